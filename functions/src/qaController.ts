@@ -8,14 +8,48 @@ import { Milvus } from 'langchain/vectorstores/milvus'
 import { OpenAIEmbeddings } from 'langchain/embeddings/openai'
 import { loadQARefineChain } from 'langchain/chains'
 import { OpenAI } from 'langchain/llms/openai'
+import { Document } from 'langchain/document'
 import { Request, Response } from 'express'
 import { getErrorMessage } from './utils'
 
+// Ask the long-lived Python retrieval service (src/retrieval_server.py),
+// which keeps its Milvus connection and embedding client warm.
+async function get_similar_documents_from_service(
+  retrievalUrl: string,
+  question: string,
+  collection_name: string
+) {
+  const response = await fetch(`${retrievalUrl}/qa`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ question, collection_name }),
+  })
+  if (!response.ok) {
+    throw new Error(
+      `retrieval service error ${response.status}: ${await response.text()}`
+    )
+  }
+  const { documents } = await response.json()
+  return documents.map(
+    (doc: { pageContent: string; metadata: Record<string, unknown> }) =>
+      new Document(doc)
+  )
+}
+
 export async function get_similar_documents(
   question: string,
   collection_name: string,
   openApiKey: string
 ) {
+  const retrievalUrl = process.env.RETRIEVAL_URL
+  if (retrievalUrl) {
+    return get_similar_documents_from_service(
+      retrievalUrl,
+      question,
+      collection_name
+    )
+  }
+
   const url = `${process.env.MILVUS_HOST}:${process.env.MILVUS_PORT}`
 
   const vectorStore = await Milvus.fromExistingCollection(
@@ -0,0 +1,439 @@
+# Vector stores behind one asynchronous interface.
+# engine.py writes a corpus to any number of backends and searches them
+# through the same calls: open, upsert, delete_by_source, search and
+# multi_search, with results as {"id", "text", "metadata", "score"} dicts
+# like similar_search.py's. Redis is driven through redis.asyncio; pymilvus,
+# supabase-py and the local store are blocking clients, so their calls run in
+# worker threads and still overlap with embedding and with other backends.
+# The client libraries are imported when a backend is opened.
+
+import re
+import json
+import asyncio
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from checkpoint import chunk_key
+from local_store import LocalVectorStore, default_local_dir, exact_search
+from milvus_schema import (text_field, text_max_length, milvus_sources, milvus_index_params,
+                           open_milvus_collection)
+
+
+BACKENDS = ["milvus", "redis", "supabase", "local", "memory"]
+DIM = 1536
+
+
+class Backend:
+    """Interface of a vector store; subclasses implement search or multi_search."""
+
+    name = "backend"
+    # Longest chunk text the store accepts, None if unbounded
+    max_text_length = None
+
+    async def open(self, drop_existing: bool = False) -> None:
+        """Connect, creating the collection or index if it doesn't exist (or dropping it first)."""
+
+    async def upsert(self, chunks: List, vectors: Sequence, positions: List[Tuple[str, int]]) -> List:
+        """Store chunks (Documents) with their vectors; returns the ids of the new rows.
+
+        positions are the (source, offset) of each chunk. Stores with string
+        keys derive the key from it, so writing a chunk again replaces it;
+        the others generate ids, and the engine deletes a file's chunks by
+        source before writing it again.
+        """
+        raise NotImplementedError
+
+    async def delete_by_source(self, sources: List[str]) -> int:
+        """Delete every chunk of the given files; returns how many were deleted."""
+        raise NotImplementedError
+
+    async def search(self, vector, k: int = 4) -> List[dict]:
+        return (await self.multi_search([vector], k))[0]
+
+    async def multi_search(self, vectors: Sequence, k: int = 4) -> List[List[dict]]:
+        # Stores without batched queries get one concurrent search per vector
+        return list(await asyncio.gather(*(self.search(vector, k) for vector in vectors)))
+
+    async def flush(self) -> None:
+        """Make everything written so far durable and searchable."""
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(Backend):
+    """Exact search over vectors kept in memory, for tests and benchmarks of the engine."""
+
+    name = "memory"
+
+    def __init__(self, dim: int = DIM):
+        self.dim = dim
+        # key -> (vector, text, metadata)
+        self.rows = {}
+
+    async def open(self, drop_existing=False):
+        if drop_existing:
+            self.rows.clear()
+
+    async def upsert(self, chunks, vectors, positions):
+        keys = [chunk_key(self.name, source, offset) for source, offset in positions]
+        for chunk, vector, key in zip(chunks, vectors, keys):
+            self.rows[key] = (np.asarray(vector, dtype=np.float32), chunk.page_content, dict(chunk.metadata))
+        return keys
+
+    async def delete_by_source(self, sources):
+        sources = set(sources)
+        stale = [key for key, (_, _, metadata) in self.rows.items() if metadata.get("source") in sources]
+        for key in stale:
+            del self.rows[key]
+        return len(stale)
+
+    async def multi_search(self, vectors, k=4):
+        if not self.rows:
+            return [[] for _ in vectors]
+        keys = list(self.rows)
+        matrix = np.stack([self.rows[key][0] for key in keys])
+        ids, distances = exact_search(matrix, np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim), k)
+        return [[{"id": keys[i], "text": self.rows[keys[i]][1], "metadata": self.rows[keys[i]][2], "score": float(d)}
+                 for i, d in zip(row_ids.tolist(), row_distances.tolist()) if i >= 0]
+                for row_ids, row_distances in zip(ids, distances)]
+
+
+class LocalBackend(Backend):
+    """The embedded LocalVectorStore of local_store.py."""
+
+    name = "local"
+
+    def __init__(self, directory: str, ef: Optional[int] = None, **store_options):
+        self.directory = directory
+        self.ef = ef
+        self.store_options = store_options
+        self.store = None
+
+    async def open(self, drop_existing=False):
+        # Vectors come from the engine, the store never embeds
+        self.store = await asyncio.to_thread(LocalVectorStore.create, self.directory, None,
+                                             drop_existing=drop_existing, **self.store_options)
+
+    async def upsert(self, chunks, vectors, positions):
+        return await asyncio.to_thread(self.store.add_vectors, vectors, [chunk.page_content for chunk in chunks],
+                                       [chunk.metadata for chunk in chunks])
+
+    def _delete_by_source(self, sources):
+        sources = set(sources)
+        ids = [i for i, record in enumerate(self.store.records)
+               if i not in self.store.deleted and record["metadata"].get("source") in sources]
+        if ids:
+            self.store.delete(ids)
+        return len(ids)
+
+    async def delete_by_source(self, sources):
+        return await asyncio.to_thread(self._delete_by_source, sources)
+
+    async def multi_search(self, vectors, k=4):
+        from similar_search import local_multi_search
+        return await asyncio.to_thread(local_multi_search, self.store, vectors, k, self.ef)
+
+    async def flush(self):
+        await asyncio.to_thread(self.store.build_index)
+
+
+class MilvusBackend(Backend):
+    """A collection with the schema of index_documents.py, written and searched with pymilvus."""
+
+    name = "milvus"
+
+    def __init__(self, collection_name: str, host: str = "127.0.0.1", port: str = "19530",
+                 index_params: Optional[dict] = None, ef: Optional[int] = None, nprobe: Optional[int] = None):
+        self.collection_name = collection_name
+        self.host = host
+        self.port = port
+        self.index_params = index_params
+        self.ef = ef
+        self.nprobe = nprobe
+        self.collection = None
+        self.max_text_length = text_max_length
+
+    def _open(self, drop_existing):
+        from pymilvus import DataType
+
+        self.collection = open_milvus_collection(self.collection_name, self.host, self.port, drop_existing,
+                                                 self.index_params or milvus_index_params())
+        self.collection.load()
+        fields = self.collection.schema.fields
+        # Insert columns follow the schema order, the auto_id primary key is left out
+        self.columns = [field.name for field in fields if not field.auto_id]
+        self.primary = next(field.name for field in fields if field.is_primary)
+        self.anns_field = next(field.name for field in fields if field.dtype == DataType.FLOAT_VECTOR)
+        self.output_fields = [field.name for field in fields if field.dtype == DataType.VARCHAR]
+
+    async def open(self, drop_existing=False):
+        await asyncio.to_thread(self._open, drop_existing)
+
+    def _insert(self, chunks, vectors):
+        columns = []
+        for name in self.columns:
+            if name == text_field:
+                columns.append([chunk.page_content for chunk in chunks])
+            elif name == self.anns_field:
+                columns.append([list(map(float, vector)) for vector in vectors])
+            elif name == "sources":
+                columns.append([milvus_sources(chunk.metadata) for chunk in chunks])
+            else:
+                columns.append([chunk.metadata.get(name, "") for chunk in chunks])
+        return list(self.collection.insert(columns).primary_keys)
+
+    async def upsert(self, chunks, vectors, positions):
+        return await asyncio.to_thread(self._insert, chunks, vectors)
+
+    def _delete_by_source(self, sources):
+        rows = self.collection.query(f"source in {json.dumps(list(sources))}", output_fields=[self.primary])
+        pks = [row[self.primary] for row in rows]
+        if pks:
+            self.collection.delete(f"{self.primary} in {pks}")
+        return len(pks)
+
+    async def delete_by_source(self, sources):
+        return await asyncio.to_thread(self._delete_by_source, sources)
+
+    def _search(self, vectors, k):
+        from similar_search import milvus_search_params
+
+        hits = self.collection.search(
+            data=[list(map(float, vector)) for vector in vectors],
+            anns_field=self.anns_field,
+            param=milvus_search_params(self.collection, k, self.ef, self.nprobe),
+            limit=k,
+            output_fields=self.output_fields,
+        )
+        return [[{
+            "id": hit.id,
+            "text": hit.entity.get(text_field),
+            "metadata": {name: hit.entity.get(name) for name in self.output_fields if name != text_field},
+            "score": hit.distance,
+        } for hit in query_hits] for query_hits in hits]
+
+    async def multi_search(self, vectors, k=4):
+        # One round trip for all the vectors
+        return await asyncio.to_thread(self._search, vectors, k)
+
+    async def flush(self):
+        await asyncio.to_thread(self.collection.flush)
+
+
+# Paths may hold commas, the default tag separator
+SOURCE_SEPARATOR = "\x1f"
+
+
+def _tag_escape(value: str) -> str:
+    # Punctuation and spaces are syntax in RediSearch tag queries
+    return re.sub(r"([^\w])", r"\\\1", value)
+
+
+class RedisBackend(Backend):
+    """Hashes in the layout of index_documents_redis.py, written and searched with redis.asyncio.
+
+    The index it creates also has a case-sensitive source TAG field that
+    doesn't split on commas, which delete_by_source queries. Indexes created by
+    index_documents_redis.py don't have one; on those, and for sources holding
+    an older index's tag separator, delete_by_source scans the index's hashes
+    and reads the source from their metadata.
+    """
+
+    name = "redis"
+
+    def __init__(self, index_name: str, url: str = "redis://127.0.0.1:6379", dim: int = DIM,
+                 content_key: str = "content", metadata_key: str = "metadata", vector_key: str = "content_vector",
+                 pipeline_size: int = 500):
+        self.index_name = index_name
+        self.url = url
+        self.dim = dim
+        self.prefix = f"doc:{index_name}"
+        self.content_key = content_key
+        self.metadata_key = metadata_key
+        self.vector_key = vector_key
+        self.pipeline_size = pipeline_size
+        self.client = None
+        self.source_tag = True
+        self.source_separator = SOURCE_SEPARATOR
+
+    async def open(self, drop_existing=False):
+        import redis
+        import redis.asyncio
+        from redis.commands.search.field import TagField, TextField, VectorField
+        from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+        self.client = redis.asyncio.from_url(self.url)
+        index = self.client.ft(self.index_name)
+        try:
+            info = await index.info()
+            exists = True
+        except redis.ResponseError:
+            exists = False
+        if exists and not drop_existing:
+            attributes = [[value.decode() if isinstance(value, bytes) else str(value) for value in attribute]
+                          for attribute in info.get("attributes", [])]
+            source = next((attribute for attribute in attributes if "source" in attribute), None)
+            self.source_tag = source is not None
+            if source is not None and "SEPARATOR" in source:
+                self.source_separator = source[source.index("SEPARATOR") + 1]
+        if exists and drop_existing:
+            await index.dropindex(delete_documents=True)
+            exists = False
+        if not exists:
+            await index.create_index(
+                fields=(
+                    TextField(name=self.content_key),
+                    TextField(name=self.metadata_key),
+                    TagField(name="source", separator=SOURCE_SEPARATOR, case_sensitive=True),
+                    VectorField(self.vector_key, "FLAT",
+                                {"TYPE": "FLOAT32", "DIM": self.dim, "DISTANCE_METRIC": "COSINE"}),
+                ),
+                definition=IndexDefinition(prefix=[self.prefix], index_type=IndexType.HASH),
+            )
+
+    async def upsert(self, chunks, vectors, positions):
+        keys = [chunk_key(self.prefix, source, offset) for source, offset in positions]
+        pipeline = self.client.pipeline(transaction=False)
+        for chunk, vector, key in zip(chunks, vectors, keys):
+            pipeline.hset(key, mapping={
+                self.content_key: chunk.page_content,
+                self.vector_key: np.asarray(vector, dtype=np.float32).tobytes(),
+                self.metadata_key: json.dumps(chunk.metadata),
+                "source": chunk.metadata.get("source", ""),
+            })
+            if len(pipeline) >= self.pipeline_size:
+                await pipeline.execute()
+        await pipeline.execute()
+        return keys
+
+    async def _scan_sources(self, sources):
+        # Keys of the hashes whose metadata has one of the sources
+        sources = set(sources)
+        matching, keys = [], []
+
+        async def check():
+            pipeline = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hget(key, self.metadata_key)
+            for key, metadata in zip(keys, await pipeline.execute()):
+                if metadata and json.loads(metadata).get("source") in sources:
+                    matching.append(key)
+            keys.clear()
+
+        async for key in self.client.scan_iter(match=f"{self.prefix}:*", count=1000):
+            keys.append(key)
+            if len(keys) >= self.pipeline_size:
+                await check()
+        if keys:
+            await check()
+        return matching
+
+    async def delete_by_source(self, sources):
+        from redis.commands.search.query import Query
+
+        deleted = 0
+        # A source holding the separator was split into several tags, it can't be queried
+        split = [source for source in sources if not self.source_tag or self.source_separator in source]
+        if split:
+            stale = await self._scan_sources(split)
+            for start in range(0, len(stale), 1000):
+                await self.client.delete(*stale[start:start + 1000])
+            deleted += len(stale)
+        sources = [source for source in sources if source not in split]
+        if not sources:
+            return deleted
+        index = self.client.ft(self.index_name)
+        query = Query("@source:{%s}" % " | ".join(_tag_escape(source) for source in sources)).no_content()
+        while True:
+            result = await index.search(query.paging(0, 1000))
+            if not result.docs:
+                return deleted
+            await self.client.delete(*[doc.id for doc in result.docs])
+            deleted += len(result.docs)
+
+    async def search(self, vector, k=4):
+        from redis.commands.search.query import Query
+
+        query = (Query(f"*=>[KNN {k} @{self.vector_key} $vector AS score]").sort_by("score")
+                 .return_fields(self.content_key, self.metadata_key, "score").paging(0, k).dialect(2))
+        result = await self.client.ft(self.index_name).search(
+            query, query_params={"vector": np.asarray(vector, dtype=np.float32).tobytes()})
+        return [{"id": doc.id, "text": getattr(doc, self.content_key),
+                 "metadata": json.loads(getattr(doc, self.metadata_key, "{}") or "{}"), "score": float(doc.score)}
+                for doc in result.docs]
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+
+class SupabaseBackend(Backend):
+    """The (content, metadata, embedding) table and match function of langchain's SupabaseVectorStore.
+
+    Scores are the similarities returned by the match function, higher is closer.
+    """
+
+    name = "supabase"
+
+    def __init__(self, url: str, service_key: str, table_name: str = "documents",
+                 query_name: str = "match_documents"):
+        self.url = url
+        self.service_key = service_key
+        self.table_name = table_name
+        self.query_name = query_name
+        self.client = None
+
+    async def open(self, drop_existing=False):
+        from supabase.client import create_client
+
+        self.client = create_client(self.url, self.service_key)
+        if drop_existing:
+            # The table and its match function are created once with SQL, a rebuild only empties the table
+            await asyncio.to_thread(lambda: self.client.table(self.table_name).delete().neq("id", -1).execute())
+
+    def _insert(self, chunks, vectors):
+        rows = [{"content": chunk.page_content, "metadata": chunk.metadata, "embedding": list(map(float, vector))}
+                for chunk, vector in zip(chunks, vectors)]
+        result = self.client.table(self.table_name).insert(rows).execute()
+        return [row["id"] for row in result.data]
+
+    async def upsert(self, chunks, vectors, positions):
+        return await asyncio.to_thread(self._insert, chunks, vectors)
+
+    def _delete_by_source(self, sources):
+        result = self.client.table(self.table_name).delete().in_("metadata->>source", list(sources)).execute()
+        return len(result.data)
+
+    async def delete_by_source(self, sources):
+        return await asyncio.to_thread(self._delete_by_source, sources)
+
+    def _search(self, vector, k):
+        result = self.client.rpc(self.query_name, {"query_embedding": list(map(float, vector)),
+                                                   "match_count": k}).execute()
+        return [{"id": row.get("id"), "text": row["content"], "metadata": row.get("metadata") or {},
+                 "score": row.get("similarity")} for row in result.data]
+
+    async def search(self, vector, k=4):
+        return await asyncio.to_thread(self._search, vector, k)
+
+
+def make_backend(name: str, collection_name: str, host: str = "127.0.0.1", port: str = "19530",
+                 redis_url: str = "redis://127.0.0.1:6379", supabase_url: Optional[str] = None,
+                 supabase_service_key: Optional[str] = None, query_name: str = "match_documents",
+                 local_dir: Optional[str] = None, ef: Optional[int] = None) -> Backend:
+    """Backend name for collection_name (the Redis index or Supabase table of that name)."""
+    if name == "milvus":
+        return MilvusBackend(collection_name, host, port, ef=ef)
+    if name == "redis":
+        return RedisBackend(collection_name, redis_url)
+    if name == "supabase":
+        if not supabase_url or not supabase_service_key:
+            raise ValueError("The supabase backend needs --supabase_url and --supabase_service_key")
+        return SupabaseBackend(supabase_url, supabase_service_key, collection_name, query_name)
+    if name == "local":
+        return LocalBackend(local_dir or default_local_dir(collection_name), ef)
+    if name == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown backend {name}, expected one of {BACKENDS}")
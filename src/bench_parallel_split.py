@@ -0,0 +1,74 @@
+# Benchmark of serial vs process-pool loading and splitting.
+# Generates a synthetic markdown corpus, runs iter_file_chunks with an
+# increasing number of workers, checks every run produces exactly the same
+# chunks as the serial path and prints the speedup.
+
+import io
+import os
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+from functools import partial
+
+from index_documents import load_documents, split_documents
+from pipeline import iter_file_chunks
+
+
+WORDS = ["milvus", "vector", "index", "chunk", "embedding", "query", "document",
+         "cairo", "contract", "storage", "function", "return", "type", "module"]
+
+
+def make_corpus(directory, files, paragraphs, seed=0):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"doc_{i:05d}.md")
+        with open(path, "w", encoding="utf8") as f:
+            for p in range(paragraphs):
+                f.write(f"## Section {p}\n\n")
+                f.write(" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 200))))
+                f.write("\n\n")
+        paths.append(path)
+    return paths
+
+
+def run(paths, file_type, chunk_size, chunk_overlap, workers):
+    started = time.perf_counter()
+    # Keep the per-file progress lines out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        chunks = list(iter_file_chunks(
+            paths,
+            partial(load_documents, encoding="utf8", file_type=file_type),
+            partial(split_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap),
+            workers))
+    return chunks, time.perf_counter() - started
+
+
+# python src/bench_parallel_split.py --files 200 --workers 1 2 4 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parallel document loading and splitting.")
+    parser.add_argument('--files', type=int, default=200, help='Number of files in the synthetic corpus.')
+    parser.add_argument('--paragraphs', type=int, default=50, help='Paragraphs per file.')
+    parser.add_argument('--file_type', type=str, default="markdown", choices=["text", "markdown"],
+                        help='Loader to benchmark.')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Size of the chunks.')
+    parser.add_argument('--chunk_overlap', type=int, default=0, help='Overlap between chunks.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Worker counts to benchmark.')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_corpus(directory, args.files, args.paragraphs)
+        baseline, baseline_seconds = run(paths, args.file_type, args.chunk_size, args.chunk_overlap, 1)
+        expected = [(c.page_content, c.metadata) for c in baseline]
+        print(f"workers=1: {len(baseline)} chunks in {baseline_seconds:.2f}s")
+        for workers in args.workers:
+            if workers == 1:
+                continue
+            chunks, seconds = run(paths, args.file_type, args.chunk_size, args.chunk_overlap, workers)
+            identical = [(c.page_content, c.metadata) for c in chunks] == expected
+            print(f"workers={workers}: {len(chunks)} chunks in {seconds:.2f}s, "
+                  f"speedup {baseline_seconds / seconds:.2f}x, identical={identical}")
@@ -0,0 +1,222 @@
+# Retrieval benchmark across index configurations.
+# Embeds a corpus with a deterministic local fake embedder, builds FLAT, HNSW
+# and IVF indexes over a sweep of parameters and reports build time, memory,
+# QPS, p50/p99 latency and recall@k against exact search. Compressed storage
+# modes (float16, int8, pq) also report the memory saved and the recall lost,
+# with and without re-ranking. Results are written as JSON so runs can be
+# compared and regressions caught.
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from fake_embeddings import BagOfWordsEmbeddings
+from hnsw import HNSWIndex
+from ivf import IVFIndex
+from local_store import codes_search, exact_search
+from quantize import make_codec, rerank, training_sample
+
+
+WORDS = ["milvus", "vector", "index", "chunk", "embedding", "query", "document", "cairo",
+         "contract", "storage", "function", "return", "type", "module", "felt", "struct",
+         "trait", "impl", "event", "syscall", "account", "deploy", "class", "hash"]
+
+
+def synthetic_corpus(num_chunks: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    # A Zipf-like vocabulary so some words are shared widely and others are rare
+    vocabulary = WORDS + [f"term{i}" for i in range(2000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return [" ".join(rng.choices(vocabulary, weights, k=rng.randint(20, 120)))
+            for _ in range(num_chunks)]
+
+
+def load_corpus(input_dir: str, chunk_size: int, limit: int) -> List[str]:
+    # Plain character windows, good enough to get realistic text into the embedder
+    chunks = []
+    for root, _, files in os.walk(input_dir):
+        for name in sorted(files):
+            with open(os.path.join(root, name), encoding="utf8", errors="ignore") as f:
+                text = f.read()
+            chunks.extend(text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+            if len(chunks) >= limit:
+                return chunks[:limit]
+    return chunks
+
+
+def make_queries(chunks: List[str], num_queries: int, seed: int = 1) -> List[str]:
+    # Queries are random word windows taken from corpus chunks
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        words = rng.choice(chunks).split()
+        start = rng.randrange(max(1, len(words) - 8))
+        queries.append(" ".join(words[start:start + 8]))
+    return queries
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0].tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(search_one: Callable, queries: np.ndarray, k: int, truth: np.ndarray) -> dict:
+    found = np.full((len(queries), k), -1, dtype=np.int64)
+    latencies = []
+    started = time.perf_counter()
+    for i, query in enumerate(queries):
+        query_started = time.perf_counter()
+        ids, _ = search_one(query)
+        latencies.append(time.perf_counter() - query_started)
+        found[i, :len(ids)] = ids[:k]
+    elapsed = time.perf_counter() - started
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "qps": round(len(queries) / elapsed, 2),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+        f"recall@{k}": round(recall_at_k(found, truth), 4),
+    }
+
+
+def timed_build(build: Callable):
+    tracemalloc.start()
+    started = time.perf_counter()
+    index = build()
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, {"build_seconds": round(seconds, 3), "build_peak_bytes": peak}
+
+
+def default_pq_m(dim: int) -> int:
+    # Largest number of subspaces dividing dim with at least 16 dimensions each (96 for 1536)
+    return max(m for m in range(1, max(1, dim // 16) + 1) if dim % m == 0)
+
+
+def write_report(report: dict, path: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run(vectors, queries, k, args, on_result: Optional[Callable[[List[dict]], None]] = None) -> List[dict]:
+    """Benchmark every configuration; on_result(results) is called after each one."""
+    results = []
+
+    def add(result):
+        results.append(result)
+        print(json.dumps(result))
+        if on_result is not None:
+            on_result(results)
+
+    truth, _ = exact_search(vectors, queries, k)
+
+    norms = np.einsum("ij,ij->i", vectors, vectors)
+    flat = {"index_type": "FLAT", "params": {}, "build_seconds": 0.0, "build_peak_bytes": 0,
+            "index_bytes": 0, "vector_bytes": vectors.nbytes}
+    flat.update(measure(lambda q: tuple(a[0] for a in exact_search(vectors, q[None], k, norms)),
+                        queries, k, truth))
+    add(flat)
+
+    for M in args.hnsw_m:
+        for ef_construction in args.hnsw_ef_construction:
+            index, build = timed_build(lambda: HNSWIndex(M, ef_construction).build(vectors))
+            for ef in args.hnsw_ef:
+                result = {"index_type": "HNSW", "params": {"M": M, "efConstruction": ef_construction, "ef": ef},
+                          **build, "index_bytes": index.nbytes(), "vector_bytes": vectors.nbytes}
+                result.update(measure(lambda q: index.search(q, k, ef), queries, k, truth))
+                add(result)
+
+    for nlist in args.ivf_nlist:
+        index, build = timed_build(lambda: IVFIndex(nlist).build(vectors))
+        for nprobe in args.ivf_nprobe:
+            result = {"index_type": "IVF_FLAT", "params": {"nlist": nlist, "nprobe": nprobe},
+                      **build, "index_bytes": index.nbytes(), "vector_bytes": vectors.nbytes}
+            result.update(measure(lambda q: index.search(q, k, nprobe), queries, k, truth))
+            add(result)
+
+    for storage in args.quantization:
+        def build():
+            codec = make_codec(storage, vectors.shape[1], args.pq_m).train(training_sample(vectors))
+            return codec, codec.encode(vectors)
+        (codec, codes), build_stats = timed_build(build)
+        for factor in args.rerank:
+            params = {"storage": storage, "rerank": factor, **({"m": args.pq_m} if storage == "pq" else {})}
+            result = {"index_type": "FLAT", "params": params, **build_stats,
+                      "index_bytes": codes.nbytes, "vector_bytes": vectors.nbytes,
+                      "memory_saved_bytes": vectors.nbytes - codes.nbytes}
+            if factor:
+                search_one = lambda q: tuple(a[0] for a in rerank(
+                    vectors, q[None], codes_search(codec, codes, q[None], k * factor)[0], k))
+            else:
+                search_one = lambda q: tuple(a[0] for a in codes_search(codec, codes, q[None], k))
+            result.update(measure(search_one, queries, k, truth))
+            result["recall_lost"] = round(flat[f"recall@{k}"] - result[f"recall@{k}"], 4)
+            add(result)
+    return results
+
+
+# python src/bench_retrieval.py --num_chunks 5000 --output bench_retrieval.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark retrieval index configurations.")
+    parser.add_argument('--input_dir', type=str, default=None,
+                        help='Directory of documents to use as corpus (default: a synthetic corpus).')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Characters per chunk of the corpus.')
+    parser.add_argument('--num_chunks', type=int, default=5000, help='Number of chunks to index.')
+    parser.add_argument('--num_queries', type=int, default=200, help='Number of queries to run.')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimension of the fake embeddings.')
+    parser.add_argument('--k', type=int, default=10, help='Number of neighbours for recall@k.')
+    parser.add_argument('--hnsw_m', type=int, nargs='*', default=[8, 16], help='HNSW M values to sweep.')
+    parser.add_argument('--hnsw_ef_construction', type=int, nargs='*', default=[64],
+                        help='HNSW efConstruction values to sweep.')
+    parser.add_argument('--hnsw_ef', type=int, nargs='*', default=[16, 64, 128], help='HNSW ef values to sweep.')
+    parser.add_argument('--ivf_nlist', type=int, nargs='*', default=[64], help='IVF nlist values to sweep.')
+    parser.add_argument('--ivf_nprobe', type=int, nargs='*', default=[1, 8, 16], help='IVF nprobe values to sweep.')
+    parser.add_argument('--quantization', type=str, nargs='*', default=["float16", "int8", "pq"],
+                        choices=["float16", "int8", "pq"], help='Compressed storage modes to sweep.')
+    parser.add_argument('--pq_m', type=int, default=None,
+                        help='Number of PQ subspaces, must divide --dim (default: --dim / 16, 96 for 1536).')
+    parser.add_argument('--rerank', type=int, nargs='*', default=[0, 4],
+                        help='Re-ranking factors to sweep for compressed storage (0 disables re-ranking).')
+    parser.add_argument('--output', type=str, default="bench_retrieval.json", help='Where to write the JSON results.')
+
+    args = parser.parse_args()
+    if args.pq_m is None:
+        args.pq_m = default_pq_m(args.dim)
+    if "pq" in args.quantization and args.dim % args.pq_m:
+        # Fail before the other configurations run, not when pq is reached
+        parser.error(f"--dim ({args.dim}) must be a multiple of --pq_m ({args.pq_m})")
+
+    if args.input_dir:
+        chunks = load_corpus(args.input_dir, args.chunk_size, args.num_chunks)
+    else:
+        chunks = synthetic_corpus(args.num_chunks)
+    embeddings = BagOfWordsEmbeddings(args.dim)
+    vectors = np.array(embeddings.embed_documents(chunks), dtype=np.float32)
+    queries = np.array(embeddings.embed_documents(make_queries(chunks, args.num_queries)), dtype=np.float32)
+
+    report = {
+        "corpus": {"chunks": len(chunks), "queries": len(queries), "dim": args.dim,
+                   "source": args.input_dir or "synthetic"},
+        "k": args.k,
+        "platform": {"python": platform.python_version(), "numpy": np.__version__,
+                     "machine": platform.machine()},
+        "results": [],
+    }
+
+    def save(results):
+        # Rewritten after every configuration, so an interrupted sweep keeps what it measured
+        report["results"] = results
+        write_report(report, args.output)
+
+    results = run(vectors, queries, args.k, args, save)
+    print(f"Wrote {len(results)} results to {args.output}.")
@@ -0,0 +1,94 @@
+# Benchmark of the command line tools' startup cost.
+# Imports each entry point in fresh interpreters, reports the median import
+# time and the packages that dominate it (from python -X importtime), and
+# fails if a module pulls in a heavy package it is supposed to import lazily:
+# backends, loaders and langchain are only imported once a run selects them.
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from collections import Counter
+
+
+# Packages no entry point may import before it knows it needs them
+HEAVY = ["langchain", "pymilvus", "redis", "supabase", "git", "unstructured", "aiohttp"]
+# Entry point -> heavy packages it legitimately imports at startup
+ENTRY_POINTS = {
+    "similar_search": [],
+    "retrieval_server": ["aiohttp"],
+    "index_documents": [],
+    "index_documents_redis": [],
+    "index_documents_supabase": [],
+    "index_sources": [],
+    "engine": [],
+}
+
+CHILD = """
+import sys, time, json
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - started,
+                  "packages": sorted({{name.split(".")[0] for name in sys.modules}})}}))
+"""
+
+
+def import_once(module, importtime=False):
+    # A fresh interpreter per measurement, so nothing is imported already
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD.format(module=module)]
+    result = subprocess.run(command, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def package_self_times(importtime_output):
+    """Self import time in ms per top-level package, from the -X importtime report."""
+    totals = Counter()
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        totals[name.strip().split(".")[0]] += int(self_us) / 1000
+    return totals
+
+
+def measure(module, runs):
+    """(median import seconds, packages imported, ms per package)."""
+    seconds = []
+    for _ in range(runs):
+        result, _ = import_once(module)
+        seconds.append(result["seconds"])
+    result, importtime_output = import_once(module, importtime=True)
+    return statistics.median(seconds), set(result["packages"]), package_self_times(importtime_output)
+
+
+# python src/bench_startup.py --runs 5 --budget_ms 500
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the command line tools.")
+    parser.add_argument('--modules', type=str, nargs='+', default=list(ENTRY_POINTS),
+                        help='Entry point modules to import.')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per module, the median is reported.')
+    parser.add_argument('--top', type=int, default=5, help='Number of slowest packages listed per module.')
+    parser.add_argument('--budget_ms', type=float, default=None,
+                        help='Fail if a module takes longer than this to import (median).')
+
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        seconds, packages, package_ms = measure(module, args.runs)
+        unexpected = sorted(p for p in HEAVY if p in packages and p not in ENTRY_POINTS.get(module, []))
+        slowest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in package_ms.most_common(args.top))
+        print(f"{module}: {seconds * 1000:.0f}ms (slowest: {slowest})")
+        if unexpected:
+            failures.append(f"{module} imports {', '.join(unexpected)} at startup")
+        if args.budget_ms is not None and seconds * 1000 > args.budget_ms:
+            failures.append(f"{module} takes {seconds * 1000:.0f}ms to import, over the {args.budget_ms:g}ms budget")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,175 @@
+# Resumable full indexing runs.
+# The checkpoint records, for every file, how many of its chunks were committed
+# to the backend and their ids. It is an append-only log, synced before and
+# after each batch: before, a record marks the batch's files pending, after,
+# a record commits the ids of the batch. Each batch costs two small appends
+# whatever the size of the run; the log is compacted when a run resumes.
+# A resumed run skips committed chunks, and rows a dead process wrote for a
+# pending batch are found by source and deleted before anything is re-written,
+# so restarts never duplicate rows.
+
+import os
+import json
+import hashlib
+from typing import Callable, Iterable, Iterator, List, Optional
+
+
+def default_checkpoint_path(name: str) -> str:
+    return os.path.join(".index_checkpoint", f"{name}.jsonl")
+
+
+def chunk_key(prefix: str, source: str, offset: int) -> str:
+    """Deterministic key of a chunk, so re-writing it overwrites instead of duplicating."""
+    digest = hashlib.sha1(f"{source}\0{offset}".encode("utf-8")).hexdigest()
+    return f"{prefix}:{digest}"
+
+
+class Checkpoint:
+    def __init__(self, path: str, settings: dict, resume: bool = False):
+        # settings are the options that decide how files are chunked; a run
+        # can only resume a checkpoint written with the same settings
+        self.path = path
+        self.settings = settings
+        self.files = {}
+        self.pending = None
+        self._next = {}
+        self._last_source = None
+        # Whether progress of an earlier run was loaded
+        self.resumed = resume and os.path.exists(path)
+        if self.resumed:
+            self._load()
+            # One snapshot instead of the records of every batch so far
+            self._rewrite()
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf8") as f:
+            lines = f.read().splitlines()
+        records = []
+        for number, line in enumerate(lines):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                if number == len(lines) - 1:
+                    # The process died while appending, the batch was never committed
+                    break
+                raise
+        if not records or records[0].get("settings") != self.settings:
+            settings = records[0].get("settings") if records else None
+            raise ValueError(f"Checkpoint {self.path} was written with settings {settings}, "
+                             f"not {self.settings}; run without --resume to start over")
+        for record in records[1:]:
+            if "pending" in record:
+                self.pending = record["pending"]
+            else:
+                self._commit(record["commit"])
+                self.pending = None
+        # Like a fresh process, only a source change seen by this run completes a file
+        self._last_source = None
+
+    def _commit(self, committed: List) -> None:
+        # committed lists the (source, id) of each chunk of a batch, in order
+        for source, row_id in committed:
+            entry = self.files.setdefault(source, {"offset": 0, "ids": [], "done": False})
+            entry["offset"] += 1
+            entry["ids"].append(row_id)
+            if self._last_source is not None and source != self._last_source:
+                # Files are streamed in order, so the previous one is complete
+                self.files[self._last_source]["done"] = True
+            self._last_source = source
+
+    def _append(self, record: dict) -> None:
+        with open(self.path, "a", encoding="utf8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write(json.dumps({"settings": self.settings}) + "\n")
+            for source, entry in self.files.items():
+                f.write(json.dumps({"commit": [[source, row_id] for row_id in entry["ids"]]}) + "\n")
+            if self.pending:
+                f.write(json.dumps({"pending": self.pending}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def start(self) -> None:
+        """Forget any previous progress, for a run that starts from scratch."""
+        self.files = {}
+        self.pending = None
+        self._rewrite()
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def committed(self) -> int:
+        return sum(entry["offset"] for entry in self.files.values())
+
+    def ids(self, path: str) -> List:
+        """Ids of the committed chunks of a file."""
+        return self.files.get(path, {}).get("ids", [])
+
+    def remaining(self, paths: Iterable[str]) -> List[str]:
+        """Paths not completely committed yet."""
+        return [path for path in paths if not self.files.get(path, {}).get("done")]
+
+    def recover(self, find_rows: Callable[[List[str]], Iterable], delete_ids: Callable[[List], None]) -> int:
+        """Delete rows of the pending batch that were written but never committed.
+
+        find_rows(sources) yields the ids of the backend rows of those sources.
+        """
+        if not self.pending:
+            return 0
+        sources = sorted(self.pending)
+        # Stores may return ids as numbers where the checkpoint has strings, compare them as text
+        committed = {str(i) for source in sources for i in self.files.get(source, {}).get("ids", [])}
+        orphans = [i for i in find_rows(sources) if str(i) not in committed]
+        if orphans:
+            delete_ids(orphans)
+            print(f"Deleted {len(orphans)} uncommitted rows of {', '.join(sources)}.")
+        self.pending = None
+        # An empty commit closes the pending batch
+        self._append({"commit": []})
+        return len(orphans)
+
+    def skip_committed(self, chunks: Iterable, on_skip: Optional[Callable] = None) -> Iterator:
+        """Drop the chunks a previous run committed; on_skip(chunk, id) sees each of them."""
+        seen = {}
+        for chunk in chunks:
+            source = chunk.metadata.get("source")
+            offset = seen.get(source, 0)
+            seen[source] = offset + 1
+            entry = self.files.get(source)
+            if entry is not None and offset < entry["offset"]:
+                if on_skip is not None:
+                    on_skip(chunk, entry["ids"][offset])
+                continue
+            yield chunk
+
+    def writer(self, add_fn: Callable[[List, List], List]) -> Callable[[List], List]:
+        """Wrap add_fn(batch, positions) -> ids so every batch is checkpointed.
+
+        positions are the (source, offset) of each chunk of the batch. The
+        returned function is meant for the single writer thread of index_stream.
+        """
+        def write(batch):
+            positions = []
+            for chunk in batch:
+                source = chunk.metadata.get("source")
+                if source not in self._next:
+                    self._next[source] = self.files.get(source, {}).get("offset", 0)
+                positions.append((source, self._next[source]))
+                self._next[source] += 1
+            self.pending = sorted({source for source, _ in positions})
+            self._append({"pending": self.pending})
+            ids = add_fn(batch, positions)
+            committed = [[source, row_id] for (source, _), row_id in zip(positions, ids)]
+            self._append({"commit": committed})
+            self._commit(committed)
+            self.pending = None
+            return ids
+        return write
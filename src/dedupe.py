@@ -0,0 +1,175 @@
+# Duplicate and near-duplicate chunk elimination between splitting and indexing.
+# Exact duplicates are found by a hash of the normalized text. Near duplicates
+# are found with MinHash signatures over word shingles (hashed with mmh3) and
+# LSH banding: chunks sharing a band bucket are candidates, and a candidate is
+# a duplicate when the estimated Jaccard similarity reaches the threshold.
+# The first chunk seen is kept. Kept chunks are streamed on as they arrive,
+# so only the signatures stay in memory; with all_sources they are held back
+# until every chunk was seen, and each lists every source of its duplicates.
+# Without it, sources found after a chunk was streamed on are written to a
+# side table instead, one JSON line per kept chunk.
+
+import os
+import re
+import json
+import hashlib
+from typing import Iterable, Iterator, List, Optional
+
+import mmh3
+import numpy as np
+
+
+# A prime above 2**32, so (a * x + b) mod p permutes 32 bit shingle hashes
+_PRIME = np.uint64(4294967311)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+
+
+def default_sources_path(name: str) -> str:
+    return os.path.join(".index_manifest", f"{name}.sources.jsonl")
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class ChunkDeduplicator:
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, bands: int = 16,
+                 shingle_size: int = 5, seed: int = 1, all_sources: bool = False):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.all_sources = all_sources
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 32, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2 ** 32, num_perm, dtype=np.uint64)
+        self._exact = {}
+        self._buckets = [{} for _ in range(bands)]
+        self._signatures = []
+        # Sources of each kept chunk, its own first
+        self._sources: List[list] = []
+        # Text digest and own source of each kept chunk
+        self._keys: List[tuple] = []
+        # Kept chunks that got sources after they were streamed on
+        self._late = set()
+        self.sources_path = None
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        # Sources found after their kept chunk was streamed on
+        self.unrecorded_sources = 0
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature of the word shingles of text, None for empty text."""
+        words = normalize_text(text).split()
+        if not words:
+            return None
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        hashes = np.array([mmh3.hash(s, signed=False) for s in shingles], dtype=np.uint64)
+        # One row per permutation, the minimum over shingles is the signature
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _PRIME & _MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def find(self, text: str):
+        """Index of the kept chunk text duplicates, or None. Adds nothing."""
+        digest = hashlib.sha1(normalize_text(text).encode("utf-8")).digest()
+        if digest in self._exact:
+            return self._exact[digest], digest, None, True
+        signature = self.signature(text)
+        if signature is not None:
+            candidates = {self._buckets[band].get(key)
+                          for band, key in enumerate(self._band_keys(signature))} - {None}
+            for candidate in sorted(candidates):
+                similarity = float(np.mean(self._signatures[candidate] == signature))
+                if similarity >= self.threshold:
+                    return candidate, digest, signature, False
+        return None, digest, signature, False
+
+    @property
+    def kept(self) -> int:
+        return len(self._sources)
+
+    def add(self, chunk) -> bool:
+        """Keep chunk unless it duplicates a kept chunk; returns whether it was kept.
+
+        A kept chunk's metadata["sources"] is the list later duplicates add
+        their sources to.
+        """
+        match, digest, signature, exact = self.find(chunk.page_content)
+        source = chunk.metadata.get("source")
+        if match is not None:
+            sources = self._sources[match]
+            if source is not None and source not in sources:
+                sources.append(source)
+                if not self.all_sources:
+                    self.unrecorded_sources += 1
+                    self._late.add(match)
+            if exact:
+                self.exact_duplicates += 1
+            else:
+                self.near_duplicates += 1
+            return False
+        index = len(self._sources)
+        chunk.metadata["sources"] = [source] if source is not None else []
+        self._sources.append(chunk.metadata["sources"])
+        self._keys.append((digest, source))
+        self._exact[digest] = index
+        self._signatures.append(signature)
+        if signature is not None:
+            for band, key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(key, index)
+        return True
+
+    def dedupe(self, chunks: Iterable) -> Iterable:
+        """Chunks kept from chunks, in order.
+
+        Streamed as they arrive, listing only the sources known by then (their
+        own). With all_sources the sources of duplicates are only known once
+        every chunk was seen, so a list is returned after reading them all.
+        """
+        if self.all_sources:
+            return [chunk for chunk in chunks if self.add(chunk)]
+        return self._stream(chunks)
+
+    def _stream(self, chunks: Iterable) -> Iterator:
+        for chunk in chunks:
+            if self.add(chunk):
+                # A copy, the writer may serialize it while later duplicates are found
+                chunk.metadata["sources"] = list(chunk.metadata["sources"])
+                yield chunk
+
+    def save_sources(self, path: str) -> int:
+        """Write every source of the kept chunks that got sources after they were streamed on.
+
+        One JSON line per chunk, found in the store by its own source and the
+        sha1 of its normalized text; returns the number of lines.
+        """
+        if not self._late:
+            # A table from an earlier run would no longer match the store
+            if os.path.exists(path):
+                os.remove(path)
+            return 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf8") as f:
+            for index in sorted(self._late):
+                digest, source = self._keys[index]
+                f.write(json.dumps({"source": source, "text_sha1": digest.hex(),
+                                    "sources": self._sources[index]}) + "\n")
+        self.sources_path = path
+        return len(self._late)
+
+    def report(self) -> str:
+        report = (f"Dedupe kept {self.kept} chunks, dropped {self.exact_duplicates} exact "
+                  f"and {self.near_duplicates} near duplicates.")
+        if self.unrecorded_sources:
+            report += (f" {self.unrecorded_sources} sources of duplicates were found after their kept chunk "
+                       f"was indexed")
+            report += f", they are listed in {self.sources_path}." if self.sources_path else "."
+            report += " --dedupe_all_sources stores them with the chunks."
+        return report
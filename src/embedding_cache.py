@@ -0,0 +1,299 @@
+# Persistent, content-addressed cache for embedding vectors.
+# Vectors live in a memory-mapped float32 file; a small JSON index maps
+# hash(model, text) to a slot in that file and keeps the LRU order. The index
+# is only written every autosave_every puts, so each slot also records a
+# fingerprint of its key: after a crash, an index entry whose slot was reused
+# for another text is detected and dropped instead of returning that text's vector.
+
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from metrics import METRICS
+
+
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.f32"
+KEYS_FILE = "keys.bin"
+FINGERPRINT_BYTES = 16
+
+
+def cache_key(model: str, text: str) -> str:
+    """Content hash for a (model, text) pair."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()[:32]
+
+
+def _fingerprint(key: str) -> np.ndarray:
+    return np.frombuffer(hashlib.blake2b(key.encode("utf-8"), digest_size=FINGERPRINT_BYTES).digest(),
+                         dtype=np.uint8)
+
+
+def _model_name(embeddings) -> str:
+    """Best-effort model identifier for a langchain embeddings object."""
+    return (getattr(embeddings, "model", None)
+            or getattr(embeddings, "document_model_name", None)
+            or type(embeddings).__name__)
+
+
+class EmbeddingCache:
+    """On-disk embedding store with LRU eviction and hit/miss counters."""
+
+    def __init__(self, cache_dir: str, dim: int = 1536, max_entries: int = 500_000,
+                 autosave_every: int = 10_000):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.max_entries = max_entries
+        self.autosave_every = autosave_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dirty = 0
+        # key -> slot, ordered from least to most recently used
+        self._slots = OrderedDict()
+        self._free = []
+        self._capacity = 0
+        self._vectors = None
+        self._keys = None
+        # Shared by the threads of the retrieval server
+        self._lock = threading.RLock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILE)
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.cache_dir, VECTORS_FILE)
+
+    @property
+    def _keys_path(self):
+        return os.path.join(self.cache_dir, KEYS_FILE)
+
+    def _map(self):
+        # Both files are sized for the capacity by the caller
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                                  shape=(self._capacity, self.dim))
+        self._keys = np.memmap(self._keys_path, dtype=np.uint8, mode="r+",
+                               shape=(self._capacity, FINGERPRINT_BYTES))
+
+    def _resize_files(self, capacity: int):
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._keys.flush()
+            self._vectors, self._keys = None, None
+        for path, row_bytes in ((self._vectors_path, self.dim * 4), (self._keys_path, FINGERPRINT_BYTES)):
+            with open(path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, encoding="utf8") as f:
+            index = json.load(f)
+        if index["dim"] != self.dim or not os.path.exists(self._vectors_path):
+            # Incompatible or orphaned index, start from scratch
+            return
+        self._capacity = index["capacity"]
+        self._slots = OrderedDict((key, slot) for key, slot in index["entries"])
+        used = set(self._slots.values())
+        self._free = [s for s in range(self._capacity) if s not in used]
+        fingerprinted = os.path.exists(self._keys_path)
+        if not fingerprinted:
+            self._resize_files(self._capacity)
+        self._map()
+        if not fingerprinted:
+            # Written before slots had fingerprints, trust the index this once
+            for key, slot in self._slots.items():
+                self._keys[slot] = _fingerprint(key)
+        # Honour a smaller max_entries than the one the cache was built with
+        while len(self._slots) > self.max_entries:
+            self._evict()
+        if self._capacity > self.max_entries:
+            self._shrink(self.max_entries)
+
+    def _shrink(self, capacity: int):
+        # Move the vectors in slots past the new capacity into free slots below it, then cut the file
+        free = sorted((s for s in self._free if s < capacity), reverse=True)
+        for key, slot in list(self._slots.items()):
+            if slot >= capacity:
+                new_slot = free.pop()
+                self._vectors[new_slot] = self._vectors[slot]
+                self._keys[new_slot] = self._keys[slot]
+                self._slots[key] = new_slot
+        self._free = free
+        self._capacity = capacity
+        # The index is written first: a longer file than the index says is still readable
+        self.flush()
+        self._resize_files(capacity)
+        self._map()
+
+    def _grow(self, needed: int):
+        if needed <= self._capacity:
+            return
+        new_capacity = min(self.max_entries, max(needed, self._capacity * 2, 1024))
+        self._resize_files(new_capacity)
+        self._free.extend(range(self._capacity, new_capacity))
+        self._capacity = new_capacity
+        self._map()
+
+    def _evict(self):
+        _, slot = self._slots.popitem(last=False)
+        self._free.append(slot)
+        self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._slots)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._slots
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None and not np.array_equal(self._keys[slot], _fingerprint(key)):
+                # The slot was reused after the index was last saved
+                del self._slots[key]
+                self._free.append(slot)
+                slot = None
+            if slot is None:
+                self.misses += 1
+                return None
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return np.array(self._vectors[slot])
+
+    def put(self, key: str, vector) -> None:
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.dim,):
+            raise ValueError(
+                f"Expected a vector of dimension {self.dim}, got {vector.shape}")
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                if not self._free:
+                    if self._capacity < self.max_entries:
+                        self._grow(self._capacity + 1)
+                    else:
+                        self._evict()
+                slot = self._free.pop()
+            self._slots[key] = slot
+            self._slots.move_to_end(key)
+            # Cleared first, so a crash mid-write leaves a slot that matches no key
+            self._keys[slot] = 0
+            self._vectors[slot] = vector
+            self._keys[slot] = _fingerprint(key)
+            self._dirty += 1
+            if self._dirty >= self.autosave_every:
+                self.flush()
+
+    def flush(self) -> None:
+        """Persist the vectors and the index."""
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._keys.flush()
+            index = {
+                "dim": self.dim,
+                "capacity": self._capacity,
+                "entries": list(self._slots.items()),
+            }
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._index_path)
+            self._dirty = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._slots),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachedEmbeddings:
+    """Wraps a langchain embeddings object and serves repeated texts from an EmbeddingCache."""
+
+    def __init__(self, embeddings, cache: EmbeddingCache, model: Optional[str] = None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or _model_name(embeddings)
+
+    def _lookup(self, texts: List[str]):
+        keys = [cache_key(self.model, text) for text in texts]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        METRICS.count("embedding_cache_hits", len(texts) - len(missing))
+        METRICS.count("embedding_cache_misses", len(missing))
+        # Embed each distinct missing text once
+        unique = list(OrderedDict((keys[i], texts[i]) for i in missing).items())
+        return keys, results, missing, unique
+
+    def _store(self, keys, results, missing, unique, vectors) -> List[List[float]]:
+        fresh = {}
+        for (key, _), vector in zip(unique, vectors):
+            self.cache.put(key, vector)
+            fresh[key] = vector
+        for i in missing:
+            results[i] = fresh[keys[i]]
+        return [list(map(float, vector)) for vector in results]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, results, missing, unique = self._lookup(texts)
+        vectors = []
+        if unique:
+            with METRICS.timer("embed"):
+                vectors = self.embeddings.embed_documents([text for _, text in unique])
+        return self._store(keys, results, missing, unique, vectors)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Misses go to the client's own async path, so its concurrency limit applies to them
+        keys, results, missing, unique = self._lookup(texts)
+        vectors = []
+        if unique:
+            with METRICS.timer("embed"):
+                if hasattr(self.embeddings, "aembed_documents"):
+                    vectors = await self.embeddings.aembed_documents([text for _, text in unique])
+                else:
+                    vectors = await asyncio.to_thread(self.embeddings.embed_documents,
+                                                      [text for _, text in unique])
+        return self._store(keys, results, missing, unique, vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model, text)
+        vector = self.cache.get(key)
+        METRICS.count("embedding_cache_hits" if vector is not None else "embedding_cache_misses")
+        if vector is None:
+            with METRICS.timer("embed"):
+                vector = self.embeddings.embed_query(text)
+            self.cache.put(key, vector)
+        return list(map(float, vector))
+
+
+def cached_embeddings(embeddings, cache_dir: Optional[str], **kwargs):
+    """Wrap embeddings with an on-disk cache, or return them unchanged if cache_dir is None."""
+    if cache_dir is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, EmbeddingCache(cache_dir, **kwargs))
+
+
+def report_cache(embeddings, file=None) -> None:
+    """Flush the cache behind embeddings (if any) and print its counters."""
+    if isinstance(embeddings, CachedEmbeddings):
+        embeddings.cache.flush()
+        print(f"Embedding cache: {embeddings.cache.stats()}", file=file)
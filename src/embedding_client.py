@@ -0,0 +1,325 @@
+# Concurrent, batched client for the OpenAI embeddings endpoint.
+# Chunks are packed into token-budgeted requests, several requests are kept
+# in flight, and requests-per-minute / tokens-per-minute limits are respected
+# with adaptive backoff when the API answers 429. Every call, sync or async,
+# runs on the client's own event loop under one scheduler, so the limits and
+# the backoff state hold across calls and across the threads making them.
+
+import os
+import math
+import time
+import random
+import asyncio
+import threading
+from typing import List, Optional, Tuple
+
+import tiktoken
+
+from metrics import METRICS
+
+
+DEFAULT_MODEL = "text-embedding-ada-002"
+# Per-input limit of text-embedding-ada-002
+MAX_INPUT_TOKENS = 8191
+
+
+class RateLimiter:
+    """Token bucket refilled continuously at limit_per_minute / 60 per second."""
+
+    def __init__(self, limit_per_minute: Optional[float]):
+        self.limit = limit_per_minute
+        self.available = limit_per_minute or 0.0
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        if not self.limit:
+            return
+        # A single request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.limit)
+        async with self._lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) * 60 / self.limit)
+                self._refill()
+            self.available -= amount
+
+    def drain(self) -> None:
+        # The server says we're over the limit whatever our own bookkeeping says
+        self.available = 0.0
+        self.updated = time.monotonic()
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: Optional[float]):
+        super().__init__("rate limited")
+        self.retry_after = retry_after
+
+
+class AsyncEmbeddingClient:
+    """Drop-in replacement for OpenAIEmbeddings with concurrent, rate-limited requests."""
+
+    def __init__(self, api_key: Optional[str] = None, api_base: Optional[str] = None,
+                 model: str = DEFAULT_MODEL, max_concurrency: int = 8,
+                 max_batch_tokens: int = 50_000, max_batch_size: int = 2048,
+                 requests_per_minute: Optional[float] = 3_000,
+                 tokens_per_minute: Optional[float] = 1_000_000,
+                 max_retries: int = 8, timeout: float = 60):
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.api_base = (api_base or os.environ.get("OPENAI_API_BASE")
+                         or "https://api.openai.com/v1").rstrip("/")
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._encoding = None
+        self._scheduler = None
+        # Event loop thread all requests run on, started by the first call
+        self._loop = None
+        self._thread = None
+        self._loop_lock = threading.Lock()
+        # Counters, cumulative over the client's lifetime
+        self.requests = 0
+        self.retries = 0
+        self.texts = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def encoding(self):
+        # Loaded on first use, tiktoken may need to download the BPE file
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    def make_batches(self, texts: List[str], counts: Optional[List[int]] = None) -> List[Tuple[List[int], int]]:
+        """Pack text indices into (indices, token count) batches under max_batch_tokens and max_batch_size.
+
+        A call is spread over up to max_concurrency requests, so an indexer
+        batch that fits one request still uses the whole concurrency window.
+        counts are the token counts of texts, if already known.
+        """
+        batch_size = min(self.max_batch_size, math.ceil(len(texts) / self.max_concurrency))
+        if counts is None:
+            counts = [self.count_tokens(text) for text in texts]
+        batches = []
+        batch, batch_tokens = [], 0
+        for i, tokens in enumerate(counts):
+            tokens = min(tokens, MAX_INPUT_TOKENS)
+            if batch and (batch_tokens + tokens > self.max_batch_tokens
+                          or len(batch) >= batch_size):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    async def _post(self, session, inputs: List[str]) -> List[List[float]]:
+        async with session.post(
+            f"{self.api_base}/embeddings",
+            json={"model": self.model, "input": inputs},
+            headers={"Authorization": f"Bearer {self.api_key}"},
+        ) as response:
+            if response.status == 429:
+                retry_after = response.headers.get("Retry-After")
+                raise RateLimitError(float(retry_after) if retry_after else None)
+            response.raise_for_status()
+            body = await response.json()
+        data = sorted(body["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    async def _embed_batch(self, session, scheduler, inputs: List[str], tokens: int):
+        import aiohttp
+        for attempt in range(self.max_retries + 1):
+            await scheduler.acquire(tokens)
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                vectors = await self._post(session, inputs)
+                outcome = "ok"
+            except RateLimitError as e:
+                outcome, error = "throttled", e
+            except aiohttp.ClientResponseError as e:
+                if 400 <= e.status < 500 and e.status != 408:
+                    # A bad request fails the same way every time
+                    METRICS.count("embedding_errors")
+                    raise
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                # Whatever happened, cancellation and unexpected bodies included, the slot is given back
+                scheduler.release(outcome)
+            if outcome == "ok":
+                self.requests += 1
+                METRICS.observe_stage("embedding_request", time.perf_counter() - started)
+                METRICS.observe("embedding_batch_texts", len(inputs))
+                METRICS.observe("embedding_batch_tokens", tokens)
+                METRICS.count("embedding_requests")
+                METRICS.count("embedding_texts", len(inputs))
+                METRICS.count("embedding_tokens", tokens)
+                return vectors
+            METRICS.count("embedding_throttled" if outcome == "throttled" else "embedding_errors")
+            if attempt == self.max_retries:
+                raise error
+            self.retries += 1
+            METRICS.count("embedding_retries")
+            delay = getattr(error, "retry_after", None) or min(60, 2 ** attempt)
+            await asyncio.sleep(delay * (1 + random.random() * 0.25))
+
+    @property
+    def scheduler(self) -> "_Scheduler":
+        # One concurrency window and one pair of RPM/TPM buckets for the client's lifetime
+        if self._scheduler is None:
+            self._scheduler = _Scheduler(self.max_concurrency, self.requests_per_minute, self.tokens_per_minute)
+        return self._scheduler
+
+    def _client_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="embedding-client",
+                                                daemon=True)
+                self._thread.start()
+        return self._loop
+
+    async def _embed(self, texts: List[str]) -> List[List[float]]:
+        # Runs on the client's loop, the scheduler's locks belong to it
+        # OpenAI recommends replacing newlines, as OpenAIEmbeddings does
+        texts = [text.replace("\n", " ") for text in texts]
+        counts = [self.count_tokens(text) for text in texts]
+        # The API rejects longer inputs outright, cut them to the limit
+        texts = [self.truncate(text, MAX_INPUT_TOKENS) if count > MAX_INPUT_TOKENS else text
+                 for text, count in zip(texts, counts)]
+        batches = self.make_batches(texts, counts)
+        # aiohttp takes a quarter second to import, queries answered from the cache never need it
+        import aiohttp
+        scheduler = self.scheduler
+        results = [None] * len(texts)
+        started = time.perf_counter()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async def run(batch, tokens):
+                vectors = await self._embed_batch(session, scheduler, [texts[i] for i in batch], tokens)
+                for i, vector in zip(batch, vectors):
+                    results[i] = vector
+
+            await asyncio.gather(*(run(batch, tokens) for batch, tokens in batches))
+        self.busy_seconds += time.perf_counter() - started
+        self.texts += len(texts)
+        self.tokens += sum(tokens for _, tokens in batches)
+        return results
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        future = asyncio.run_coroutine_threadsafe(self._embed(texts), self._client_loop())
+        return await asyncio.wrap_future(future)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return asyncio.run_coroutine_threadsafe(self._embed(texts), self._client_loop()).result()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> dict:
+        seconds = self.busy_seconds
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "texts": self.texts,
+            "tokens": self.tokens,
+            "seconds": round(self.busy_seconds, 3),
+            "texts_per_second": round(self.texts / seconds, 1) if seconds else 0.0,
+            "tokens_per_second": round(self.tokens / seconds, 1) if seconds else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._loop_lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop, self._thread, self._scheduler = None, None, None
+
+
+class _Scheduler:
+    """Concurrency window plus RPM/TPM buckets, shrinking the window on 429s (AIMD)."""
+
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.window = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.requests = RateLimiter(requests_per_minute)
+        self.tokens = RateLimiter(tokens_per_minute)
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, tokens: int) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+        try:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(tokens)
+        except BaseException:
+            # Cancelled while waiting for budget
+            self.release("error")
+            raise
+
+    def release(self, outcome: str) -> None:
+        """Give back a slot; outcome is "ok", "throttled" (a 429) or "error"."""
+        self.in_flight -= 1
+        if outcome == "throttled":
+            # Multiplicative decrease, and stop spending budget we don't have
+            self.window = max(1, self.window // 2)
+            self.successes = 0
+            self.requests.drain()
+            self.tokens.drain()
+        elif outcome == "ok":
+            # Additive increase once a full window succeeded
+            self.successes += 1
+            if self.successes >= self.window and self.window < self.max_concurrency:
+                self.window += 1
+                self.successes = 0
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+
+def openai_embeddings(concurrency: int = 0, requests_per_minute=None, tokens_per_minute=None):
+    """OpenAIEmbeddings, or an AsyncEmbeddingClient when concurrency > 0."""
+    if concurrency > 0:
+        return AsyncEmbeddingClient(max_concurrency=concurrency,
+                                    requests_per_minute=requests_per_minute,
+                                    tokens_per_minute=tokens_per_minute)
+    from langchain.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings()
+
+
+def report_throughput(embeddings) -> None:
+    """Print the throughput counters of an AsyncEmbeddingClient, possibly behind a cache."""
+    client = getattr(embeddings, "embeddings", embeddings)
+    if isinstance(client, AsyncEmbeddingClient):
+        print(f"Embedding throughput: {client.stats()}")
@@ -0,0 +1,385 @@
+# Indexing and query engine over the asynchronous backends of backends.py.
+# Files are loaded and split like in the indexers, then every batch of chunks
+# is embedded once and upserted into each selected backend. The next batch is
+# read in a thread while the current one is embedded, and each backend has
+# its own writer with a bounded queue: embedding runs ahead of the writes, the
+# writes to different stores overlap, and a slow store only holds back its
+# own queue. Each backend's writer deletes a file's old chunks just before it
+# writes the file's first new batch, so re-runs don't duplicate rows and the
+# other files stay searchable throughout; with --incremental the manifest
+# limits a run to new, changed and removed files.
+
+import sys
+import json
+import asyncio
+import argparse
+from functools import partial
+from itertools import chain, groupby, islice
+from typing import Dict, Iterable, List, Optional
+
+from backends import BACKENDS, Backend, make_backend
+from loaders import load_documents, split_documents, clone_from_github, list_directory_files, list_repo_files
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import openai_embeddings, report_throughput
+from query_cache import bump_collection_version
+from manifest import Manifest, default_manifest_path, file_hash
+from pipeline import iter_file_chunks
+from token_splitter import ChunkHistogram
+from dedupe import ChunkDeduplicator
+from metrics import METRICS, add_arguments as add_metrics_arguments, instrumented
+
+
+_DONE = object()
+
+
+async def aembed(embeddings, texts: List[str]) -> List[List[float]]:
+    # The aiohttp client (cached or not) embeds asynchronously, blocking clients like langchain in a thread
+    if hasattr(embeddings, "aembed_documents"):
+        return await embeddings.aembed_documents(texts)
+    return await asyncio.to_thread(embeddings.embed_documents, texts)
+
+
+def chunk_positions(batch: List, offsets: Dict[str, int]):
+    # (source, offset) of each chunk, counting the chunks of every file in stream order
+    positions = []
+    for chunk in batch:
+        source = chunk.metadata.get("source")
+        offset = offsets.get(source, 0)
+        offsets[source] = offset + 1
+        positions.append((source, offset))
+    return positions
+
+
+async def _writer(backend: Backend, pending: asyncio.Queue, errors: list, replace: bool, written: list):
+    # written lists the files this writer has started, in order
+    while True:
+        item = await pending.get()
+        if item is _DONE:
+            return
+        if errors:
+            # Drain the queue so the producer never blocks forever
+            continue
+        batch, vectors, positions = item
+        started = set(written)
+        new = list(dict.fromkeys(source for source, _ in positions if source not in started))
+        try:
+            if replace and new:
+                with METRICS.timer(f"delete_{backend.name}"):
+                    await backend.delete_by_source(new)
+            written.extend(new)
+            with METRICS.timer(f"upsert_{backend.name}"):
+                await backend.upsert(batch, vectors, positions)
+        except Exception as e:
+            errors.append(e)
+
+
+async def aindex_chunks(chunks: Iterable, embeddings, backends: List[Backend], batch_size: int = 64,
+                        max_pending: int = 2, replace: bool = False, written: Optional[List[list]] = None) -> int:
+    """Embed chunks in batches and upsert every batch into all backends; returns the number of chunks.
+
+    Each backend's writer holds at most max_pending batches; embedding blocks
+    when the slowest backend falls that far behind. With replace, a file's
+    earlier chunks are deleted from a backend right before its first batch is
+    written there. written, if given, gets one list per backend of the files
+    whose chunks were (being) written, in order.
+    """
+    chunks = iter(chunks)
+    queues = [asyncio.Queue(maxsize=max_pending) for _ in backends]
+    errors = []
+    if written is None:
+        written = []
+    written[:] = [[] for _ in backends]
+    writers = [asyncio.create_task(_writer(backend, pending, errors, replace, files))
+               for backend, pending, files in zip(backends, queues, written)]
+    read = lambda: list(islice(chunks, batch_size))
+    offsets = {}
+    count = 0
+    next_batch = asyncio.ensure_future(asyncio.to_thread(read))
+    try:
+        while True:
+            batch = await next_batch
+            if not batch or errors:
+                break
+            # Loading and splitting the next batch overlaps with embedding this one
+            next_batch = asyncio.ensure_future(asyncio.to_thread(read))
+            with METRICS.timer("embed_batch"):
+                vectors = await aembed(embeddings, [chunk.page_content for chunk in batch])
+            positions = chunk_positions(batch, offsets)
+            # Time blocked here means a backend is the bottleneck
+            with METRICS.timer("wait_for_writer"):
+                for pending in queues:
+                    await pending.put((batch, vectors, positions))
+            METRICS.observe("write_batch_size", len(batch))
+            count += len(batch)
+    finally:
+        # The reader thread can't be cancelled, let it finish before the chunks go away
+        await asyncio.gather(next_batch, return_exceptions=True)
+        for pending in queues:
+            await pending.put(_DONE)
+        await asyncio.gather(*writers)
+    if errors:
+        raise errors[0]
+    return count
+
+
+async def adelete_sources(backends: List[Backend], sources: List[str], batch_size: int = 256) -> Dict[str, int]:
+    """Delete the chunks of sources from every backend concurrently; returns the count per backend."""
+    deleted = {backend.name: 0 for backend in backends}
+
+    async def delete(backend):
+        for start in range(0, len(sources), batch_size):
+            with METRICS.timer(f"delete_{backend.name}"):
+                deleted[backend.name] += await backend.delete_by_source(sources[start:start + batch_size])
+
+    await asyncio.gather(*(delete(backend) for backend in backends))
+    return deleted
+
+
+async def amulti_search(backends: List[Backend], embeddings, questions: List[str], k: int = 4) -> Dict[str, List]:
+    """Top-k results per question from every backend, searched concurrently with one embedding call."""
+    with METRICS.timer("query_embed"):
+        vectors = await aembed(embeddings, questions)
+
+    async def search(backend):
+        with METRICS.timer(f"search_{backend.name}"):
+            return await backend.multi_search(vectors, k)
+
+    results = await asyncio.gather(*(search(backend) for backend in backends))
+    return {backend.name: result for backend, result in zip(backends, results)}
+
+
+def file_chunks(file_types: Dict[str, str], encoding, chunk_size, chunk_overlap, splitter, workers=1,
+                dedupe_threshold=None, histogram=None, max_length=None):
+    # file_types maps each path to its loader type; consecutive paths of one type share a stream
+    streams = []
+    for file_type, group in groupby(file_types.items(), key=lambda item: item[1]):
+        streams.append(iter_file_chunks(
+            [path for path, _ in group],
+            partial(load_documents, encoding=encoding, file_type=file_type),
+            partial(split_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                    splitter=splitter, file_type=file_type, max_length=max_length),
+            workers))
+    chunks = chain.from_iterable(streams)
+    if dedupe_threshold is not None:
+        # Chunks are deleted by source, so a duplicate may only be dropped within its own file
+        chunks = chain.from_iterable(ChunkDeduplicator(dedupe_threshold, all_sources=True).dedupe(same_file)
+                                     for _, same_file in groupby(chunks, key=lambda c: c.metadata.get("source")))
+    if histogram is not None:
+        chunks = histogram.observe_all(chunks)
+    return chunks
+
+
+async def aindex(backends: List[Backend], embeddings, collection_name, input_dir=None, github_url=None,
+                 encoding="utf8", file_type="text", chunk_size=1000, chunk_overlap=0, splitter="character",
+                 dedupe=False, dedupe_threshold=0.8, incremental=False, manifest_path=None, drop_existing=False,
+                 batch_size=64, max_pending=2, workers=1):
+    """Index input_dir and/or a GitHub repository into every backend in one pass."""
+    # Chunk sizes are only reported for the token splitter, which has a tokenizer loaded anyway
+    histogram = ChunkHistogram() if splitter == "token" else None
+    manifest = Manifest(manifest_path or default_manifest_path(collection_name))
+    incremental = incremental and manifest.exists and not drop_existing
+    if drop_existing:
+        # The dropped collections keep none of the files the manifest knows of
+        manifest.files = {}
+    await asyncio.gather(*(backend.open(drop_existing) for backend in backends))
+
+    commit = None
+    file_types = {}
+    if input_dir is not None:
+        file_types.update((path, file_type) for path in list_directory_files(input_dir))
+    if github_url is not None:
+        commit = await asyncio.to_thread(clone_from_github, github_url, collection_name, file_type)
+        # Repo files are read as plain text, like the indexers do
+        file_types.update((path, "text") for path in list_repo_files(file_type, collection_name))
+
+    if incremental:
+        changed, removed = manifest.plan(file_types)
+    else:
+        # Everything is written again; files the manifest knows of that are gone are removed
+        changed = [(path, None) for path in file_types]
+        removed = [path for path in manifest.files if path not in file_types] if not drop_existing else []
+    if removed:
+        deleted = await adelete_sources(backends, removed)
+        print(f"Deleted the chunks of {len(removed)} removed files: {deleted}")
+
+    # The token splitter keeps chunks within the smallest text field of the backends
+    limits = [backend.max_text_length for backend in backends if backend.max_text_length]
+    chunks = file_chunks({path: file_types[path] for path, _ in changed}, encoding, chunk_size, chunk_overlap,
+                         splitter, workers, dedupe_threshold if dedupe else None, histogram,
+                         min(limits) if limits else None)
+    written = []
+    completed = False
+    try:
+        # Files are replaced one at a time, a dropped collection has nothing to replace
+        count = await aindex_chunks(chunks, embeddings, backends, batch_size, max_pending,
+                                    replace=not drop_existing, written=written)
+        started = set().union(*written)
+        # Changed files without any chunk left still have to lose their old ones
+        empty = [path for path, _ in changed if path not in started]
+        if empty and not drop_existing:
+            await adelete_sources(backends, empty)
+        await asyncio.gather(*(backend.flush() for backend in backends))
+        completed = True
+    finally:
+        # Only files written to every backend are recorded; a file some backend
+        # started but may not have finished loses its entry, so it is redone
+        started = set().union(*written)
+        if completed:
+            finished = {path for path, _ in changed}
+        else:
+            finished = set.intersection(*(set(files[:-1]) for files in written)) if written else set()
+        for path in removed:
+            manifest.forget(path)
+        for path, content_hash in changed:
+            if path in finished:
+                # Chunks are found by source, no ids to keep
+                manifest.record(path, content_hash or file_hash(path), [])
+            elif path in started:
+                manifest.forget(path)
+        if completed:
+            manifest.commit = commit
+        manifest.save()
+    print(f"Indexed {count} chunks from {len(changed)} files into {', '.join(b.name for b in backends)}.")
+    if histogram is not None:
+        print(histogram.report())
+    return count
+
+
+async def _run(backends, coroutine):
+    try:
+        return await coroutine
+    finally:
+        await asyncio.gather(*(backend.close() for backend in backends))
+
+
+def main(input_dir, collection_name, backends=("milvus",), github_url=None, encoding="utf8", file_type="text",
+         chunk_size=1000, chunk_overlap=0, splitter="character", dedupe=False, dedupe_threshold=0.8,
+         incremental=False, manifest_path=None, drop_existing=False, batch_size=64, max_pending=2, workers=1,
+         cache_dir=None, embedding_concurrency=8, requests_per_minute=3000, tokens_per_minute=1000000,
+         host="127.0.0.1", port="19530", redis_url="redis://127.0.0.1:6379", supabase_url=None,
+         supabase_service_key=None, query_name="match_documents", local_dir=None, version_store=None,
+         embeddings=None):
+    if embeddings is None:
+        embeddings = cached_embeddings(
+            openai_embeddings(embedding_concurrency, requests_per_minute, tokens_per_minute), cache_dir)
+    backends = [make_backend(name, collection_name, host, port, redis_url, supabase_url, supabase_service_key,
+                             query_name, local_dir) for name in backends]
+    count = asyncio.run(_run(backends, aindex(
+        backends, embeddings, collection_name, input_dir, github_url, encoding, file_type, chunk_size,
+        chunk_overlap, splitter, dedupe, dedupe_threshold, incremental, manifest_path, drop_existing,
+        batch_size, max_pending, workers)))
+    bump_collection_version(collection_name, version_store)
+    report_cache(embeddings)
+    report_throughput(embeddings)
+    print("Done!")
+    return count
+
+
+def main_search(questions, collection_name, backends=("milvus",), k=4, cache_dir=None, host="127.0.0.1",
+                port="19530", redis_url="redis://127.0.0.1:6379", supabase_url=None, supabase_service_key=None,
+                query_name="match_documents", local_dir=None, ef=None, output=sys.stdout, embeddings=None):
+    if embeddings is None:
+        embeddings = cached_embeddings(openai_embeddings(1), cache_dir)
+    backends = [make_backend(name, collection_name, host, port, redis_url, supabase_url, supabase_service_key,
+                             query_name, local_dir, ef) for name in backends]
+
+    async def search():
+        await asyncio.gather(*(backend.open() for backend in backends))
+        return await amulti_search(backends, embeddings, questions, k)
+
+    results = asyncio.run(_run(backends, search()))
+    for i, question in enumerate(questions):
+        output.write(json.dumps({"question": question,
+                                 "results": {name: found[i] for name, found in results.items()}}, default=str) + "\n")
+    report_cache(embeddings, file=sys.stderr)
+    return results
+
+
+# python src/engine.py --input_dir docs --collection_name my_collection --backends milvus redis
+# python src/engine.py --question "How do I deploy?" --collection_name my_collection --backends milvus redis
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index documents into, or search, several vector stores at once.")
+    parser.add_argument('--backends', type=str, nargs='+', default=["milvus"], choices=BACKENDS,
+                        help='Vector stores to write to or search; every batch is embedded once for all of them.')
+    parser.add_argument('--collection_name', type=str, required=True,
+                        help='Name of the Milvus collection, Redis index, Supabase table or local store.')
+    parser.add_argument('--question', type=str, nargs='+', default=None,
+                        help='Search every backend for these questions instead of indexing.')
+    parser.add_argument('--k', type=int, default=4,
+                        help='Number of documents returned per question and backend.')
+    parser.add_argument('--input_dir', type=str, default=None,
+                        help='Path to the directory containing documents to be indexed.')
+    parser.add_argument('--github_url', type=str, default=None,
+                        help='URL of a GitHub repository to index, checked out under ./docs/<collection_name>.')
+    parser.add_argument('--encoding', type=str, default='utf8',
+                        help='Encoding of the input documents.')
+    parser.add_argument('--file_type', type=str, default="text", choices=["text", "markdown", "adoc"],
+                        help='Type of the input files.')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Size of the chunks to split documents into (in tokens with --splitter token).')
+    parser.add_argument('--chunk_overlap', type=int, default=0,
+                        help='Number of overlapping characters (tokens with --splitter token) between consecutive chunks.')
+    parser.add_argument('--splitter', type=str, default="character", choices=["character", "token"],
+                        help='Split on characters, or on tokens at heading, code block and paragraph boundaries.')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Drop duplicate and near-duplicate chunks within each file before embedding.')
+    parser.add_argument('--dedupe_threshold', type=float, default=0.8,
+                        help='Estimated Jaccard similarity of word shingles above which chunks are near duplicates.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-index new or changed files and delete the chunks of removed files.')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path of the manifest (default: .index_manifest/<collection_name>.json).')
+    parser.add_argument('--drop', action='store_true',
+                        help='Drop and recreate the collections first (empties the Supabase table).')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of chunks embedded and upserted per batch.')
+    parser.add_argument('--max_pending', type=int, default=2,
+                        help='Embedded batches each backend may fall behind before embedding waits.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to load and split documents.')
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache",
+                        help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+    parser.add_argument('--embedding_concurrency', type=int, default=8,
+                        help='Number of embedding requests kept in flight.')
+    parser.add_argument('--requests_per_minute', type=int, default=3000,
+                        help='Embedding requests per minute allowed.')
+    parser.add_argument('--tokens_per_minute', type=int, default=1000000,
+                        help='Embedding tokens per minute allowed.')
+    parser.add_argument('--host', type=str, default="127.0.0.1",
+                        help='Host address for the Milvus server.')
+    parser.add_argument('--port', type=str, default="19530",
+                        help='Port for the Milvus server.')
+    parser.add_argument('--redis_url', type=str, default="redis://127.0.0.1:6379",
+                        help='URL of the Redis Stack server.')
+    parser.add_argument('--supabase_url', type=str, default=None,
+                        help='URL of the Supabase project.')
+    parser.add_argument('--supabase_service_key', type=str, default=None,
+                        help='Service key of the Supabase project.')
+    parser.add_argument('--query_name', type=str, default="match_documents",
+                        help='Supabase function that matches documents by embedding.')
+    parser.add_argument('--local_dir', type=str, default=None,
+                        help='Directory of the local vector store (default: .local_index/<collection_name>).')
+    parser.add_argument('--ef', type=int, default=None,
+                        help='HNSW ef used when searching Milvus or the local store.')
+    parser.add_argument('--version_store', type=str, default=".collection_versions",
+                        help='Directory or redis:// URL where the collection version is bumped after indexing (invalidates query caches).')
+
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    # Search results go to stdout, so the reports go to stderr
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode,
+                      file=sys.stderr if args.question else None):
+        if args.question:
+            main_search(args.question, args.collection_name, args.backends, args.k, args.cache_dir or None,
+                        args.host, args.port, args.redis_url, args.supabase_url, args.supabase_service_key,
+                        args.query_name, args.local_dir, args.ef)
+        else:
+            main(args.input_dir, args.collection_name, args.backends, args.github_url, args.encoding,
+                 args.file_type, args.chunk_size, args.chunk_overlap, args.splitter, args.dedupe,
+                 args.dedupe_threshold, args.incremental, args.manifest, args.drop, args.batch_size,
+                 args.max_pending, args.workers, args.cache_dir or None, args.embedding_concurrency,
+                 args.requests_per_minute, args.tokens_per_minute, args.host, args.port, args.redis_url,
+                 args.supabase_url, args.supabase_service_key, args.query_name, args.local_dir,
+                 args.version_store)
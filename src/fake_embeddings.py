@@ -0,0 +1,49 @@
+# Deterministic local stand-in for OpenAIEmbeddings.
+# The same text always maps to the same unit vector, so indexes, caches and
+# benchmarks can run without network access or an API key.
+
+import re
+import hashlib
+from typing import List
+
+import numpy as np
+
+
+class FakeEmbeddings:
+    def __init__(self, dim: int = 1536, model: str = "fake-embedding"):
+        self.dim = dim
+        self.model = model
+
+    def embed_vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_vector(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_vector(text).tolist()
+
+
+class BagOfWordsEmbeddings(FakeEmbeddings):
+    """Sum of per-word random vectors: texts sharing words end up close together,
+    which gives benchmarks a neighbourhood structure closer to real embeddings."""
+
+    def __init__(self, dim: int = 1536, model: str = "fake-bow-embedding"):
+        super().__init__(dim, model)
+        self._words = {}
+
+    def _word_vector(self, word):
+        vector = self._words.get(word)
+        if vector is None:
+            vector = super().embed_vector(word)
+            self._words[word] = vector
+        return vector
+
+    def embed_vector(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return super().embed_vector(text)
+        vector = np.sum([self._word_vector(word) for word in words], axis=0)
+        return vector / np.linalg.norm(vector)
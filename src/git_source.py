@@ -0,0 +1,53 @@
+# Shallow, blobless, sparse checkouts of GitHub sources.
+# Only the tip commit is fetched, without file contents (--filter=blob:none),
+# and only files of the indexed type are checked out, so git downloads just
+# those blobs. Later runs fetch the new tip into the same checkout, and the
+# files changed since the last indexed commit are found by diffing trees,
+# which blobless clones have locally.
+
+import os
+from typing import List, Optional
+
+from git import Repo, GitCommandError
+
+
+def sparse_patterns(file_type: str) -> List[str]:
+    # Non-cone patterns without a slash match at any depth
+    return [f"*.{file_type}"]
+
+
+def sync_repo(github_url: str, path: str, file_type: str, branch: str = "main") -> str:
+    """Clone github_url into path, or update an existing checkout; returns the checked out commit."""
+    patterns = sparse_patterns(file_type)
+    if not os.path.exists(path):
+        print(f"Cloning {github_url}...")
+        Repo.clone_from(github_url, to_path=path, branch=branch, depth=1,
+                        filter="blob:none", sparse=True, no_checkout=True)
+        repo = Repo(path)
+        repo.git.sparse_checkout("set", "--no-cone", *patterns)
+        repo.git.checkout(branch)
+        return repo.head.commit.hexsha
+
+    if not os.path.exists(os.path.join(path, ".git")):
+        raise ValueError(f"{path} exists and is not a git checkout")
+    repo = Repo(path)
+    print(f"Fetching {github_url}...")
+    # Patterns are set again in case file_type changed, or for a full clone of an older version
+    repo.git.sparse_checkout("set", "--no-cone", *patterns)
+    repo.git.fetch(github_url, branch, depth=1, filter="blob:none")
+    repo.git.reset("--hard", "FETCH_HEAD")
+    return repo.head.commit.hexsha
+
+
+def changed_files(path: str, since_commit: Optional[str], file_type: str) -> Optional[List[str]]:
+    """Files of file_type that differ between since_commit and HEAD, None if that can't be told."""
+    if not since_commit:
+        return None
+    repo = Repo(path)
+    try:
+        names = repo.git.diff("--name-only", "--no-renames", since_commit, "HEAD",
+                              "--", *sparse_patterns(file_type))
+    except GitCommandError:
+        # The commit is no longer in the shallow history
+        return None
+    return [os.path.join(path, name) for name in names.splitlines()]
@@ -0,0 +1,185 @@
+# Small HNSW (Hierarchical Navigable Small World) graph over a float32 matrix.
+# Same knobs as the Milvus index in create_milvus_collection: M neighbours per
+# node, efConstruction while building and ef while searching. Distances are
+# squared L2, matching the "L2" metric used there.
+
+import heapq
+import math
+import pickle
+import random
+from typing import List, Tuple
+
+import numpy as np
+
+
+class HNSWIndex:
+    def __init__(self, M: int = 8, ef_construction: int = 64, ef: int = 64, seed: int = 0):
+        self.M = M
+        self.max_M0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.level_mult = 1 / math.log(max(M, 2))
+        self.rng = random.Random(seed)
+        # One dict per layer: node -> list of neighbours
+        self.layers: List[dict] = []
+        self.entry_point = None
+        self.vectors = None
+        # Rows of vectors live in, with spare capacity so adding rows doesn't copy them all
+        self._buffer = None
+
+    def __len__(self):
+        return len(self.layers[0]) if self.layers else 0
+
+    @property
+    def rows(self) -> int:
+        """Rows of the vector matrix covered, nodes left out of the graph included."""
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def tombstones(self, deleted) -> int:
+        """How many of the deleted rows are still nodes of the graph."""
+        graph = self.layers[0] if self.layers else {}
+        return sum(1 for node in deleted if node in graph)
+
+    def nbytes(self) -> int:
+        # Adjacency lists at 8 bytes per link, vectors are shared with the store
+        return sum(len(links) for graph in self.layers for links in graph.values()) * 8
+
+    def _distances(self, query, nodes):
+        diff = self.vectors[nodes] - query
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def _search_layer(self, query, entry_points, ef, layer):
+        graph = self.layers[layer]
+        visited = set(entry_points)
+        dists = self._distances(query, list(entry_points))
+        candidates = [(d, n) for d, n in zip(dists.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        # Max-heap of the best ef results so far
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+            neighbours = [n for n in graph.get(node, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for d, n in zip(self._distances(query, neighbours).tolist(), neighbours):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _select_neighbours(self, candidates, M):
+        # Simple heuristic: keep the M closest
+        return [n for _, n in candidates[:M]]
+
+    def _random_level(self):
+        return int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        # Grow the buffer geometrically, copying the current rows once per doubling
+        if self._buffer is not None and len(self._buffer) >= rows:
+            return
+        buffer = np.empty((max(rows, 2 * self.rows, 1024), dim), dtype=np.float32)
+        if self.vectors is not None:
+            buffer[:self.rows] = self.vectors
+        self._buffer = buffer
+
+    def add(self, vectors: np.ndarray) -> None:
+        """Insert rows of vectors; ids continue from the current number of rows."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        start = self.rows
+        self._reserve(start + len(vectors), vectors.shape[1])
+        self._buffer[start:start + len(vectors)] = vectors
+        self.vectors = self._buffer[:start + len(vectors)]
+        for node in range(start, start + len(vectors)):
+            self._insert(node)
+
+    def build(self, vectors: np.ndarray, skip=None) -> "HNSWIndex":
+        """Build the graph over the rows of vectors, leaving out the rows in skip."""
+        self.layers, self.entry_point, self._buffer = [], None, None
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        for node in range(len(self.vectors)):
+            if not skip or node not in skip:
+                self._insert(node)
+        return self
+
+    def _insert(self, node):
+        level = self._random_level()
+        while len(self.layers) <= level:
+            self.layers.append({})
+        for layer in range(level + 1):
+            self.layers[layer][node] = []
+        if self.entry_point is None:
+            self.entry_point = node
+            return
+
+        query = self.vectors[node]
+        entry = [self.entry_point]
+        top = self._level_of(self.entry_point)
+        # Greedy descent through the layers above the node's level
+        for layer in range(top, level, -1):
+            entry = [self._search_layer(query, entry, 1, layer)[0][1]]
+        for layer in range(min(level, top), -1, -1):
+            candidates = self._search_layer(query, entry, self.ef_construction, layer)
+            max_M = self.max_M0 if layer == 0 else self.M
+            neighbours = self._select_neighbours(candidates, self.M)
+            graph = self.layers[layer]
+            graph[node] = neighbours
+            for neighbour in neighbours:
+                links = graph[neighbour]
+                links.append(node)
+                if len(links) > max_M:
+                    dists = self._distances(self.vectors[neighbour], links)
+                    graph[neighbour] = [links[i] for i in np.argsort(dists)[:max_M]]
+            entry = [n for _, n in candidates]
+        if level > top:
+            self.entry_point = node
+
+    def _level_of(self, node):
+        level = 0
+        while level + 1 < len(self.layers) and node in self.layers[level + 1]:
+            level += 1
+        return level
+
+    def search(self, query: np.ndarray, k: int, ef: int = None, deleted=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (ids, squared L2 distances) of the approximate k nearest rows not in deleted."""
+        if self.entry_point is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        entry = [self.entry_point]
+        for layer in range(len(self.layers) - 1, 0, -1):
+            entry = [self._search_layer(query, entry, 1, layer)[0][1]]
+        ef = max(ef or self.ef, k)
+        while True:
+            found = self._search_layer(query, entry, ef, 0)
+            if deleted:
+                found = [(d, n) for d, n in found if n not in deleted]
+            # Widen the search only while deleted nodes crowd out live ones
+            if len(found) >= k or ef >= len(self):
+                break
+            ef *= 2
+        found = found[:k]
+        return (np.array([n for _, n in found], dtype=np.int64),
+                np.array([d for d, _ in found], dtype=np.float32))
+
+    def save(self, path: str) -> None:
+        # Vectors are not saved, the owning store keeps them
+        with open(path, "wb") as f:
+            pickle.dump({"M": self.M, "ef_construction": self.ef_construction, "ef": self.ef,
+                         "layers": self.layers, "entry_point": self.entry_point, "rows": self.rows}, f)
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray) -> "HNSWIndex":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        index = cls(state["M"], state["ef_construction"], state["ef"])
+        index.layers = state["layers"]
+        index.entry_point = state["entry_point"]
+        # Graphs saved before rows were tracked cover every row they have a node for
+        index.vectors = vectors[:state.get("rows", len(index))]
+        return index
@@ -1,121 +1,89 @@
 # Langchain wraps the Milvus client and provides a few convenience methods for working with documents.
 # It can split documents into chunks, embed them, and store them in Milvus.
 
-import os
+import json
 import argparse
-
-from langchain.document_loaders import TextLoader, GitLoader
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Milvus
-from langchain.document_loaders import UnstructuredMarkdownLoader, DirectoryLoader
-from langchain.document_loaders.text import TextLoader
-
-
-from pymilvus import FieldSchema, DataType, CollectionSchema, Collection, connections, utility
-from git import Repo
-
-
-text_field = "text"
-primary_field = "pk"
-vector_field = "vector"
-
-
-def load_documents(file_path, encoding='utf8', file_type='text'):
-    if file_type == 'markdown':
-        loader = UnstructuredMarkdownLoader(file_path)
-    else:
-        loader = TextLoader(file_path, encoding=encoding)
-    return loader.load()
-
-
-def load_documents_from_github(github_url, file_type, collection_name):
-    repoPath = "./docs/" + collection_name
-    githubUrl = github_url
-    # check if the repo exists
-    if os.path.exists(repoPath):
-        print("Repo already exists")
-        githubUrl = None
-
-    loader = GitLoader(
-        clone_url=githubUrl,
-        repo_path=repoPath,
-        branch="main",
-        file_filter=lambda file_path: file_path.endswith(
-            ".{}".format(file_type)),
-    )
-
-    return loader.load()
-
-
-def load_documents_from_directory(file_type, collection_name):
-    path = "./docs/" + collection_name
-    loader = DirectoryLoader(
-        path=path,
-        glob="**/*.{}".format(file_type),
-        loader_cls=TextLoader
-    )
-
-    return loader.load()
-
-
-def clone_from_github(github_url, collection_name):
-    path = "./docs/" + collection_name
-    if os.path.exists(path):
-        print("Repo already exists")
+from functools import partial
+
+# langchain, pymilvus, unstructured and git are imported where they are used,
+# so only the loaders and the backend a run selects are paid for at startup
+import loaders
+from loaders import load_documents, clone_from_github, list_directory_files, list_repo_files, repo_path
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import openai_embeddings, report_throughput
+from query_cache import bump_collection_version
+from manifest import Manifest, default_manifest_path, sync_files
+from pipeline import iter_file_chunks, index_stream
+from token_splitter import ChunkHistogram
+from dedupe import ChunkDeduplicator, default_sources_path
+from lexical import BM25Writer, default_lexical_dir
+from local_store import LocalVectorStore, default_local_dir
+from bulk_load import MilvusBulkWriter
+from checkpoint import Checkpoint, default_checkpoint_path
+from metrics import METRICS, add_arguments as add_metrics_arguments, instrumented
+from milvus_schema import (text_field, primary_field, vector_field, text_max_length, milvus_sources,
+                           milvus_index_params, open_milvus_collection)
+
+
+def split_documents(documents, chunk_size=1000, chunk_overlap=0, splitter="character", file_type="text"):
+    # The token splitter keeps chunks within the Milvus text field
+    return loaders.split_documents(documents, chunk_size, chunk_overlap, splitter, file_type, text_max_length)
+
+
+def milvus_document(doc):
+    # Milvus needs a value for every schema field
+    from langchain.docstore.document import Document
+    return Document(page_content=doc.page_content, metadata={**doc.metadata, "sources": milvus_sources(doc.metadata)})
+
+
+def index_documents(milvus, docs, lexical=None):
+    # Index the documents using the provided Milvus (or local) vector store
+    if not isinstance(milvus, LocalVectorStore):
+        docs = [milvus_document(doc) for doc in docs]
+    pks = milvus.add_documents(docs)
+    if lexical is not None:
+        # Under the same ids, so lexical hits can be fetched from the vector store
+        lexical.add_documents(pks, docs)
+    return pks
+
+
+def delete_chunks(milvus, collection_name, pks, lexical=None):
+    # Delete chunks by primary key, e.g. the chunks of a changed or removed file
+    if lexical is not None:
+        lexical.remove(pks)
+    if isinstance(milvus, LocalVectorStore):
+        milvus.delete(pks)
         return
+    from pymilvus import Collection
+    collection = Collection(collection_name)
+    collection.delete(f"{primary_field} in {list(pks)}")
+
+
+def find_chunks(milvus, collection_name, sources):
+    # Primary keys of the stored chunks of the given files
+    if isinstance(milvus, LocalVectorStore):
+        return [pk for pk, record in enumerate(milvus.records)
+                if pk not in milvus.deleted and record["metadata"].get("source") in sources]
+    from pymilvus import Collection
+    collection = Collection(collection_name)
+    if isinstance(milvus, MilvusBulkWriter) and not collection.has_index():
+        # A bulk load that died before its index was built, Milvus can't load it without one
+        collection.create_index(vector_field, milvus.index_params)
+    collection.load()
+    rows = collection.query(f"source in {json.dumps(list(sources))}", output_fields=[primary_field])
+    return [row[primary_field] for row in rows]
+
+
+def create_milvus_collection(embeddings, collection_name, host, port, drop_existing=True,
+                             storage="float32", nlist=1024, pq_m=96, bulk=False):
+    from langchain.vectorstores import Milvus
 
-    repo = Repo.clone_from(
-        github_url, to_path=path
-    )
-    repo.git.checkout("main")
-
-
-def split_documents(documents, chunk_size=1000, chunk_overlap=0):
-    text_splitter = CharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    return text_splitter.split_documents(documents)
-
-
-def index_documents(milvus, docs):
-    # Index the documents using the provided Milvus instance
-    milvus.add_documents(docs)
-
-
-def create_milvus_collection(embeddings, collection_name, host, port):
-    # Connect to Milvus instance
-    if not connections.has_connection("default"):
-        connections.connect(host=host, port=port)
-    utility.drop_collection(collection_name)
-    # Create the collection in Milvus
-    fields = []
-    # Create the metadata field
-    fields.append(
-        FieldSchema('source', DataType.VARCHAR, max_length=200)
-    )
-    # Create the text field
-    fields.append(
-        FieldSchema(text_field, DataType.VARCHAR, max_length=2500)
-    )
-    # Create the primary key field
-    fields.append(
-        FieldSchema(primary_field, DataType.INT64,
-                    is_primary=True, auto_id=True)
-    )
-    # Create the vector field
-    fields.append(FieldSchema(vector_field, DataType.FLOAT_VECTOR, dim=1536))
-    # Create the schema for the collection
-    schema = CollectionSchema(fields)
-    # Create the collection
-    collection = Collection(collection_name, schema)
     # Index parameters for the collection
-    index = {
-        "index_type": "HNSW",
-        "metric_type": "L2",
-        "params": {"M": 8, "efConstruction": 64},
-    }
-    # Create the index
-    collection.create_index(vector_field, index)
+    index = milvus_index_params(storage, nlist, pq_m)
+    # The index of a bulk load is built once all rows are in, see MilvusBulkWriter.finish
+    collection = open_milvus_collection(collection_name, host, port, drop_existing, index, build_index=not bulk)
+    if bulk:
+        return MilvusBulkWriter(collection, embeddings, text_field, vector_field, index)
 
     # Create the VectorStore
     milvus = Milvus(
@@ -128,32 +96,191 @@ def create_milvus_collection(embeddings, collection_name, host, port):
     return milvus
 
 
-def main(input_dir, encoding, chunk_size, chunk_overlap, host, port, file_type, collection_name, github_url):
-    embeddings = OpenAIEmbeddings()
-    milvus = create_milvus_collection(embeddings, collection_name, host, port)
+def create_local_store(embeddings, collection_name, local_dir=None, drop_existing=True,
+                       index_type="HNSW", M=8, ef_construction=64, storage="float32", pq_m=96, rerank=0):
+    # Embedded store in a local directory, with the same HNSW parameters as the Milvus index
+    return LocalVectorStore.create(
+        local_dir or default_local_dir(collection_name), embeddings, drop_existing=drop_existing,
+        index_type=index_type, M=M, ef_construction=ef_construction, storage=storage, pq_m=pq_m, rerank=rerank)
+
+
+def index_incrementally(milvus, manifest, file_types, encoding, chunk_size, chunk_overlap, collection_name,
+                        splitter="character", histogram=None, dedupe_threshold=None, lexical=None,
+                        candidates=None):
+    # file_types maps each file path to the loader type used for it
+    def index_file(file_path):
+        with METRICS.timer("load"):
+            documents = load_documents(file_path, encoding, file_types[file_path])
+        with METRICS.timer("split"):
+            docs = split_documents(documents, chunk_size, chunk_overlap, splitter, file_types[file_path])
+        if dedupe_threshold is not None:
+            # The manifest tracks chunks per file, so duplicates are only dropped within a file
+            docs = ChunkDeduplicator(dedupe_threshold, all_sources=True).dedupe(docs)
+        if histogram is not None:
+            docs = list(histogram.observe_all(docs))
+        return index_documents(milvus, docs, lexical) if docs else []
+
+    return sync_files(manifest, file_types, index_file,
+                      lambda pks: delete_chunks(milvus, collection_name, pks, lexical), candidates,
+                      lambda sources: find_chunks(milvus, collection_name, sources))
+
+
+def index_files(milvus, paths, encoding, file_type, chunk_size, chunk_overlap, batch_size, workers=1,
+                splitter="character", histogram=None, deduplicator=None, lexical=None, checkpoint=None):
+    # Stream the files through load -> split -> embed -> insert in bounded batches
+    if checkpoint is not None and deduplicator is None and lexical is None:
+        # Nothing has to be rebuilt from the chunks of completed files, don't read them again
+        paths = checkpoint.remaining(paths)
+    chunks = iter_file_chunks(
+        paths,
+        partial(load_documents, encoding=encoding, file_type=file_type),
+        partial(split_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                splitter=splitter, file_type=file_type),
+        workers)
+    if deduplicator is not None:
+        chunks = deduplicator.dedupe(chunks)
+    if checkpoint is None:
+        write = lambda batch: index_documents(milvus, batch, lexical)
+    else:
+        # Committed chunks are skipped after deduplication, which has to see them all again;
+        # the lexical index of a resumed run is rebuilt from them under their stored ids
+        on_skip = (lambda chunk, pk: lexical.add([pk], [chunk.page_content])) if lexical is not None else None
+        chunks = checkpoint.skip_committed(chunks, on_skip)
+        write = checkpoint.writer(lambda batch, positions: index_documents(milvus, batch, lexical))
+    if histogram is not None:
+        chunks = histogram.observe_all(chunks)
+    return index_stream(chunks, write, batch_size)
+
+
+def main(input_dir, encoding, chunk_size, chunk_overlap, host, port, file_type, collection_name, github_url, cache_dir=None,
+         incremental=False, manifest_path=None, batch_size=64,
+         embedding_concurrency=0, requests_per_minute=3000, tokens_per_minute=1000000,
+         workers=1, backend="milvus", local_dir=None, local_index_type=None, hnsw_m=8, hnsw_ef_construction=64, version_store=None,
+         splitter="character", dedupe=False, dedupe_threshold=0.8, lexical_index=False, lexical_dir=None,
+         storage="float32", pq_m=96, rerank=0, nlist=1024, bulk=False, resume=False, checkpoint_path=None,
+         dedupe_all_sources=False, embeddings=None):
+    if resume and incremental:
+        raise ValueError("Incremental runs resume from their manifest, --resume is for full runs")
+    # Chunk sizes are only reported for the token splitter, which has a tokenizer loaded anyway
+    histogram = ChunkHistogram() if splitter == "token" else None
+    deduplicator = ChunkDeduplicator(dedupe_threshold, all_sources=dedupe_all_sources) if dedupe else None
+    if embeddings is None:
+        # Callers indexing several sources pass one client, see index_sources.py
+        embeddings = cached_embeddings(
+            openai_embeddings(embedding_concurrency, requests_per_minute, tokens_per_minute), cache_dir)
+    manifest = Manifest(manifest_path or default_manifest_path(collection_name))
+    # Anything that changes the chunks would make the checkpoint offsets meaningless
+    checkpoint = Checkpoint(checkpoint_path or default_checkpoint_path(collection_name), {
+        "backend": backend, "input_dir": input_dir, "github_url": github_url, "file_type": file_type,
+        "encoding": encoding, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "splitter": splitter,
+        "dedupe": dedupe, "dedupe_threshold": dedupe_threshold,
+    }, resume)
+    # Without a manifest we can't tell what is already stored, so rebuild
+    drop_existing = not (incremental and manifest.exists) and not checkpoint.resumed
+    if backend == "local":
+        # Compressed storage is searched by scanning its codes, not through HNSW
+        milvus = create_local_store(embeddings, collection_name, local_dir, drop_existing,
+                                    local_index_type or ("HNSW" if storage == "float32" else "FLAT"),
+                                    hnsw_m, hnsw_ef_construction, storage, pq_m, rerank)
+    else:
+        milvus = create_milvus_collection(embeddings, collection_name, host, port, drop_existing,
+                                          storage, nlist, pq_m, bulk)
+    commit = None
+    if github_url is not None and not checkpoint.resumed:
+        # A resumed run keeps the checkout its checkpoint offsets refer to
+        commit = clone_from_github(github_url, collection_name, file_type)
+    lexical = None
+    if lexical_index:
+        lexical_dir = lexical_dir or default_lexical_dir(collection_name)
+        # Incremental runs update the saved index, full runs start a new one (a resumed
+        # run gets the chunks it already indexed back from the checkpoint, see index_files)
+        lexical = BM25Writer.load(lexical_dir) if incremental and not drop_existing else BM25Writer(lexical_dir)
+
+    if incremental:
+        file_types = {}
+        if input_dir is not None:
+            file_types.update((path, file_type) for path in list_directory_files(input_dir))
+        candidates = None
+        if github_url is not None:
+            # Repo files are read as plain text, like load_documents_from_directory does
+            file_types.update((path, "text") for path in list_repo_files(file_type, collection_name))
+            # Only repo files changed since the last indexed commit need hashing
+            from git_source import changed_files
+            changed_paths = changed_files(repo_path(collection_name), manifest.commit, file_type)
+            if changed_paths is not None:
+                candidates = set(changed_paths)
+                if input_dir is not None:
+                    candidates.update(list_directory_files(input_dir))
+        changed, removed = index_incrementally(
+            milvus, manifest, file_types, encoding, chunk_size, chunk_overlap, collection_name,
+            splitter, histogram, dedupe_threshold if dedupe else None, lexical, candidates)
+        manifest.commit = commit
+        manifest.save()
+        print(f"Indexed {changed} new or changed files, removed {removed} files.")
+        if isinstance(milvus, LocalVectorStore):
+            milvus.build_index()
+        if isinstance(milvus, MilvusBulkWriter):
+            milvus.finish()
+            print(milvus.stats.report(collection_name))
+        if lexical is not None:
+            lexical.save()
+        bump_collection_version(collection_name, version_store)
+        if histogram is not None:
+            print(histogram.report())
+        report_cache(embeddings)
+        report_throughput(embeddings)
+        print("Done!")
+        return
+
+    # A full rebuild invalidates whatever the manifest recorded, until it completes
+    manifest.clear()
+    if checkpoint.resumed:
+        # Rows of the batch that was being written when the last run stopped are not in the checkpoint
+        checkpoint.recover(lambda sources: find_chunks(milvus, collection_name, sources),
+                           lambda pks: delete_chunks(milvus, collection_name, pks))
+        print(f"Resuming from {checkpoint.path}: {checkpoint.committed()} chunks already indexed.")
+    else:
+        checkpoint.start()
 
-    documents = []
+    paths = []
     if input_dir is not None:
         # Iterate through all the files in the input directory and process each one
-
-        for file in os.listdir(input_dir):
-            file_path = os.path.join(input_dir, file)
-            if os.path.isfile(file_path):
-                print(f"Processing {file_path}...")
-                loadedDocuments = load_documents(
-                    file_path, encoding, file_type)
-                # concat two lists
-                documents = documents + loadedDocuments
-        docs = split_documents(documents, chunk_size, chunk_overlap)
-        index_documents(milvus, docs)
-        print(f"Indexed {len(docs)} chunks from {input_dir}.")
+        directory_paths = list_directory_files(input_dir)
+        paths += directory_paths
+        count = index_files(milvus, directory_paths, encoding, file_type,
+                            chunk_size, chunk_overlap, batch_size, workers, splitter, histogram, deduplicator,
+                            lexical, checkpoint)
+        print(f"Indexed {count} chunks from {input_dir}.")
 
     if github_url is not None:
-        documents = load_documents_from_directory(file_type, collection_name)
-        docs = split_documents(documents, chunk_size, chunk_overlap)
-        index_documents(milvus, docs)
-        print(f"Indexed {len(docs)} chunks from {github_url}.")
-
+        # Repo files are read as plain text, like load_documents_from_directory does
+        repo_paths = list_repo_files(file_type, collection_name)
+        paths += repo_paths
+        count = index_files(milvus, repo_paths, encoding, "text",
+                            chunk_size, chunk_overlap, batch_size, workers, splitter, histogram, deduplicator,
+                            lexical, checkpoint)
+        print(f"Indexed {count} chunks from {github_url}.")
+
+    if isinstance(milvus, LocalVectorStore):
+        milvus.build_index()
+    if isinstance(milvus, MilvusBulkWriter):
+        milvus.finish()
+        print(milvus.stats.report(collection_name))
+    if lexical is not None:
+        lexical.save()
+    # A later --incremental run only touches what changed since this one
+    manifest.rebuild(paths, checkpoint.ids, commit)
+    # The job is complete, a later run starts over
+    checkpoint.clear()
+
+    bump_collection_version(collection_name, version_store)
+    if deduplicator is not None:
+        deduplicator.save_sources(default_sources_path(collection_name))
+        print(deduplicator.report())
+    if histogram is not None:
+        print(histogram.report())
+    report_cache(embeddings)
+    report_throughput(embeddings)
     print("Done!")
 
 
@@ -166,9 +293,23 @@ if __name__ == "__main__":
     parser.add_argument('--encoding', type=str, default='utf8',
                         help='Encoding of the input documents.')
     parser.add_argument('--chunk_size', type=int, default=1000,
-                        help='Size of the chunks to split documents into.')
+                        help='Size of the chunks to split documents into (in tokens with --splitter token).')
     parser.add_argument('--chunk_overlap', type=int, default=0,
-                        help='Number of overlapping characters between consecutive chunks.')
+                        help='Number of overlapping characters (tokens with --splitter token) between consecutive chunks.')
+    parser.add_argument('--splitter', type=str, default="character", choices=["character", "token"],
+                        help='Split on characters, or on tokens at heading, code block and paragraph boundaries.')
+    parser.add_argument('--lexical_index', action='store_true',
+                        help='Also build a BM25 index of the chunks for hybrid search in similar_search.py.')
+    parser.add_argument('--lexical_dir', type=str, default=None,
+                        help='Directory of the BM25 index (default: .lexical_index/<collection_name>).')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Drop duplicate and near-duplicate chunks before embedding, streaming the kept ones.')
+    parser.add_argument('--dedupe_threshold', type=float, default=0.8,
+                        help='Estimated Jaccard similarity of word shingles above which chunks are near duplicates.')
+    parser.add_argument('--dedupe_all_sources', action='store_true',
+                        help='With --dedupe, hold the kept chunks of the whole corpus in memory until it is split, '
+                             'so each lists every file its duplicates were found in. Otherwise a chunk lists only its own '
+                             'and the later ones go to .index_manifest/<name>.sources.jsonl.')
     parser.add_argument('--host', type=str, default="127.0.0.1",
                         help='Host address for the Milvus server.')
     parser.add_argument('--port', type=str, default="19530",
@@ -179,8 +320,59 @@ if __name__ == "__main__":
                         help='Name of the collection to index the documents into.')
     parser.add_argument('--github_url', type=str, default=None,
                         help='URL of the file to download from GitHub (raw content URL).')
-
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache",
+                        help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-index new or changed files and delete the chunks of removed files.')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path of the incremental indexing manifest (default: .index_manifest/<collection_name>.json).')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of chunks embedded and inserted per batch.')
+    parser.add_argument('--embedding_concurrency', type=int, default=0,
+                        help='Number of embedding requests kept in flight (0 uses langchain OpenAIEmbeddings).')
+    parser.add_argument('--requests_per_minute', type=int, default=3000,
+                        help='Embedding requests per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--tokens_per_minute', type=int, default=1000000,
+                        help='Embedding tokens per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to load and split documents.')
+    parser.add_argument('--backend', type=str, default="milvus", choices=["milvus", "local"],
+                        help='Vector store to index into: a Milvus server or an embedded local directory.')
+    parser.add_argument('--local_dir', type=str, default=None,
+                        help='Directory of the local vector store (default: .local_index/<collection_name>).')
+    parser.add_argument('--local_index_type', type=str, default=None, choices=["FLAT", "HNSW"],
+                        help='Index of the local vector store: exact search or an HNSW graph (default: HNSW for float32 storage, else FLAT).')
+    parser.add_argument('--hnsw_m', type=int, default=8,
+                        help='HNSW M (neighbours per node) for the local vector store.')
+    parser.add_argument('--hnsw_ef_construction', type=int, default=64,
+                        help='HNSW efConstruction for the local vector store.')
+    parser.add_argument('--storage', type=str, default="float32", choices=["float32", "float16", "int8", "pq"],
+                        help='Vector storage: full float32, float16 (local only), int8 scalar quantization (Milvus IVF_SQ8) or product quantization (Milvus IVF_PQ).')
+    parser.add_argument('--pq_m', type=int, default=96,
+                        help='Number of product quantization subspaces, must divide the dimension (1536).')
+    parser.add_argument('--rerank', type=int, default=0,
+                        help='Local store: re-rank k * rerank candidates against the float32 vectors on disk (0 disables).')
+    parser.add_argument('--nlist', type=int, default=1024,
+                        help='Number of IVF clusters of the quantized Milvus indexes.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Milvus: insert columnar batches with pymilvus and build the vector index after the load.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted full run from its checkpoint instead of dropping the collection.')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Path of the full run checkpoint (default: .index_checkpoint/<collection_name>.jsonl).')
+    parser.add_argument('--version_store', type=str, default=".collection_versions",
+                        help='Directory or redis:// URL where the collection version is bumped after indexing (invalidates query caches).')
+
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
-         args.host, args.port, args.file_type, args.collection_name, args.github_url)
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode):
+        main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
+             args.host, args.port, args.file_type, args.collection_name, args.github_url,
+             args.cache_dir or None, args.incremental, args.manifest, args.batch_size,
+             args.embedding_concurrency, args.requests_per_minute, args.tokens_per_minute,
+             args.workers, args.backend, args.local_dir, args.local_index_type, args.hnsw_m, args.hnsw_ef_construction, args.version_store,
+             args.splitter,
+             args.dedupe, args.dedupe_threshold, args.lexical_index, args.lexical_dir,
+             args.storage, args.pq_m, args.rerank, args.nlist, args.bulk, args.resume, args.checkpoint,
+             dedupe_all_sources=args.dedupe_all_sources)
@@ -1,21 +1,29 @@
-# Langchain wraps the Redis client and provides a few convenience methods for working with documents.
-# It can split documents into chunks, embed them, and store them in Redis.
+# Langchain loads and splits documents into chunks; they are embedded a batch
+# at a time and stored in Redis in the hash layout of langchain's Redis store.
 
-import os
+import json
 import argparse
-
-from langchain.document_loaders import TextLoader
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.document_loaders import UnstructuredMarkdownLoader
+from functools import partial
 import logging
+from typing import TYPE_CHECKING, List
+
+# langchain, unstructured and redis are imported where they are used, so
+# importing this module (e.g. from index_sources.py) stays cheap
+if TYPE_CHECKING:
+    from redis.client import Redis as RedisType
 
-import redis
-from redis.client import Redis as RedisType
-from langchain.vectorstores.redis import Redis
-from redis.commands.search.field import TextField, VectorField
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from typing import List
+import loaders
+from loaders import load_documents, list_directory_files
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import openai_embeddings, report_throughput
+from query_cache import bump_collection_version
+from manifest import Manifest, default_manifest_path, sync_files
+from pipeline import iter_file_chunks, index_stream
+from token_splitter import ChunkHistogram
+from dedupe import ChunkDeduplicator, default_sources_path
+from bulk_load import RedisBulkWriter
+from checkpoint import Checkpoint, chunk_key, default_checkpoint_path
+from metrics import METRICS, add_arguments as add_metrics_arguments, instrumented
 
 
 text_field = "otext"
@@ -33,7 +41,7 @@ def _redis_prefix(index_name: str) -> str:
     return f"doc:{index_name}"
 
 
-def _check_redis_module_exist(client: RedisType, modules: List[dict]) -> None:
+def _check_redis_module_exist(client: "RedisType", modules: List[dict]) -> None:
     """Check if the correct Redis modules are installed."""
     installed_modules = client.module_list()
     installed_modules = {
@@ -51,29 +59,88 @@ def _check_redis_module_exist(client: RedisType, modules: List[dict]) -> None:
             raise ValueError(error_message)
 
 
-def load_documents(file_path, encoding='utf8', file_type='text'):
-    if file_type == 'markdown':
-        loader = UnstructuredMarkdownLoader(file_path)
-    else:
-        loader = TextLoader(file_path, encoding=encoding)
-    return loader.load()
+def _index_exists(client: "RedisType", index_name: str) -> bool:
+    """Check if a RediSearch index already exists."""
+    import redis
+    try:
+        client.ft(index_name).info()
+    except redis.ResponseError:
+        return False
+    return True
+
+
+def split_documents(documents, chunk_size=1000, chunk_overlap=0, splitter="character", file_type="text"):
+    # Redis has no text size limit
+    return loaders.split_documents(documents, chunk_size, chunk_overlap, splitter, file_type)
 
 
-def split_documents(documents, chunk_size=1000, chunk_overlap=0):
-    text_splitter = CharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    return text_splitter.split_documents(documents)
+def index_documents(redis_vector, docs, keys=None):
+    # Index the documents using the provided Redis instance; given keys are
+    # overwritten if they exist, so writing the same chunks twice is harmless
+    if keys is None:
+        return redis_vector.add_documents(docs)
+    return redis_vector.add_documents(docs, keys=keys)
 
 
-def index_documents(redis_vector, docs):
-    # Index the documents using the provided Redis instance
-    redis_vector.add_documents(docs)
+def delete_chunks(redis_vector, keys):
+    # Delete chunks by their doc:{index_name}:... key
+    redis_vector.client.delete(*keys)
+
+
+def find_chunks(redis_vector, index_name, sources):
+    # Keys of the stored chunks of the given files; the index has no source
+    # field, so this scans the hashes of the index and reads their metadata
+    sources = set(sources)
+    keys = list(redis_vector.client.scan_iter(match=f"{_redis_prefix(index_name)}:*", count=1000))
+    found = []
+    for start in range(0, len(keys), 1000):
+        batch = keys[start:start + 1000]
+        pipeline = redis_vector.client.pipeline(transaction=False)
+        for key in batch:
+            pipeline.hget(key, "metadata")
+        for key, metadata in zip(batch, pipeline.execute()):
+            if metadata and json.loads(metadata).get("source") in sources:
+                found.append(key.decode() if isinstance(key, bytes) else key)
+    return found
+
+
+def index_files(redis_vector, paths, encoding, file_type, chunk_size, chunk_overlap, batch_size, workers=1,
+                splitter="character", histogram=None, deduplicator=None, checkpoint=None, index_name=None):
+    # Stream the files through load -> split -> embed -> insert in bounded batches
+    if checkpoint is not None and deduplicator is None:
+        # Deduplication has to see the chunks of completed files again, otherwise skip them
+        paths = checkpoint.remaining(paths)
+    chunks = iter_file_chunks(
+        paths,
+        partial(load_documents, encoding=encoding, file_type=file_type),
+        partial(split_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                splitter=splitter, file_type=file_type),
+        workers)
+    if deduplicator is not None:
+        chunks = deduplicator.dedupe(chunks)
+    if checkpoint is None:
+        write = lambda batch: index_documents(redis_vector, batch)
+    else:
+        # Keys derive from each chunk's file and position, so a batch that is
+        # written again after a restart replaces its earlier hashes
+        prefix = _redis_prefix(index_name)
+        chunks = checkpoint.skip_committed(chunks)
+        write = checkpoint.writer(lambda batch, positions: index_documents(
+            redis_vector, batch, [chunk_key(prefix, source, offset) for source, offset in positions]))
+    if histogram is not None:
+        chunks = histogram.observe_all(chunks)
+    return index_stream(chunks, write, batch_size)
 
 
 def create_redis_index(embeddings, index_name, username, password, host, port,
                        content_key: str = "content",
                        metadata_key: str = "metadata",
-                       vector_key: str = "content_vector"):
+                       vector_key: str = "content_vector",
+                       if_exists: str = "fail", bulk: bool = False, pipeline_size: int = 500):
+    # if_exists controls an already existing index: "fail", "reuse" it, or "drop" it with its documents
+    import redis
+    from redis.commands.search.field import TextField, VectorField
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 
     redis_url = "redis://{}:{}@{}:{}".format(username, password, host, port)
 
@@ -84,6 +151,10 @@ def create_redis_index(embeddings, index_name, username, password, host, port,
     except ValueError as e:
         raise ValueError(f"Redis failed to connect: {e}")
 
+    exists = _index_exists(client, index_name)
+    if exists and if_exists == "drop":
+        client.ft(index_name).dropindex(delete_documents=True)
+
     prefix = _redis_prefix(index_name)
     dim = 1536
     distance_metric = (
@@ -103,37 +174,109 @@ def create_redis_index(embeddings, index_name, username, password, host, port,
         ),
     )
     # Create Redis Index
-    client.ft(index_name).create_index(
-        fields=schema,
-        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
-    )
+    if not (exists and if_exists == "reuse"):
+        client.ft(index_name).create_index(
+            fields=schema,
+            definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
+        )
+
+    # Each batch is embedded with one embed_documents call and written as
+    # pipelined HSETs in the layout of langchain's Redis store; langchain's
+    # add_documents would embed the chunks one at a time
+    if bulk:
+        # One dedicated connection for the whole load
+        client = redis.from_url(url=redis_url, single_connection_client=True)
+    return RedisBulkWriter(client, index_name, embeddings, content_key, metadata_key, vector_key, pipeline_size)
+
+
+def index_incrementally(redis_vector, manifest, input_dir, encoding, chunk_size, chunk_overlap, file_type,
+                        splitter="character", histogram=None, dedupe_threshold=None, index_name=None):
+    def index_file(file_path):
+        with METRICS.timer("load"):
+            documents = load_documents(file_path, encoding, file_type)
+        with METRICS.timer("split"):
+            docs = split_documents(documents, chunk_size, chunk_overlap, splitter, file_type)
+        if dedupe_threshold is not None:
+            # The manifest tracks chunks per file, so duplicates are only dropped within a file
+            docs = ChunkDeduplicator(dedupe_threshold, all_sources=True).dedupe(docs)
+        if histogram is not None:
+            docs = list(histogram.observe_all(docs))
+        return index_documents(redis_vector, docs) if docs else []
+
+    return sync_files(manifest, list_directory_files(input_dir), index_file,
+                      lambda keys: delete_chunks(redis_vector, keys),
+                      find_ids=lambda sources: find_chunks(redis_vector, index_name, sources))
 
-    # Create the VectorStore
-    redis_vector = Redis(
-        redis_url,
-        index_name,
-        embeddings.embed_query,
-        content_key=content_key,
-        metadata_key=metadata_key,
-        vector_key=vector_key,
-    )
 
-    return redis_vector
+def main(input_dir, encoding, chunk_size, chunk_overlap, username, password, host, port, file_type, index_name, cache_dir=None,
+         incremental=False, manifest_path=None,
+         embedding_concurrency=0, requests_per_minute=3000, tokens_per_minute=1000000,
+         batch_size=64, workers=1, version_store=None, splitter="character", dedupe=False, dedupe_threshold=0.8,
+         bulk=False, pipeline_size=500, resume=False, checkpoint_path=None, dedupe_all_sources=False,
+         embeddings=None):
+    if resume and incremental:
+        raise ValueError("Incremental runs resume from their manifest, --resume is for full runs")
+    # Chunk sizes are only reported for the token splitter, which has a tokenizer loaded anyway
+    histogram = ChunkHistogram() if splitter == "token" else None
+    deduplicator = ChunkDeduplicator(dedupe_threshold, all_sources=dedupe_all_sources) if dedupe else None
+    if embeddings is None:
+        # Callers indexing several sources pass one client, see index_sources.py
+        embeddings = cached_embeddings(
+            openai_embeddings(embedding_concurrency, requests_per_minute, tokens_per_minute), cache_dir)
+    manifest = Manifest(manifest_path or default_manifest_path(index_name))
 
+    if incremental:
+        # Without a manifest we can't tell which doc: keys are ours, so rebuild
+        redis_vector = create_redis_index(
+            embeddings, index_name, username, password, host, port,
+            if_exists="reuse" if manifest.exists else "drop", bulk=bulk, pipeline_size=pipeline_size)
+        changed, removed = index_incrementally(
+            redis_vector, manifest, input_dir, encoding, chunk_size, chunk_overlap, file_type,
+            splitter, histogram, dedupe_threshold if dedupe else None, index_name)
+        print(f"Indexed {changed} new or changed files, removed {removed} files.")
+        if bulk:
+            print(redis_vector.stats.report(index_name))
+        bump_collection_version(index_name, version_store)
+        if histogram is not None:
+            print(histogram.report())
+        report_cache(embeddings)
+        report_throughput(embeddings)
+        return
 
-def main(input_dir, encoding, chunk_size, chunk_overlap, username, password, host, port, file_type, index_name):
-    embeddings = OpenAIEmbeddings()
+    # Anything that changes the chunks would make the checkpoint offsets meaningless
+    checkpoint = Checkpoint(checkpoint_path or default_checkpoint_path(index_name), {
+        "input_dir": input_dir, "file_type": file_type, "encoding": encoding, "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap, "splitter": splitter, "dedupe": dedupe, "dedupe_threshold": dedupe_threshold,
+    }, resume)
     redis_vector = create_redis_index(
-        embeddings, index_name, username, password, host, port)
+        embeddings, index_name, username, password, host, port,
+        if_exists="reuse" if checkpoint.resumed else "fail", bulk=bulk, pipeline_size=pipeline_size)
+    # A full rebuild invalidates whatever the manifest recorded, until it completes
+    manifest.clear()
+    if checkpoint.resumed:
+        # Nothing to recover: the pending batch is rewritten under the same keys
+        print(f"Resuming from {checkpoint.path}: {checkpoint.committed()} chunks already indexed.")
+    else:
+        checkpoint.start()
     # Iterate through all the files in the input directory and process each one
-    for file in os.listdir(input_dir):
-        file_path = os.path.join(input_dir, file)
-        if os.path.isfile(file_path):
-            print(f"Processing {file_path}...")
-            documents = load_documents(file_path, encoding, file_type)
-            docs = split_documents(documents, chunk_size, chunk_overlap)
-            index_documents(redis_vector, docs)
-            print(f"Indexed {len(docs)} chunks from {file_path}.")
+    count = index_files(redis_vector, list_directory_files(input_dir), encoding, file_type,
+                        chunk_size, chunk_overlap, batch_size, workers, splitter, histogram, deduplicator,
+                        checkpoint, index_name)
+    print(f"Indexed {count} chunks from {input_dir}.")
+    # A later --incremental run only touches what changed since this one
+    manifest.rebuild(list_directory_files(input_dir), checkpoint.ids)
+    # The job is complete, a later run starts over
+    checkpoint.clear()
+    if bulk:
+        print(redis_vector.stats.report(index_name))
+    bump_collection_version(index_name, version_store)
+    if deduplicator is not None:
+        deduplicator.save_sources(default_sources_path(index_name))
+        print(deduplicator.report())
+    if histogram is not None:
+        print(histogram.report())
+    report_cache(embeddings)
+    report_throughput(embeddings)
 
 
 # python index_documents.py --input_dir /path/to/your/documents --file_type markdown --index_name index_name
@@ -145,9 +288,19 @@ if __name__ == "__main__":
     parser.add_argument('--encoding', type=str, default='utf8',
                         help='Encoding of the input documents.')
     parser.add_argument('--chunk_size', type=int, default=1000,
-                        help='Size of the chunks to split documents into.')
+                        help='Size of the chunks to split documents into (in tokens with --splitter token).')
     parser.add_argument('--chunk_overlap', type=int, default=0,
-                        help='Number of overlapping characters between consecutive chunks.')
+                        help='Number of overlapping characters (tokens with --splitter token) between consecutive chunks.')
+    parser.add_argument('--splitter', type=str, default="character", choices=["character", "token"],
+                        help='Split on characters, or on tokens at heading, code block and paragraph boundaries.')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Drop duplicate and near-duplicate chunks before embedding, streaming the kept ones.')
+    parser.add_argument('--dedupe_threshold', type=float, default=0.8,
+                        help='Estimated Jaccard similarity of word shingles above which chunks are near duplicates.')
+    parser.add_argument('--dedupe_all_sources', action='store_true',
+                        help='With --dedupe, hold the kept chunks of the whole corpus in memory until it is split, '
+                             'so each lists every file its duplicates were found in. Otherwise a chunk lists only its own '
+                             'and the later ones go to .index_manifest/<name>.sources.jsonl.')
     parser.add_argument('--username', type=str,
                         help='username for the Redis server.')
     parser.add_argument('--password', type=str,
@@ -160,8 +313,41 @@ if __name__ == "__main__":
                         "text", "markdown"], help='Type of the input files (text or markdown).')
     parser.add_argument('--index_name', type=str, required=True,
                         help='Name of the Index to index the documents into.')
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache",
+                        help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only re-index new or changed files and delete the chunks of removed files.')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='Path of the incremental indexing manifest (default: .index_manifest/<index_name>.json).')
+    parser.add_argument('--embedding_concurrency', type=int, default=0,
+                        help='Number of embedding requests kept in flight (0 uses langchain OpenAIEmbeddings).')
+    parser.add_argument('--requests_per_minute', type=int, default=3000,
+                        help='Embedding requests per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--tokens_per_minute', type=int, default=1000000,
+                        help='Embedding tokens per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of chunks embedded and inserted per batch.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to load and split documents.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Write over a single dedicated connection and report rows per second.')
+    parser.add_argument('--pipeline_size', type=int, default=500,
+                        help='Number of HSETs sent per pipeline round trip.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted full run from its checkpoint, reusing the existing index.')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Path of the full run checkpoint (default: .index_checkpoint/<index_name>.jsonl).')
+    parser.add_argument('--version_store', type=str, default=".collection_versions",
+                        help='Directory or redis:// URL where the collection version is bumped after indexing (invalidates query caches).')
 
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
-         args.username, args.password, args.host, args.port, args.file_type, args.index_name)
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode):
+        main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
+             args.username, args.password, args.host, args.port, args.file_type, args.index_name,
+             args.cache_dir or None, args.incremental, args.manifest,
+             args.embedding_concurrency, args.requests_per_minute, args.tokens_per_minute,
+             args.batch_size, args.workers, args.version_store, args.splitter,
+             args.dedupe, args.dedupe_threshold, args.bulk, args.pipeline_size, args.resume, args.checkpoint,
+             dedupe_all_sources=args.dedupe_all_sources)
@@ -1,84 +1,85 @@
 # Langchain wraps the Milvus client and provides a few convenience methods for working with documents.
 # It can split documents into chunks, embed them, and store them in Milvus.
 
-import os
 import argparse
+from functools import partial
 
-from langchain.document_loaders import TextLoader, GitLoader
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import SupabaseVectorStore
-from langchain.document_loaders import UnstructuredMarkdownLoader, DirectoryLoader
-from langchain.document_loaders.text import TextLoader
+# langchain, unstructured, git and supabase are imported where they are used,
+# so importing this module (e.g. from index_sources.py) stays cheap
+import loaders
+from loaders import load_documents, clone_from_github, list_directory_files, list_repo_files
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import openai_embeddings, report_throughput
+from query_cache import bump_collection_version
+from pipeline import iter_file_chunks, index_stream
+from token_splitter import ChunkHistogram
+from dedupe import ChunkDeduplicator, default_sources_path
+from checkpoint import Checkpoint, default_checkpoint_path
+from metrics import add_arguments as add_metrics_arguments, instrumented
 
-from git import Repo
 
-from supabase.client import Client, create_client
-
-
-def load_documents(file_path, encoding='utf8', file_type='text'):
-    if file_type == 'markdown':
-        loader = UnstructuredMarkdownLoader(file_path)
-    else:
-        loader = TextLoader(file_path, encoding=encoding)
-    return loader.load()
-
-
-def load_documents_from_github(github_url, file_type, collection_name):
-    repoPath = "./docs/" + collection_name
-    githubUrl = github_url
-    # check if the repo exists
-    if os.path.exists(repoPath):
-        print("Repo already exists")
-        githubUrl = None
-
-    loader = GitLoader(
-        clone_url=githubUrl,
-        repo_path=repoPath,
-        branch="main",
-        file_filter=lambda file_path: file_path.endswith(
-            ".{}".format(file_type)),
-    )
-
-    return loader.load()
-
-
-def load_documents_from_directory(file_type, collection_name):
-    path = "./docs/" + collection_name
-    loader = DirectoryLoader(
-        path=path,
-        glob="**/*.{}".format(file_type),
-        loader_cls=TextLoader
-    )
-
-    return loader.load()
-
-
-def clone_from_github(github_url, collection_name):
-    path = "./docs/" + collection_name
-    if os.path.exists(path):
-        print("Repo already exists")
-        return
-
-    repo = Repo.clone_from(
-        github_url, to_path=path
-    )
-    repo.git.checkout("main")
-
-
-def split_documents(documents, chunk_size=1000, chunk_overlap=0):
-    text_splitter = CharacterTextSplitter(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    return text_splitter.split_documents(documents)
+def split_documents(documents, chunk_size=1000, chunk_overlap=0, splitter="character", file_type="text"):
+    # The content column is unbounded text
+    return loaders.split_documents(documents, chunk_size, chunk_overlap, splitter, file_type)
 
 
 def index_documents(supabaseVectorStore, docs):
     # Index the documents using the provided Milvus instance
-    supabaseVectorStore.add_documents(docs)
-
-
-def main(input_dir, encoding, chunk_size, chunk_overlap, supabase_url, supabase_service_key, file_type, table_name, query_name, github_url):
-    embeddings = OpenAIEmbeddings()
+    return supabaseVectorStore.add_documents(docs)
+
+
+def find_chunks(supabase, table_name, sources):
+    # ids of the rows of the given files, as strings like the ids add_documents returns
+    ids = []
+    for source in sources:
+        result = supabase.table(table_name).select("id").eq("metadata->>source", source).execute()
+        ids.extend(str(row["id"]) for row in result.data)
+    return ids
+
+
+def delete_chunks(supabase, table_name, ids):
+    supabase.table(table_name).delete().in_("id", list(ids)).execute()
+
+
+def index_files(supabaseVectorStore, paths, encoding, file_type, chunk_size, chunk_overlap, batch_size, workers=1,
+                splitter="character", histogram=None, deduplicator=None, checkpoint=None):
+    # Stream the files through load -> split -> embed -> insert in bounded batches
+    if checkpoint is not None and deduplicator is None:
+        # Deduplication has to see the chunks of completed files again, otherwise skip them
+        paths = checkpoint.remaining(paths)
+    chunks = iter_file_chunks(
+        paths,
+        partial(load_documents, encoding=encoding, file_type=file_type),
+        partial(split_documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                splitter=splitter, file_type=file_type),
+        workers)
+    if deduplicator is not None:
+        chunks = deduplicator.dedupe(chunks)
+    if checkpoint is None:
+        write = lambda batch: index_documents(supabaseVectorStore, batch)
+    else:
+        chunks = checkpoint.skip_committed(chunks)
+        write = checkpoint.writer(lambda batch, positions: index_documents(supabaseVectorStore, batch))
+    if histogram is not None:
+        chunks = histogram.observe_all(chunks)
+    return index_stream(chunks, write, batch_size)
+
+
+def main(input_dir, encoding, chunk_size, chunk_overlap, supabase_url, supabase_service_key, file_type, table_name, query_name, github_url, cache_dir=None,
+         batch_size=64, embedding_concurrency=0, requests_per_minute=3000, tokens_per_minute=1000000,
+         workers=1, version_store=None, splitter="character", dedupe=False, dedupe_threshold=0.8,
+         resume=False, checkpoint_path=None, dedupe_all_sources=False,
+         embeddings=None):
+    # Chunk sizes are only reported for the token splitter, which has a tokenizer loaded anyway
+    histogram = ChunkHistogram() if splitter == "token" else None
+    deduplicator = ChunkDeduplicator(dedupe_threshold, all_sources=dedupe_all_sources) if dedupe else None
+    if embeddings is None:
+        # Callers indexing several sources pass one client, see index_sources.py
+        embeddings = cached_embeddings(
+            openai_embeddings(embedding_concurrency, requests_per_minute, tokens_per_minute), cache_dir)
+
+    from langchain.vectorstores import SupabaseVectorStore
+    from supabase.client import Client, create_client
 
     supabase: Client = create_client(supabase_url, supabase_service_key)
     # Create the VectorStore
@@ -88,30 +89,47 @@ def main(input_dir, encoding, chunk_size, chunk_overlap, supabase_url, supabase_
         table_name,
         query_name,
     )
+    # Anything that changes the chunks would make the checkpoint offsets meaningless
+    checkpoint = Checkpoint(checkpoint_path or default_checkpoint_path(table_name), {
+        "input_dir": input_dir, "github_url": github_url, "file_type": file_type, "encoding": encoding,
+        "chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "splitter": splitter,
+        "dedupe": dedupe, "dedupe_threshold": dedupe_threshold,
+    }, resume)
+    if checkpoint.resumed:
+        # Rows of the batch that was being inserted when the last run stopped are not in the checkpoint
+        checkpoint.recover(lambda sources: find_chunks(supabase, table_name, sources),
+                           lambda ids: delete_chunks(supabase, table_name, ids))
+        print(f"Resuming from {checkpoint.path}: {checkpoint.committed()} chunks already indexed.")
+    else:
+        checkpoint.start()
 
-    documents = []
     if input_dir is not None:
         # Iterate through all the files in the input directory and process each one
-        for file in os.listdir(input_dir):
-            file_path = os.path.join(input_dir, file)
-            if os.path.isfile(file_path):
-                print(f"Processing {file_path}...")
-                loadedDocuments = load_documents(
-                    file_path, encoding, file_type)
-                # concat two lists
-                documents = documents + loadedDocuments
-        docs = split_documents(documents, chunk_size, chunk_overlap)
-
-        index_documents(supabaseVectorStore, docs)
-        print(f"Indexed {len(docs)} chunks from {input_dir}.")
+        count = index_files(supabaseVectorStore, list_directory_files(input_dir), encoding, file_type,
+                            chunk_size, chunk_overlap, batch_size, workers, splitter, histogram, deduplicator,
+                            checkpoint)
+        print(f"Indexed {count} chunks from {input_dir}.")
 
     if github_url is not None:
-        documents = load_documents_from_directory(file_type, collection_name)
-        docs = split_documents(documents, chunk_size, chunk_overlap)
-
-        index_documents(supabaseVectorStore, docs)
-        print(f"Indexed {len(docs)} chunks from {github_url}.")
-
+        # The repo is cloned under ./docs/<table_name>; its files are read as plain text.
+        # A resumed run keeps the checkout its checkpoint offsets refer to
+        if not checkpoint.resumed:
+            clone_from_github(github_url, table_name, file_type)
+        count = index_files(supabaseVectorStore, list_repo_files(file_type, table_name), encoding, "text",
+                            chunk_size, chunk_overlap, batch_size, workers, splitter, histogram, deduplicator,
+                            checkpoint)
+        print(f"Indexed {count} chunks from {github_url}.")
+    # The job is complete, a later run starts over
+    checkpoint.clear()
+
+    bump_collection_version(table_name, version_store)
+    if deduplicator is not None:
+        deduplicator.save_sources(default_sources_path(table_name))
+        print(deduplicator.report())
+    if histogram is not None:
+        print(histogram.report())
+    report_cache(embeddings)
+    report_throughput(embeddings)
     print("Done!")
 
 
@@ -124,9 +142,19 @@ if __name__ == "__main__":
     parser.add_argument('--encoding', type=str, default='utf8',
                         help='Encoding of the input documents.')
     parser.add_argument('--chunk_size', type=int, default=1000,
-                        help='Size of the chunks to split documents into.')
+                        help='Size of the chunks to split documents into (in tokens with --splitter token).')
     parser.add_argument('--chunk_overlap', type=int, default=0,
-                        help='Number of overlapping characters between consecutive chunks.')
+                        help='Number of overlapping characters (tokens with --splitter token) between consecutive chunks.')
+    parser.add_argument('--splitter', type=str, default="character", choices=["character", "token"],
+                        help='Split on characters, or on tokens at heading, code block and paragraph boundaries.')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Drop duplicate and near-duplicate chunks before embedding, streaming the kept ones.')
+    parser.add_argument('--dedupe_threshold', type=float, default=0.8,
+                        help='Estimated Jaccard similarity of word shingles above which chunks are near duplicates.')
+    parser.add_argument('--dedupe_all_sources', action='store_true',
+                        help='With --dedupe, hold the kept chunks of the whole corpus in memory until it is split, '
+                             'so each lists every file its duplicates were found in. Otherwise a chunk lists only its own '
+                             'and the later ones go to .index_manifest/<name>.sources.jsonl.')
     parser.add_argument('--supabase_url', type=str, required=True,
                         help='Supabase url.')
     parser.add_argument('--supabase_service_key', type=str, required=True,
@@ -139,8 +167,34 @@ if __name__ == "__main__":
                         help='The function query name.')
     parser.add_argument('--github_url', type=str, default=None,
                         help='URL of the file to download from GitHub (raw content URL).')
-
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache",
+                        help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Number of chunks embedded and inserted per batch.')
+    parser.add_argument('--embedding_concurrency', type=int, default=0,
+                        help='Number of embedding requests kept in flight (0 uses langchain OpenAIEmbeddings).')
+    parser.add_argument('--requests_per_minute', type=int, default=3000,
+                        help='Embedding requests per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--tokens_per_minute', type=int, default=1000000,
+                        help='Embedding tokens per minute allowed with --embedding_concurrency.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to load and split documents.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its checkpoint, without inserting its chunks twice.')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Path of the run checkpoint (default: .index_checkpoint/<table_name>.jsonl).')
+    parser.add_argument('--version_store', type=str, default=".collection_versions",
+                        help='Directory or redis:// URL where the collection version is bumped after indexing (invalidates query caches).')
+
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
-         args.supabase_url, args.supabase_service_key, args.file_type, args.table_name, args.query_name, args.github_url)
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode):
+        main(args.input_dir, args.encoding, args.chunk_size, args.chunk_overlap,
+             args.supabase_url, args.supabase_service_key, args.file_type, args.table_name, args.query_name, args.github_url,
+             args.cache_dir or None, args.batch_size,
+             args.embedding_concurrency, args.requests_per_minute, args.tokens_per_minute,
+             args.workers, args.version_store, args.splitter,
+             args.dedupe, args.dedupe_threshold, args.resume, args.checkpoint,
+             dedupe_all_sources=args.dedupe_all_sources)
@@ -0,0 +1,195 @@
+# Index many sources in one process, from a YAML manifest.
+# Each source is a local directory or a GitHub repository indexed into its own
+# collection of one of the backends. Sources run as concurrent jobs: one
+# clones while another splits and a third waits on the embeddings API. All
+# jobs share one embedding client, so its concurrency window and rate limits
+# apply to the whole run, and the run takes about as long as its slowest
+# source instead of the sum of all of them.
+#
+# embedding_concurrency: 16
+# defaults:
+#   backend: milvus
+#   file_type: markdown
+#   splitter: token
+# sources:
+#   - collection_name: cairo_book
+#     github_url: https://github.com/cairo-book/cairo-book.github.io
+#   - collection_name: notes
+#     input_dir: ./notes
+#     backend: local
+#
+# Source options are the parameters of the main() of index_documents.py
+# (backends milvus and local), index_documents_redis.py or
+# index_documents_supabase.py.
+
+import sys
+import json
+import time
+import inspect
+import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import openai_embeddings, report_throughput, AsyncEmbeddingClient
+from metrics import add_arguments as add_metrics_arguments, instrumented
+
+
+# backend -> (indexer module, option naming the collection)
+BACKENDS = {
+    "milvus": ("index_documents", "collection_name"),
+    "local": ("index_documents", "collection_name"),
+    "redis": ("index_documents_redis", "index_name"),
+    "supabase": ("index_documents_supabase", "table_name"),
+}
+
+# Defaults of the indexers' command lines for their positional parameters
+OPTION_DEFAULTS = {
+    "input_dir": None, "github_url": None, "encoding": "utf8", "chunk_size": 1000, "chunk_overlap": 0,
+    "file_type": "text", "host": "127.0.0.1",
+}
+PORT_DEFAULTS = {"milvus": "19530", "redis": "6379"}
+
+
+class SourceStatus:
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.state = "queued"
+        self.error = None
+        self.started = None
+        self.finished = None
+        # Seconds spent in each state
+        self.timings = {}
+        self._entered = None
+        self._lock = threading.Lock()
+
+    def enter(self, state):
+        with self._lock:
+            now = time.perf_counter()
+            if self.started is None:
+                self.started = now
+            if self._entered is not None:
+                self.timings[self.state] = round(now - self._entered, 3)
+            self.state = state
+            self._entered = now
+            if state in ("done", "failed"):
+                self.finished = now
+        # One write per line, so concurrent jobs don't interleave their lines
+        print(f"[{self.name}] {state}" + (f": {self.error}" if self.error else "") + "\n", end="", flush=True)
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def as_dict(self):
+        return {"name": self.name, "backend": self.backend, "state": self.state,
+                "seconds": round(self.seconds, 3), "timings": self.timings, "error": self.error}
+
+
+def load_sources(path):
+    with open(path, encoding="utf8") as f:
+        config = yaml.safe_load(f) or {}
+    if not config.get("sources"):
+        raise ValueError(f"{path} lists no sources")
+    return config
+
+
+def job_arguments(source, defaults):
+    """(backend, name, main() keyword arguments) of a source, checked against the indexer."""
+    options = {**defaults, **source}
+    backend = options.pop("backend", "milvus")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {sorted(BACKENDS)}")
+    module_name, name_option = BACKENDS[backend]
+    main = importlib.import_module(module_name).main
+    parameters = inspect.signature(main).parameters
+    if "backend" in parameters:
+        options["backend"] = backend
+    arguments = {key: value for key, value in OPTION_DEFAULTS.items() if key in parameters}
+    if "port" in parameters:
+        arguments["port"] = PORT_DEFAULTS.get(backend)
+    arguments.update(options)
+    unknown = sorted(set(arguments) - set(parameters))
+    if unknown:
+        raise ValueError(f"Unknown options {unknown} for a {backend} source")
+    missing = [key for key, parameter in parameters.items()
+               if parameter.default is inspect.Parameter.empty and key not in arguments]
+    if missing:
+        raise ValueError(f"Missing options {missing} for a {backend} source")
+    return backend, arguments[name_option], arguments
+
+
+def run_source(status, module, arguments, embeddings):
+    try:
+        # The indexers clone or fetch GitHub sources themselves
+        status.enter("indexing")
+        module.main(**arguments, embeddings=embeddings)
+        status.enter("done")
+    except Exception as e:
+        # One failing source doesn't stop the others
+        status.error = f"{type(e).__name__}: {e}"
+        status.enter("failed")
+
+
+def main(sources_path, max_jobs=0, cache_dir=None, report_path=None):
+    config = load_sources(sources_path)
+    defaults = config.get("defaults") or {}
+    # Validated, and the indexers imported, before any job starts
+    jobs = [job_arguments(source, defaults) for source in config["sources"]]
+    names = [name for _, name, _ in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Every source needs its own collection")
+
+    concurrency = config.get("embedding_concurrency", 16)
+    client = openai_embeddings(concurrency, config.get("requests_per_minute", 3000),
+                               config.get("tokens_per_minute", 1000000))
+    embeddings = cached_embeddings(client, cache_dir)
+
+    statuses = [SourceStatus(name, backend) for backend, name, _ in jobs]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_jobs or len(jobs)) as pool:
+        for status, (backend, _, arguments) in zip(statuses, jobs):
+            module = importlib.import_module(BACKENDS[backend][0])
+            pool.submit(run_source, status, module, arguments, embeddings)
+    elapsed = time.perf_counter() - started
+    if isinstance(client, AsyncEmbeddingClient):
+        client.close()
+
+    for status in statuses:
+        print(f"{status.name:<30} {status.backend:<9} {status.state:<7} {status.seconds:8.1f}s"
+              + (f"  {status.error}" if status.error else ""))
+    print(f"Indexed {len(statuses)} sources in {elapsed:.1f}s "
+          f"(sum of the jobs: {sum(status.seconds for status in statuses):.1f}s).")
+    report_cache(embeddings)
+    report_throughput(embeddings)
+    if report_path:
+        with open(report_path, "w", encoding="utf8") as f:
+            json.dump({"seconds": round(elapsed, 3), "sources": [status.as_dict() for status in statuses]}, f, indent=2)
+    return all(status.state == "done" for status in statuses)
+
+
+# python src/index_sources.py --sources sources.yaml
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index every source of a YAML manifest concurrently, sharing one embedding budget.")
+    parser.add_argument('--sources', type=str, required=True,
+                        help='YAML file listing the sources to index (see the top of this file).')
+    parser.add_argument('--max_jobs', type=int, default=0,
+                        help='Number of sources indexed at the same time (0 runs all of them at once).')
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache",
+                        help='Directory of the on-disk embedding cache shared by all sources (pass an empty string to disable).')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Write the status and timings of every source to this JSON file.')
+
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode):
+        ok = main(args.sources, args.max_jobs, args.cache_dir or None, args.report)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,77 @@
+# IVF_FLAT style index: k-means coarse quantizer plus inverted lists.
+# Mirrors the Milvus IVF_FLAT parameters: nlist clusters at build time and
+# nprobe clusters scanned per query. Distances are squared L2.
+
+from typing import Tuple
+
+import numpy as np
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 20, seed: int = 0,
+           sample_size: int = 100_000) -> np.ndarray:
+    """Lloyd's k-means on (a sample of) vectors; returns the centroids."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = np.array(vectors[rng.choice(len(vectors), n_clusters, replace=False)], dtype=np.float32)
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        for c in range(n_clusters):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+            else:
+                # Re-seed empty clusters with a random point
+                centroids[c] = vectors[rng.integers(len(vectors))]
+    return centroids
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 16384) -> np.ndarray:
+    """Index of the nearest centroid for every vector."""
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    result = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        # ||x||^2 is the same for every centroid, so it can be dropped
+        dists = centroid_norms - 2 * block @ centroids.T
+        result[start:start + len(block)] = np.argmin(dists, axis=1)
+    return result
+
+
+class IVFIndex:
+    def __init__(self, nlist: int = 128, nprobe: int = 8, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.vectors = None
+
+    def build(self, vectors: np.ndarray) -> "IVFIndex":
+        self.vectors = vectors
+        self.centroids = kmeans(vectors, self.nlist, seed=self.seed)
+        assignment = assign(vectors, self.centroids)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+        return self
+
+    def nbytes(self) -> int:
+        # Centroids plus the ids in the inverted lists, vectors are shared with the store
+        return self.centroids.nbytes + sum(ids.nbytes for ids in self.lists)
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (ids, squared L2 distances) of the approximate k nearest rows."""
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_dists = np.einsum("ij,ij->i", self.centroids - query, self.centroids - query)
+        probes = np.argpartition(centroid_dists, nprobe - 1)[:nprobe]
+        candidates = np.concatenate([self.lists[c] for c in probes])
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        diff = self.vectors[candidates] - query
+        dists = np.einsum("ij,ij->i", diff, diff)
+        top = np.argsort(dists)[:k] if len(dists) <= k else np.argpartition(dists, k - 1)[:k]
+        top = top[np.argsort(dists[top])]
+        return candidates[top], dists[top]
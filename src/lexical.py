@@ -0,0 +1,271 @@
+# BM25 inverted index over the indexed chunks, for lexical and hybrid search.
+# Postings are stored in one memory-mapped file of (doc, tf) records, grouped
+# by term (the writer spills them to sorted segments while indexing and merges
+# those on save); doc is a dense integer id and lexicon.json maps it back to the id the
+# vector store gave the chunk (a Milvus pk, a local store id, ...). Queries only
+# touch the postings of their own terms. Hybrid search fuses the lexical and
+# vector rankings with reciprocal-rank fusion.
+
+import os
+import re
+import json
+import math
+import shutil
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+
+POSTING = np.dtype([("doc", "<u4"), ("tf", "<u2")])
+# Postings of a spilled segment of BM25Writer, sorted by term id
+SEGMENT = np.dtype([("term", "<u4"), ("doc", "<u4"), ("tf", "<u2")])
+# About 10 bytes each while buffered
+SPILL_POSTINGS = 4_000_000
+
+
+def default_lexical_dir(collection_name: str) -> str:
+    return os.path.join(".lexical_index", collection_name)
+
+
+def tokenize(text: str) -> List[str]:
+    # Identifiers such as get_block_hash or E0123 stay whole tokens
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Writer:
+    """BM25 index that is built up by the indexers and saved to a directory.
+
+    Postings are buffered as flat (term, doc, tf) arrays and spilled to a
+    segment file, sorted by term, every spill_postings postings; save merges
+    the saved index and the segments into a new one. Memory stays flat
+    whatever the size of the corpus.
+    """
+
+    def __init__(self, directory: str, spill_postings: int = SPILL_POSTINGS):
+        self.directory = directory
+        self.spill_postings = spill_postings
+        self.ids = []
+        self.lengths = array("I")
+        self.removed = set()
+        self._doc_of = {}
+        # term -> term id, in first-seen order
+        self._term_ids: Dict[str, int] = {}
+        self._terms, self._docs, self._tfs = array("I"), array("I"), array("H")
+        self._segments = []
+        # Saved index the writer continues, its postings are merged in by save
+        self._base = None
+
+    @property
+    def _segment_dir(self):
+        return self.directory.rstrip(os.sep) + ".segments"
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Writer":
+        """Writer continuing a saved index, for incremental updates."""
+        writer = cls(directory)
+        if os.path.exists(os.path.join(directory, "lexicon.json")):
+            writer._continue(BM25Index(directory))
+        return writer
+
+    def _continue(self, index: "BM25Index") -> None:
+        self._base = index
+        self.ids = list(index.ids)
+        self.lengths = array("I", index.lengths.tobytes())
+        self._doc_of = {external_id: doc for doc, external_id in enumerate(self.ids)}
+        self._term_ids = {term: term_id for term_id, term in enumerate(index.terms)}
+
+    def add(self, ids: Sequence, texts: Iterable[str]) -> None:
+        for external_id, text in zip(ids, texts):
+            doc = len(self.ids)
+            tokens = tokenize(text)
+            self.ids.append(external_id)
+            self.lengths.append(len(tokens))
+            self._doc_of[external_id] = doc
+            for term, tf in Counter(tokens).items():
+                self._terms.append(self._term_ids.setdefault(term, len(self._term_ids)))
+                self._docs.append(doc)
+                self._tfs.append(min(tf, 65535))
+        if len(self._terms) >= self.spill_postings:
+            self._spill()
+
+    def add_documents(self, ids: Sequence, docs: Iterable) -> None:
+        self.add(ids, (doc.page_content for doc in docs))
+
+    def remove(self, ids: Iterable) -> None:
+        for external_id in ids:
+            doc = self._doc_of.pop(external_id, None)
+            if doc is not None:
+                self.removed.add(doc)
+
+    def _spill(self) -> None:
+        if not self._terms:
+            return
+        if not self._segments:
+            # Left over from a run that died before saving
+            shutil.rmtree(self._segment_dir, ignore_errors=True)
+            os.makedirs(self._segment_dir)
+        records = np.empty(len(self._terms), dtype=SEGMENT)
+        records["term"] = np.frombuffer(self._terms, dtype=np.uint32)
+        records["doc"] = np.frombuffer(self._docs, dtype=np.uint32)
+        records["tf"] = np.frombuffer(self._tfs, dtype=np.uint16)
+        # Docs only grow, so a stable sort keeps each term's postings in doc order
+        path = os.path.join(self._segment_dir, f"{len(self._segments)}.bin")
+        records[np.argsort(records["term"], kind="stable")].tofile(path)
+        self._segments.append(path)
+        self._terms, self._docs, self._tfs = array("I"), array("I"), array("H")
+
+    def _base_postings(self, live):
+        # (term id, live postings) of every term of the saved index
+        for term, (offset, df) in self._base.terms.items():
+            postings = self._base.postings[offset:offset + df]
+            yield self._term_ids[term], postings[live[postings["doc"]]]
+
+    def _segment_postings(self, live):
+        for path in self._segments:
+            records = np.fromfile(path, dtype=SEGMENT)
+            yield records[live[records["doc"]]]
+
+    def save(self) -> None:
+        self._spill()
+        # Removed docs are dropped and the rest renumbered, so doc ids stay dense
+        live = np.ones(len(self.ids), dtype=bool)
+        live[list(self.removed)] = False
+        renumber = np.cumsum(live, dtype=np.int64) - 1
+
+        # First pass counts the postings of every term, which gives each its offset
+        counts = np.zeros(len(self._term_ids), dtype=np.int64)
+        if self._base is not None:
+            for term_id, postings in self._base_postings(live):
+                counts[term_id] += len(postings)
+        for records in self._segment_postings(live):
+            counts += np.bincount(records["term"], minlength=len(counts))
+        offsets = np.cumsum(counts) - counts
+        total = int(counts.sum())
+
+        # Write a complete new directory, then swap it in
+        tmp_dir = self.directory.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        postings_path = os.path.join(tmp_dir, "postings.bin")
+        if total:
+            # Second pass writes each term's postings after the ones written before them
+            out = np.memmap(postings_path, dtype=POSTING, mode="w+", shape=(total,))
+            cursor = offsets.copy()
+            if self._base is not None:
+                for term_id, postings in self._base_postings(live):
+                    start = cursor[term_id]
+                    out["doc"][start:start + len(postings)] = renumber[postings["doc"]]
+                    out["tf"][start:start + len(postings)] = postings["tf"]
+                    cursor[term_id] += len(postings)
+            for records in self._segment_postings(live):
+                terms, first, runs = np.unique(records["term"], return_index=True, return_counts=True)
+                destination = cursor[records["term"]] + np.arange(len(records)) - np.repeat(first, runs)
+                out["doc"][destination] = renumber[records["doc"]]
+                out["tf"][destination] = records["tf"]
+                cursor[terms] += runs
+            out.flush()
+            del out
+        else:
+            open(postings_path, "wb").close()
+        lengths = np.frombuffer(self.lengths, dtype=np.uint32)[live]
+        lengths.tofile(os.path.join(tmp_dir, "lengths.u32"))
+        terms = {term: [int(offsets[term_id]), int(counts[term_id])]
+                 for term, term_id in self._term_ids.items() if counts[term_id]}
+        with open(os.path.join(tmp_dir, "lexicon.json"), "w", encoding="utf8") as f:
+            json.dump({"ids": [self.ids[doc] for doc in np.flatnonzero(live).tolist()], "terms": terms,
+                       "avgdl": float(lengths.mean()) if len(lengths) else 0.0}, f)
+        old_dir = self.directory.rstrip(os.sep) + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(self.directory):
+            os.replace(self.directory, old_dir)
+        os.replace(tmp_dir, self.directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        shutil.rmtree(self._segment_dir, ignore_errors=True)
+        print(f"Saved lexical index of {len(lengths)} chunks and {len(terms)} terms to {self.directory}.")
+        # Further updates continue from what was just saved
+        self.removed = set()
+        self._segments = []
+        self._continue(BM25Index(self.directory))
+
+
+class BM25Index:
+    """Read-only BM25 index over a directory saved by BM25Writer."""
+
+    def __init__(self, directory: str, k1: float = 1.2, b: float = 0.75):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        with open(os.path.join(directory, "lexicon.json"), encoding="utf8") as f:
+            lexicon = json.load(f)
+        self.ids = lexicon["ids"]
+        self.terms = lexicon["terms"]
+        self.avgdl = lexicon["avgdl"] or 1.0
+        self.lengths = np.fromfile(os.path.join(directory, "lengths.u32"), dtype=np.uint32)
+        path = os.path.join(directory, "postings.bin")
+        if os.path.getsize(path):
+            self.postings = np.memmap(path, dtype=POSTING, mode="r")
+        else:
+            self.postings = np.empty(0, dtype=POSTING)
+        # Length normalisation is per document, compute it once
+        self._norms = (self.k1 * (1 - self.b + self.b * self.lengths / self.avgdl)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 4):
+        """Top-k [(id, score)] for query, best first; only documents sharing a term."""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            offset, df = entry
+            postings = self.postings[offset:offset + df]
+            docs = postings["doc"].astype(np.int64)
+            tf = postings["tf"].astype(np.float32)
+            idf = math.log(1 + (len(self.ids) - df + 0.5) / (df + 0.5))
+            # A term has one posting per document, so the fancy index never collides
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._norms[docs])
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(self.ids[doc], float(scores[doc])) for doc in hits]
+
+    def search_many(self, queries: Iterable[str], k: int = 4):
+        return [self.search(query, k) for query in queries]
+
+
+def rrf_fuse(rankings: Sequence[List[dict]], k: int, rrf_k: int = 60) -> List[dict]:
+    """Reciprocal-rank fusion of several ranked result lists.
+
+    Results are matched on their "id" (their text when they have none) and
+    scored sum(1 / (rrf_k + rank)) over the lists they appear in.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, 1):
+            key = result.get("id", result["text"])
+            entry = fused.setdefault(key, {**result, "score": 0.0})
+            entry["score"] += 1 / (rrf_k + rank)
+    return sorted(fused.values(), key=lambda result: -result["score"])[:k]
+
+
+def redis_text_search(client, index_name: str, query: str, k: int,
+                      content_key: str = "content", metadata_key: str = "metadata") -> List[dict]:
+    """Lexical side for Redis: FT.SEARCH on the text fields of the index, BM25 scored."""
+    from redis.commands.search.query import Query
+
+    terms = tokenize(query)
+    if not terms:
+        return []
+    # \w tokens contain no RediSearch syntax, so they can be OR-ed as is
+    search = (Query(f"@{content_key}:({'|'.join(terms)})").scorer("BM25").with_scores()
+              .return_fields(content_key, metadata_key).paging(0, k))
+    result = client.ft(index_name).search(search)
+    # Keyed like the KNN hits of similar_search.redis_multi_search, so fusion matches them
+    return [{"id": doc.id, "text": getattr(doc, content_key),
+             "metadata": json.loads(getattr(doc, metadata_key, "{}") or "{}"), "score": float(doc.score)}
+            for doc in result.docs]
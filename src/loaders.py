@@ -0,0 +1,84 @@
+# Loading and splitting shared by the indexers and the indexing engine.
+# langchain, unstructured and git are imported where they are used, so only
+# the loaders a run selects are paid for at startup.
+
+import os
+import glob
+from typing import Optional
+
+from token_splitter import StructuredTokenSplitter
+
+
+def repo_path(collection_name):
+    # GitHub sources are checked out under ./docs/<collection_name>
+    return "./docs/" + collection_name
+
+
+def load_documents(file_path, encoding='utf8', file_type='text'):
+    if file_type == 'markdown':
+        from langchain.document_loaders import UnstructuredMarkdownLoader
+        loader = UnstructuredMarkdownLoader(file_path)
+    else:
+        from langchain.document_loaders.text import TextLoader
+        loader = TextLoader(file_path, encoding=encoding)
+    return loader.load()
+
+
+def split_documents(documents, chunk_size=1000, chunk_overlap=0, splitter="character", file_type="text",
+                    max_length: Optional[int] = None):
+    if splitter == "token":
+        # chunk_size and chunk_overlap are counted in tokens, chunks stay below max_length characters
+        text_splitter = StructuredTokenSplitter(chunk_size, chunk_overlap, file_type, max_length=max_length)
+    else:
+        from langchain.text_splitter import CharacterTextSplitter
+        text_splitter = CharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(documents)
+
+
+def load_documents_from_github(github_url, file_type, collection_name):
+    from langchain.document_loaders import GitLoader
+
+    # Clone, or bring an existing checkout up to date, then read it in place
+    clone_from_github(github_url, collection_name, file_type)
+
+    loader = GitLoader(
+        repo_path=repo_path(collection_name),
+        branch="main",
+        file_filter=lambda file_path: file_path.endswith(
+            ".{}".format(file_type)),
+    )
+
+    return loader.load()
+
+
+def load_documents_from_directory(file_type, collection_name):
+    from langchain.document_loaders import DirectoryLoader
+    from langchain.document_loaders.text import TextLoader
+
+    loader = DirectoryLoader(
+        path=repo_path(collection_name),
+        glob="**/*.{}".format(file_type),
+        loader_cls=TextLoader
+    )
+
+    return loader.load()
+
+
+def clone_from_github(github_url, collection_name, file_type="text"):
+    # Shallow, blobless checkout of the files of file_type, fetched again if it exists;
+    # returns the checked out commit
+    from git_source import sync_repo
+    return sync_repo(github_url, repo_path(collection_name), file_type)
+
+
+def list_directory_files(input_dir):
+    # Files directly inside input_dir, in a stable order
+    paths = (os.path.join(input_dir, file) for file in sorted(os.listdir(input_dir)))
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def list_repo_files(file_type, collection_name):
+    # Same files DirectoryLoader picks up in load_documents_from_directory
+    path = repo_path(collection_name)
+    return sorted(glob.glob(os.path.join(path, "**", "*.{}".format(file_type)), recursive=True))
@@ -0,0 +1,360 @@
+# Embedded vector store kept in a local directory.
+# Vectors are appended to a float32 file that is memory-mapped for search,
+# texts and metadata go to a JSON-lines file. Search is exact (batched matrix
+# products) or approximate through an HNSW graph, with L2 distance like the
+# Milvus collection created by index_documents.py. With a compressed storage
+# mode (float16, int8, pq) search scans compact codes instead, and the float32
+# file stays on disk for re-ranking the top candidates.
+
+import os
+import json
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from hnsw import HNSWIndex
+from quantize import load_codec, make_codec, rerank, save_codec, training_sample
+from metrics import METRICS
+
+
+CONFIG_FILE = "store.json"
+VECTORS_FILE = "vectors.f32"
+METADATA_FILE = "metadata.jsonl"
+HNSW_FILE = "hnsw.pkl"
+CODES_FILE = "codes.bin"
+CODEC_FILE = "codec.npz"
+# Deleted rows stay in the HNSW graph until they make up this share of its
+# nodes, then build_index rebuilds the graph without them
+MAX_DELETED_RATIO = 0.2
+
+
+def blockwise_top_k(n: int, num_queries: int, block_distances, k: int,
+                    deleted: Optional[np.ndarray] = None, block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """k smallest distances per query over n rows scanned in blocks.
+
+    block_distances(start, stop) returns the (num_queries, stop - start)
+    distances of rows start..stop. Rows listed in deleted are skipped.
+    Returns (ids, distances) sorted by distance, -1 marks missing hits.
+    """
+    best_ids = np.full((num_queries, 0), -1, dtype=np.int64)
+    best_dists = np.full((num_queries, 0), np.inf, dtype=np.float32)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        dists = block_distances(start, stop)
+        if deleted is not None:
+            local = deleted[(deleted >= start) & (deleted < stop)] - start
+            dists[:, local] = np.inf
+        ids = np.broadcast_to(np.arange(start, stop), dists.shape)
+        best_ids = np.concatenate([best_ids, ids], axis=1)
+        best_dists = np.concatenate([best_dists, dists], axis=1)
+        if best_ids.shape[1] > k:
+            top = np.argpartition(best_dists, k - 1, axis=1)[:, :k]
+            best_ids = np.take_along_axis(best_ids, top, axis=1)
+            best_dists = np.take_along_axis(best_dists, top, axis=1)
+    order = np.argsort(best_dists, axis=1)
+    best_ids = np.take_along_axis(best_ids, order, axis=1)
+    best_dists = np.take_along_axis(best_dists, order, axis=1)
+    best_ids[~np.isfinite(best_dists)] = -1
+    return best_ids, best_dists
+
+
+def exact_search(vectors: np.ndarray, queries: np.ndarray, k: int, norms: Optional[np.ndarray] = None,
+                 deleted: Optional[np.ndarray] = None, block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact k nearest rows of vectors for every query, by squared L2 distance.
+
+    vectors is scanned in blocks of block_size rows so a memory-mapped matrix
+    never has to be resident as a whole.
+    """
+    if norms is None:
+        norms = np.einsum("ij,ij->i", vectors, vectors)
+    query_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+
+    def block_distances(start, stop):
+        # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2, one matrix product per block
+        return query_norms - 2 * queries @ vectors[start:stop].T + norms[start:stop]
+    return blockwise_top_k(len(vectors), len(queries), block_distances, k, deleted, block_size)
+
+
+def codes_search(codec, codes: np.ndarray, queries: np.ndarray, k: int,
+                 deleted: Optional[np.ndarray] = None, block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """Approximate k nearest rows by squared L2 distance to compressed codes."""
+    return blockwise_top_k(len(codes), len(queries), lambda start, stop: codec.distances(queries, codes[start:stop]),
+                           k, deleted, block_size)
+
+
+def default_local_dir(collection_name: str) -> str:
+    return os.path.join(".local_index", collection_name)
+
+
+class LocalVectorStore:
+    def __init__(self, directory: str, embedding_function, dim: int = 1536,
+                 index_type: str = "FLAT", M: int = 8, ef_construction: int = 64, ef: int = 64,
+                 block_size: int = 65536, storage: str = "float32", pq_m: int = 96, rerank: int = 0):
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.block_size = block_size
+        os.makedirs(directory, exist_ok=True)
+        self.config = {
+            "dim": dim, "count": 0, "deleted": [],
+            "index_type": index_type, "params": {"M": M, "efConstruction": ef_construction, "ef": ef},
+            # rerank: candidates fetched from the codes per result, 0 keeps the code order
+            "storage": storage, "pq_m": pq_m, "rerank": rerank,
+        }
+        if os.path.exists(self._path(CONFIG_FILE)):
+            with open(self._path(CONFIG_FILE), encoding="utf8") as f:
+                self.config = json.load(f)
+        self.dim = self.config["dim"]
+        self.storage = self.config.get("storage", "float32")
+        if self.storage != "float32" and self.config["index_type"] == "HNSW":
+            raise ValueError("Compressed storage is searched by scanning its codes, use index_type FLAT")
+        self.deleted = set(self.config["deleted"])
+        self._vectors = None
+        self._norms = None
+        self._records = None
+        self._hnsw = None
+        # Whether the open graph has nodes its saved copy lacks
+        self._hnsw_dirty = False
+        self._codec = None
+        self._codes = None
+
+    @classmethod
+    def create(cls, directory: str, embedding_function, drop_existing: bool = True, **kwargs):
+        """Open the store in directory, emptying it first if drop_existing."""
+        if drop_existing:
+            for name in (CONFIG_FILE, VECTORS_FILE, METADATA_FILE, HNSW_FILE, CODES_FILE, CODEC_FILE):
+                path = os.path.join(directory, name)
+                if os.path.exists(path):
+                    os.remove(path)
+        store = cls(directory, embedding_function, **kwargs)
+        store._save_config()
+        return store
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _save_config(self):
+        self.config["deleted"] = sorted(self.deleted)
+        tmp_path = self._path(CONFIG_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.config, f)
+        os.replace(tmp_path, self._path(CONFIG_FILE))
+
+    def __len__(self):
+        return self.config["count"] - len(self.deleted)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            count = self.config["count"]
+            if count == 0:
+                self._vectors = np.empty((0, self.dim), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(self._path(VECTORS_FILE), dtype=np.float32,
+                                          mode="r", shape=(count, self.dim))
+        return self._vectors
+
+    @property
+    def codec(self):
+        if self._codec is None and os.path.exists(self._path(CODEC_FILE)):
+            self._codec = load_codec(self.storage, self.dim, self._path(CODEC_FILE), self.config["pq_m"])
+        return self._codec
+
+    @property
+    def codes(self) -> np.ndarray:
+        if self._codes is None:
+            codec = self.codec
+            self._codes = np.memmap(self._path(CODES_FILE), dtype=codec.code_dtype, mode="r",
+                                    shape=(self.config["count"], codec.code_width))
+        return self._codes
+
+    def nbytes(self) -> int:
+        """Bytes scanned by a search: the codes, or the float32 vectors without compression."""
+        if self.storage == "float32":
+            return self.config["count"] * self.dim * 4
+        return self.config["count"] * self.codec.code_width * np.dtype(self.codec.code_dtype).itemsize
+
+    @property
+    def records(self) -> List[dict]:
+        if self._records is None:
+            self._records = []
+            if os.path.exists(self._path(METADATA_FILE)):
+                with open(self._path(METADATA_FILE), encoding="utf8") as f:
+                    self._records = [json.loads(line) for line in f]
+        return self._records
+
+    def _invalidate(self):
+        self._vectors = None
+        self._norms = None
+        self._records = None
+        self._codes = None
+
+    def add_vectors(self, vectors, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[int]:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        metadatas = metadatas or [{} for _ in texts]
+        start = self.config["count"]
+        ids = list(range(start, start + len(texts)))
+        self._discard_partial_write(start)
+        graph = None
+        if self.config["index_type"] == "HNSW" and (self._hnsw is not None or os.path.exists(self._path(HNSW_FILE))):
+            graph = self._graph()
+        with open(self._path(VECTORS_FILE), "ab") as f:
+            f.write(vectors.tobytes())
+        if self.storage != "float32" and self.codec is not None:
+            # Codes follow the vectors once the codec is trained, see build_index
+            with open(self._path(CODES_FILE), "ab") as f:
+                f.write(self.codec.encode(vectors).tobytes())
+        with open(self._path(METADATA_FILE), "a", encoding="utf8") as f:
+            for text, metadata in zip(texts, metadatas):
+                f.write(json.dumps({"text": text, "metadata": metadata}) + "\n")
+        self.config["count"] = start + len(texts)
+        self._save_config()
+        self._invalidate()
+        if graph is not None:
+            # Extend the open graph instead of rebuilding it, build_index saves it once
+            graph.add(vectors)
+            self._hnsw_dirty = True
+        return ids
+
+    def _graph(self) -> HNSWIndex:
+        # Loaded once and then kept up to date by add_vectors
+        if self._hnsw is None:
+            self._hnsw = HNSWIndex.load(self._path(HNSW_FILE), self.vectors)
+            if self._hnsw.rows < self.config["count"]:
+                # Rows added by a run that stopped before build_index saved the graph
+                self._hnsw.add(self.vectors[self._hnsw.rows:])
+                self._hnsw_dirty = True
+        return self._hnsw
+
+    def _discard_partial_write(self, count: int) -> None:
+        # A process killed inside add_vectors leaves rows past the saved count
+        # in the data files; drop them so appended rows line up with their ids
+        path = self._path(VECTORS_FILE)
+        if not os.path.exists(path) or os.path.getsize(path) <= count * self.dim * 4:
+            return
+        with open(path, "r+b") as f:
+            f.truncate(count * self.dim * 4)
+        if os.path.exists(self._path(CODES_FILE)) and self.codec is not None:
+            with open(self._path(CODES_FILE), "r+b") as f:
+                f.truncate(count * self.codec.code_width * np.dtype(self.codec.code_dtype).itemsize)
+        if os.path.exists(self._path(METADATA_FILE)):
+            with open(self._path(METADATA_FILE), encoding="utf8") as f:
+                lines = [line for line, _ in zip(f, range(count))]
+            with open(self._path(METADATA_FILE), "w", encoding="utf8") as f:
+                f.writelines(lines)
+        self._invalidate()
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None) -> List[int]:
+        texts = list(texts)
+        if not texts:
+            return []
+        vectors = self.embedding_function.embed_documents(texts)
+        with METRICS.timer("insert"):
+            return self.add_vectors(vectors, texts, metadatas)
+
+    def add_documents(self, documents: List) -> List[int]:
+        return self.add_texts([d.page_content for d in documents],
+                              [d.metadata for d in documents])
+
+    def delete(self, ids: Iterable[int]) -> None:
+        self.deleted.update(int(i) for i in ids)
+        self._save_config()
+
+    def build_index(self, rebuild: bool = False) -> None:
+        """Build the HNSW graph or the codes over all stored vectors, unless already kept up to date."""
+        if self.storage != "float32":
+            self._build_codes(rebuild)
+            return
+        if self.config["index_type"] != "HNSW":
+            return
+        if os.path.exists(self._path(HNSW_FILE)) and not rebuild:
+            graph = self._graph()
+            if graph.tombstones(self.deleted) <= MAX_DELETED_RATIO * len(graph):
+                if self._hnsw_dirty:
+                    graph.save(self._path(HNSW_FILE))
+                    self._hnsw_dirty = False
+                return
+        params = self.config["params"]
+        self._hnsw = HNSWIndex(params["M"], params["efConstruction"], params["ef"]).build(self.vectors, self.deleted)
+        self._hnsw.save(self._path(HNSW_FILE))
+        self._hnsw_dirty = False
+
+    def _build_codes(self, rebuild: bool) -> None:
+        if os.path.exists(self._path(CODES_FILE)) and not rebuild:
+            return
+        # Calibrate on a sample, then encode everything block by block
+        codec = make_codec(self.storage, self.dim, self.config["pq_m"]).train(training_sample(self.vectors))
+        tmp_path = self._path(CODES_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            for start in range(0, self.config["count"], self.block_size):
+                f.write(codec.encode(self.vectors[start:start + self.block_size]).tobytes())
+        save_codec(codec, self._path(CODEC_FILE))
+        os.replace(tmp_path, self._path(CODES_FILE))
+        self._codec = codec
+        self._codes = None
+
+    def _deleted_array(self) -> Optional[np.ndarray]:
+        return np.fromiter(self.deleted, dtype=np.int64) if self.deleted else None
+
+    def _exact_search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        vectors = self.vectors
+        if self._norms is None:
+            self._norms = np.einsum("ij,ij->i", vectors, vectors)
+        return exact_search(vectors, queries, k, self._norms, self._deleted_array(), self.block_size)
+
+    def _codes_search(self, queries: np.ndarray, k: int, rerank_factor: int) -> Tuple[np.ndarray, np.ndarray]:
+        if not os.path.exists(self._path(CODES_FILE)):
+            self.build_index()
+        deleted = self._deleted_array()
+        if not rerank_factor:
+            return codes_search(self.codec, self.codes, queries, k, deleted, self.block_size)
+        # Shortlist from the codes, exact order from the float32 vectors on disk
+        candidates, _ = codes_search(self.codec, self.codes, queries, k * rerank_factor, deleted, self.block_size)
+        return rerank(self.vectors, queries, candidates, k)
+
+    def _hnsw_search(self, queries: np.ndarray, k: int, ef: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        if self._hnsw is None and not os.path.exists(self._path(HNSW_FILE)):
+            self.build_index()
+        graph = self._graph()
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            found_ids, found_dists = graph.search(query, k, ef, self.deleted)
+            ids[row, :len(found_ids)] = found_ids
+            dists[row, :len(found_ids)] = found_dists
+        return ids, dists
+
+    def search_vectors(self, queries, k: int = 4, ef: Optional[int] = None,
+                       rerank: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search many query vectors at once; returns (ids, squared L2 distances), -1 pads missing hits.
+
+        rerank overrides the store's re-ranking factor for compressed storage.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self.config["count"] == 0:
+            return (np.full((len(queries), k), -1, dtype=np.int64),
+                    np.full((len(queries), k), np.inf, dtype=np.float32))
+        if self.config["index_type"] == "HNSW":
+            return self._hnsw_search(queries, k, ef)
+        if self.storage != "float32":
+            ids, dists = self._codes_search(queries, k, self.config["rerank"] if rerank is None else rerank)
+        else:
+            ids, dists = self._exact_search(queries, k)
+        if ids.shape[1] < k:
+            pad = k - ids.shape[1]
+            ids = np.pad(ids, ((0, 0), (0, pad)), constant_values=-1)
+            dists = np.pad(dists, ((0, 0), (0, pad)), constant_values=np.inf)
+        return ids, dists
+
+    def documents(self, ids: Iterable[int]) -> List:
+        from langchain.docstore.document import Document
+        records = self.records
+        return [Document(page_content=records[i]["text"], metadata=records[i]["metadata"])
+                for i in ids if i >= 0]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs) -> List:
+        ids, _ = self.search_vectors([embedding], k, kwargs.get("ef"), kwargs.get("rerank"))
+        return self.documents(ids[0].tolist())
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k, **kwargs)
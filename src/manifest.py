@@ -0,0 +1,198 @@
+# Per-file manifest for incremental indexing.
+# Tracks file path -> content hash -> ids of the chunks stored in the backend,
+# so a re-run only touches files that were added, changed or removed.
+# For a git source it also keeps the last indexed commit.
+# Incremental runs append one record per file to a log next to the manifest,
+# which is folded into the JSON manifest once at the end of the run.
+
+import os
+import json
+import hashlib
+from typing import Callable, Iterable, List, Optional, Set
+
+
+def default_manifest_path(name: str) -> str:
+    return os.path.join(".index_manifest", f"{name}.json")
+
+
+def file_hash(file_path: str) -> str:
+    """sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.files = {}
+        self.commit = None
+        # File whose chunks were being stored when the last run stopped
+        self.pending = None
+        if os.path.exists(path):
+            with open(path, encoding="utf8") as f:
+                state = json.load(f)
+            self.files = state["files"]
+            self.commit = state.get("commit")
+            self.pending = state.get("pending")
+        if os.path.exists(self.log_path):
+            self._replay()
+
+    @property
+    def log_path(self) -> str:
+        return self.path + ".log"
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(self.log_path)
+
+    def _replay(self) -> None:
+        with open(self.log_path, encoding="utf8") as f:
+            lines = f.read().splitlines()
+        for number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if number == len(lines) - 1:
+                    # The process died while appending
+                    break
+                raise
+            if "pending" in record:
+                self.pending = record["pending"]
+                continue
+            if record.get("removed"):
+                self.forget(record["path"])
+            else:
+                self.record(record["path"], record["hash"], record["ids"])
+            if record["path"] == self.pending:
+                self.pending = None
+
+    def _append(self, record: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.log_path, "a", encoding="utf8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def plan(self, paths: Iterable[str], candidates: Optional[Set[str]] = None):
+        """Split paths into (changed, removed).
+
+        changed is a list of (path, content_hash) for new or modified files,
+        removed lists manifest entries whose file is no longer present. If
+        candidates is given, files already in the manifest are only hashed
+        if they are candidates (e.g. changed since the last indexed commit).
+        """
+        seen = set()
+        changed = []
+        for path in paths:
+            seen.add(path)
+            if candidates is not None and path not in candidates and path in self.files:
+                continue
+            content_hash = file_hash(path)
+            entry = self.files.get(path)
+            if entry is None or entry["hash"] != content_hash:
+                changed.append((path, content_hash))
+        removed = [path for path in self.files if path not in seen]
+        return changed, removed
+
+    def ids(self, path: str) -> List:
+        entry = self.files.get(path)
+        return entry["ids"] if entry else []
+
+    def record(self, path: str, content_hash: str, ids: List) -> None:
+        self.files[path] = {"hash": content_hash, "ids": list(ids)}
+
+    def forget(self, path: str) -> None:
+        self.files.pop(path, None)
+
+    def log_start(self, path: str) -> None:
+        """Note that path's chunks are about to be stored."""
+        self.pending = path
+        self._append({"pending": path})
+
+    def log_record(self, path: str, content_hash: Optional[str], ids: List) -> None:
+        self.record(path, content_hash, ids)
+        if path == self.pending:
+            self.pending = None
+        self._append({"path": path, "hash": content_hash, "ids": list(ids)})
+
+    def log_forget(self, path: str) -> None:
+        self.forget(path)
+        self._append({"path": path, "removed": True})
+
+    def recover(self, find_ids: Callable[[List[str]], List]) -> None:
+        """Record the chunks stored for the pending file, so the next sync deletes them.
+
+        find_ids(sources) returns the ids of the stored chunks of those files.
+        Without a hash the file counts as changed, or as removed if it is gone.
+        """
+        if self.pending is not None:
+            self.log_record(self.pending, None, find_ids([self.pending]))
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump({"files": self.files, "commit": self.commit, "pending": self.pending}, f)
+        os.replace(tmp_path, self.path)
+        # Everything the log recorded is in the manifest now
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def rebuild(self, paths: Iterable[str], ids: Callable[[str], List], commit: Optional[str] = None) -> None:
+        """Record every file of a full run with the ids of its chunks, and save."""
+        self.files = {}
+        for path in paths:
+            self.record(path, file_hash(path), ids(path))
+        self.commit = commit
+        self.save()
+
+    def clear(self) -> None:
+        self.files = {}
+        self.commit = None
+        self.pending = None
+        for path in (self.path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def sync_files(manifest: Manifest, paths: Iterable[str],
+               index_file: Callable[[str], List], delete_ids: Callable[[List], None],
+               candidates: Optional[Set[str]] = None, find_ids: Optional[Callable[[List[str]], List]] = None):
+    """Bring a backend in line with paths, touching only what changed.
+
+    index_file(path) loads, splits and stores one file and returns the ids of
+    its chunks; delete_ids(ids) removes chunks from the backend. Every file is
+    logged as it completes and the manifest saved once at the end, so an
+    interrupted run loses at most one file. find_ids(sources) finds the chunks
+    stored for a file that failed partway, which would otherwise be orphaned.
+    candidates limits which known files are checked, see Manifest.plan.
+    Returns (number of files indexed, number of files removed).
+    """
+    if find_ids is not None:
+        # The chunks of a file the last run died in, see Manifest.recover
+        manifest.recover(find_ids)
+    changed, removed = manifest.plan(paths, candidates)
+    try:
+        for path in removed:
+            print(f"Removing {path}...")
+            stale = manifest.ids(path)
+            if stale:
+                delete_ids(stale)
+            manifest.log_forget(path)
+        for path, content_hash in changed:
+            print(f"Processing {path}...")
+            stale = manifest.ids(path)
+            if stale:
+                delete_ids(stale)
+            manifest.log_start(path)
+            try:
+                ids = index_file(path)
+            except Exception:
+                if find_ids is not None:
+                    manifest.recover(find_ids)
+                raise
+            manifest.log_record(path, content_hash, ids)
+    finally:
+        manifest.save()
+    return len(changed), len(removed)
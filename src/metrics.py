@@ -0,0 +1,254 @@
+# Instrumentation of the indexing and query pipelines.
+# A process-wide registry (METRICS) of stage timings with histograms, counters
+# (files, bytes, chunks, tokens, retries, cache hits...) and distributions of
+# values such as batch sizes. The pipeline, embedding and storage code records
+# into it; instrumented() prints a summary at the end of a run and can write it
+# as JSON or in the Prometheus text format, and profile the run on request.
+
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, Sequence
+
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # counts[i] observations <= buckets[i], the last one above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def cumulative(self):
+        """[(upper bound, observations <= it)], ending with +Inf."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def summary(self) -> dict:
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+                "min": self.min, "max": self.max,
+                "buckets": {("+Inf" if bound == float("inf") else str(bound)): count
+                            for bound, count in self.cumulative()}}
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = Counter()
+        self.values = {}
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.setdefault(stage, Histogram(TIME_BUCKETS)).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self.values.setdefault(name, Histogram(SIZE_BUCKETS)).observe(value)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "elapsed_seconds": round(time.perf_counter() - self.started, 3),
+                "stages": {stage: histogram.summary() for stage, histogram in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "values": {name: histogram.summary() for name, histogram in sorted(self.values.items())},
+            }
+
+    def report(self) -> str:
+        """Human readable table of the stages and counters."""
+        summary = self.summary()
+        lines = [f"{'stage':<22} {'count':>8} {'total s':>10} {'mean ms':>10} {'max ms':>10}"]
+        for stage, stats in summary["stages"].items():
+            lines.append(f"{stage:<22} {stats['count']:>8} {stats['sum']:>10.3f} "
+                         f"{stats['mean'] * 1000:>10.2f} {(stats['max'] or 0) * 1000:>10.2f}")
+        for name, stats in summary["values"].items():
+            lines.append(f"{name}: mean {stats['mean']:.1f}, max {stats['max']} over {stats['count']}")
+        if summary["counters"]:
+            lines.append(", ".join(f"{name}={value:g}" for name, value in summary["counters"].items()))
+        return "\n".join(lines)
+
+    def prometheus(self, prefix: str = "qagpt") -> str:
+        """Everything in the Prometheus text exposition format."""
+        with self._lock:
+            lines = []
+            if self.stages:
+                lines += [f"# HELP {prefix}_stage_seconds Time spent per call of a pipeline stage.",
+                          f"# TYPE {prefix}_stage_seconds histogram"]
+                for stage, histogram in sorted(self.stages.items()):
+                    lines += _histogram_lines(f"{prefix}_stage_seconds", histogram, f'stage="{stage}"')
+            for name, histogram in sorted(self.values.items()):
+                lines += [f"# TYPE {prefix}_{name} histogram"]
+                lines += _histogram_lines(f"{prefix}_{name}", histogram)
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value:g}"]
+            return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.perf_counter()
+            self.stages.clear()
+            self.counters.clear()
+            self.values.clear()
+
+
+def _histogram_lines(metric, histogram, labels=""):
+    separator = "," if labels else ""
+    lines = [f'{metric}_bucket{{{labels}{separator}le="{"+Inf" if bound == float("inf") else bound}"}} {count}'
+             for bound, count in histogram.cumulative()]
+    suffix = f"{{{labels}}}" if labels else ""
+    lines += [f"{metric}_sum{suffix} {histogram.sum:.6f}", f"{metric}_count{suffix} {histogram.count}"]
+    return lines
+
+
+METRICS = Metrics()
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread, e.g. the indexers' writer threads that cProfile doesn't see."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        # (file, line, function) -> samples where it was running / anywhere on the stack
+        self.own = Counter()
+        self.total = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "SamplingProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if leaf:
+                        self.own[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        self.total[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+
+    def report(self, top: int = 30) -> str:
+        samples = self.samples or 1
+        lines = [f"{self.samples} samples every {self.interval * 1000:g}ms over all threads "
+                 "(waiting on locks and I/O counts as running)",
+                 f"{'own %':>7} {'total %':>8}  function"]
+        for key, own in self.own.most_common(top):
+            filename, line, name = key
+            lines.append(f"{100 * own / samples:>7.2f} {100 * self.total[key] / samples:>8.2f}  "
+                         f"{name} ({filename}:{line})")
+        return "\n".join(lines)
+
+
+@contextmanager
+def profiled(path: Optional[str], mode: str = "sample", top: int = 30, file=None):
+    """Profile the block: sample all threads, or cProfile the calling thread; write the result to path."""
+    if not path:
+        yield
+        return
+    if mode == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+            print(f"Wrote cProfile stats to {path}, hottest functions:", file=file)
+            pstats.Stats(profile, stream=file or sys.stdout).sort_stats("cumulative").print_stats(top)
+        return
+    profiler = SamplingProfiler().start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        report = profiler.report(top)
+        with open(path, "w", encoding="utf8") as f:
+            f.write(report + "\n")
+        print(f"Wrote sampling profile to {path}, hottest functions:", file=file)
+        print("\n".join(report.splitlines()[:12]), file=file)
+
+
+@contextmanager
+def instrumented(metrics_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+                 profile_path: Optional[str] = None, profile_mode: str = "sample", file=None):
+    """Run a command line entry point, then report what METRICS recorded (printed to file, stdout by default)."""
+    try:
+        with profiled(profile_path, profile_mode, file=file):
+            yield METRICS
+    finally:
+        print(METRICS.report(), file=file)
+        if metrics_path:
+            with open(metrics_path, "w", encoding="utf8") as f:
+                json.dump(METRICS.summary(), f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, "w", encoding="utf8") as f:
+                f.write(METRICS.prometheus())
+
+
+def add_arguments(parser) -> None:
+    """The instrumentation options shared by the command line tools."""
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write stage timings, counters and batch size histograms to this JSON file.')
+    parser.add_argument('--prometheus', type=str, default=None,
+                        help='Write the same metrics in the Prometheus text format (e.g. for the node_exporter textfile collector).')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Profile the run and write the hottest functions to this file.')
+    parser.add_argument('--profile_mode', type=str, default="sample", choices=["sample", "cprofile"],
+                        help='Sample the stacks of all threads, or cProfile the main thread (pstats dump).')
@@ -0,0 +1,77 @@
+# Schema of the Milvus collections written by index_documents.py.
+# Kept apart from the indexer so the query path (similar_search.py, the
+# retrieval server, backends.py) can use the field names without importing
+# the loaders, the splitters and their dependencies.
+
+text_field = "text"
+primary_field = "pk"
+vector_field = "vector"
+# Size of the Milvus text field, the token splitter keeps chunks below it
+text_max_length = 2500
+sources_max_length = 2000
+
+
+def milvus_sources(metadata):
+    # sources is a newline separated VARCHAR, holding as many whole paths as fit in the field
+    sources = metadata.get("sources") or [metadata.get("source", "")]
+    joined = ""
+    for source in sources:
+        candidate = f"{joined}\n{source}" if joined else source
+        if len(candidate.encode("utf-8")) > sources_max_length:
+            break
+        joined = candidate
+    return joined
+
+
+def milvus_index_params(storage="float32", nlist=1024, pq_m=96):
+    # Compressed storage maps to Milvus' quantized IVF indexes; the raw vectors
+    # stay in the collection's segments, so results can be re-ranked against them
+    if storage == "int8":
+        return {"index_type": "IVF_SQ8", "metric_type": "L2", "params": {"nlist": nlist}}
+    if storage == "pq":
+        return {"index_type": "IVF_PQ", "metric_type": "L2", "params": {"nlist": nlist, "m": pq_m, "nbits": 8}}
+    if storage == "float16":
+        raise ValueError("Milvus FLOAT_VECTOR fields are float32, use --storage int8 or pq with Milvus")
+    return {"index_type": "HNSW", "metric_type": "L2", "params": {"M": 8, "efConstruction": 64}}
+
+
+def open_milvus_collection(collection_name, host, port, drop_existing=True, index=None, build_index=True):
+    """pymilvus Collection with the fields above, created unless it exists and drop_existing is False."""
+    from pymilvus import FieldSchema, DataType, CollectionSchema, Collection, connections, utility
+
+    # Connect to Milvus instance
+    if not connections.has_connection("default"):
+        connections.connect(host=host, port=port)
+    if not drop_existing and utility.has_collection(collection_name):
+        # Keep the existing collection and its data
+        return Collection(collection_name)
+    utility.drop_collection(collection_name)
+    # Create the collection in Milvus
+    fields = []
+    # Create the metadata field
+    fields.append(
+        FieldSchema('source', DataType.VARCHAR, max_length=200)
+    )
+    # Every file a deduplicated chunk was found in
+    fields.append(
+        FieldSchema('sources', DataType.VARCHAR, max_length=sources_max_length)
+    )
+    # Create the text field
+    fields.append(
+        FieldSchema(text_field, DataType.VARCHAR, max_length=text_max_length)
+    )
+    # Create the primary key field
+    fields.append(
+        FieldSchema(primary_field, DataType.INT64,
+                    is_primary=True, auto_id=True)
+    )
+    # Create the vector field
+    fields.append(FieldSchema(vector_field, DataType.FLOAT_VECTOR, dim=1536))
+    # Create the schema for the collection
+    schema = CollectionSchema(fields)
+    # Create the collection
+    collection = Collection(collection_name, schema)
+    if build_index:
+        # Create the index
+        collection.create_index(vector_field, index or milvus_index_params())
+    return collection
@@ -0,0 +1,150 @@
+# Streaming load -> split -> embed -> upsert pipeline.
+# Documents and chunks are produced lazily by generators and written in
+# bounded batches, so memory stays flat regardless of the corpus size.
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List
+
+from metrics import METRICS
+
+
+def iter_documents(paths: Iterable[str], load_fn: Callable[[str], List]) -> Iterator:
+    """Yield the documents of each file in turn."""
+    for path in paths:
+        print(f"Processing {path}...")
+        with METRICS.timer("load"):
+            documents = load_fn(path)
+        _count_file(path)
+        yield from documents
+
+
+def iter_chunks(documents: Iterable, split_fn: Callable[[List], List]) -> Iterator:
+    """Split documents one at a time and yield their chunks."""
+    for document in documents:
+        with METRICS.timer("split"):
+            chunks = split_fn([document])
+        _count_chunks(chunks)
+        yield from chunks
+
+
+def _count_file(path):
+    METRICS.count("files")
+    METRICS.count("input_bytes", os.path.getsize(path))
+
+
+def _count_chunks(chunks):
+    METRICS.count("chunks", len(chunks))
+    METRICS.count("chunk_characters", sum(len(chunk.page_content) for chunk in chunks))
+
+
+def _load_and_split(path, load_fn, split_fn):
+    # Timed in the worker, recorded by the parent process
+    started = time.perf_counter()
+    documents = load_fn(path)
+    loaded = time.perf_counter()
+    chunks = split_fn(documents)
+    return chunks, loaded - started, time.perf_counter() - loaded
+
+
+def _record_file(path, result):
+    chunks, load_seconds, split_seconds = result
+    print(f"Processing {path}...")
+    METRICS.observe_stage("load", load_seconds)
+    METRICS.observe_stage("split", split_seconds)
+    _count_file(path)
+    _count_chunks(chunks)
+    return chunks
+
+
+def iter_chunks_parallel(paths: Iterable[str], load_fn: Callable[[str], List],
+                         split_fn: Callable[[List], List], workers: int,
+                         prefetch: int = None) -> Iterator:
+    """Load and split files on a process pool, yielding chunks in path order.
+
+    load_fn and split_fn must be picklable (module level functions or
+    functools.partial of them). At most prefetch files are in flight, so a
+    slow consumer holds back the workers instead of piling up results.
+    """
+    prefetch = prefetch or workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(_load_and_split, path, load_fn, split_fn)))
+            if len(pending) >= prefetch:
+                done_path, future = pending.popleft()
+                yield from _record_file(done_path, future.result())
+        while pending:
+            done_path, future = pending.popleft()
+            yield from _record_file(done_path, future.result())
+
+
+def iter_file_chunks(paths: Iterable[str], load_fn: Callable[[str], List],
+                     split_fn: Callable[[List], List], workers: int = 1) -> Iterator:
+    """Chunks of every file in path order, serially or across workers processes."""
+    if workers > 1:
+        return iter_chunks_parallel(paths, load_fn, split_fn, workers)
+    return iter_chunks(iter_documents(paths, load_fn), split_fn)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+_DONE = object()
+
+
+def index_stream(chunks: Iterable, add_fn: Callable[[List], object],
+                 batch_size: int = 64, max_pending: int = 2) -> int:
+    """Write chunks through add_fn in batches of batch_size.
+
+    Batches are handed to a writer thread through a queue holding at most
+    max_pending batches: loading and splitting the next batch overlaps with
+    embedding and inserting the current one, and the producer blocks when
+    the writer falls behind. Returns the number of chunks written.
+    """
+    pending = queue.Queue(maxsize=max_pending)
+    errors = []
+
+    def writer():
+        while True:
+            batch = pending.get()
+            if batch is _DONE:
+                return
+            if errors:
+                # Drain the queue so the producer never blocks forever
+                continue
+            try:
+                with METRICS.timer("write"):
+                    add_fn(batch)
+                METRICS.observe("write_batch_size", len(batch))
+            except BaseException as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    count = 0
+    try:
+        for batch in batched(chunks, batch_size):
+            if errors:
+                break
+            # Time blocked here means the writer (embedding and inserts) is the bottleneck
+            with METRICS.timer("wait_for_writer"):
+                pending.put(batch)
+            count += len(batch)
+    finally:
+        pending.put(_DONE)
+        thread.join()
+    if errors:
+        raise errors[0]
+    return count
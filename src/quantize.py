@@ -0,0 +1,190 @@
+# Compressed vector codes for the local store and the retrieval benchmark.
+# float16 halves the float32 vectors, int8 scalar quantization stores one byte
+# per dimension using a per-dimension range calibrated on the data, and product
+# quantization stores one byte per subspace of dim / m dimensions (k-means
+# codebooks of 256 centroids). Distances are squared L2 against the codes;
+# PQ uses asymmetric distance tables so codes are never decoded.
+
+from typing import Optional
+
+import numpy as np
+
+from ivf import kmeans
+
+
+STORAGE_MODES = ["float32", "float16", "int8", "pq"]
+
+
+class Float16Codec:
+    name = "float16"
+    code_dtype = np.float16
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.code_width = dim
+        self.trained = True
+
+    def train(self, vectors: np.ndarray) -> "Float16Codec":
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(codes, dtype=np.float32)
+
+    def distances(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        block = self.decode(codes)
+        return (np.einsum("ij,ij->i", queries, queries)[:, None] - 2 * queries @ block.T
+                + np.einsum("ij,ij->i", block, block))
+
+    def state(self) -> dict:
+        return {}
+
+    def load_state(self, state: dict) -> None:
+        pass
+
+
+class ScalarInt8Codec(Float16Codec):
+    name = "int8"
+    code_dtype = np.uint8
+
+    def __init__(self, dim: int, clip: float = 0.001):
+        super().__init__(dim)
+        # Fraction of values clipped at each end of every dimension's range
+        self.clip = clip
+        self.low = None
+        self.scale = None
+        self.trained = False
+
+    def train(self, vectors: np.ndarray) -> "ScalarInt8Codec":
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.low = np.quantile(vectors, self.clip, axis=0).astype(np.float32)
+        high = np.quantile(vectors, 1 - self.clip, axis=0).astype(np.float32)
+        self.scale = np.maximum(high - self.low, 1e-12) / 255
+        self.trained = True
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.low + codes.astype(np.float32) * self.scale
+
+    def state(self) -> dict:
+        return {"low": self.low, "scale": self.scale}
+
+    def load_state(self, state: dict) -> None:
+        self.low, self.scale = state["low"], state["scale"]
+        self.trained = True
+
+
+class ProductQuantizer:
+    name = "pq"
+    code_dtype = np.uint8
+
+    def __init__(self, dim: int, m: int = 96, ksub: int = 256, iterations: int = 10):
+        if dim % m:
+            raise ValueError(f"dim ({dim}) must be a multiple of the number of PQ subspaces ({m})")
+        self.dim = dim
+        self.m = m
+        self.dsub = dim // m
+        self.ksub = ksub
+        self.iterations = iterations
+        self.code_width = m
+        self.centroids = None
+        self.trained = False
+
+    def _split(self, vectors):
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.m, self.dsub)
+
+    def train(self, vectors: np.ndarray) -> "ProductQuantizer":
+        sub = self._split(vectors)
+        # One codebook per subspace; fewer centroids if there are fewer vectors
+        ksub = min(self.ksub, len(vectors))
+        self.centroids = np.stack([kmeans(sub[:, j], ksub, self.iterations, seed=j)
+                                   for j in range(self.m)])
+        self.trained = True
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        sub = self._split(vectors)
+        codes = np.empty((len(sub), self.m), dtype=np.uint8)
+        norms = np.einsum("jkd,jkd->jk", self.centroids, self.centroids)
+        for j in range(self.m):
+            dists = norms[j] - 2 * sub[:, j] @ self.centroids[j].T
+            codes[:, j] = np.argmin(dists, axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.centroids[np.arange(self.m), codes].reshape(len(codes), self.dim)
+
+    def distances(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        sub = self._split(queries)
+        # tables[q, j, c] = ||query q's subvector j - centroid c of subspace j||^2
+        diff = sub[:, :, None, :] - self.centroids[None]
+        tables = np.einsum("qjcd,qjcd->qjc", diff, diff)
+        columns = np.arange(self.m)
+        return np.stack([table[columns, codes].sum(axis=1) for table in tables])
+
+    def state(self) -> dict:
+        return {"centroids": self.centroids}
+
+    def load_state(self, state: dict) -> None:
+        self.centroids = state["centroids"]
+        self.m, self.ksub, self.dsub = self.centroids.shape
+        self.code_width = self.m
+        self.trained = True
+
+
+def make_codec(storage: str, dim: int, pq_m: int = 96):
+    """Codec for a storage mode, None for full float32 vectors."""
+    if storage == "float32":
+        return None
+    if storage == "float16":
+        return Float16Codec(dim)
+    if storage == "int8":
+        return ScalarInt8Codec(dim)
+    if storage == "pq":
+        return ProductQuantizer(dim, pq_m)
+    raise ValueError(f"Unknown storage mode {storage}, expected one of {STORAGE_MODES}")
+
+
+def save_codec(codec, path: str) -> None:
+    with open(path, "wb") as f:
+        np.savez(f, **codec.state())
+
+
+def load_codec(storage: str, dim: int, path: str, pq_m: int = 96):
+    codec = make_codec(storage, dim, pq_m)
+    with np.load(path) as state:
+        codec.load_state(dict(state))
+    return codec
+
+
+def training_sample(vectors: np.ndarray, sample_size: int = 100_000, seed: int = 0) -> np.ndarray:
+    if len(vectors) <= sample_size:
+        return np.asarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.default_rng(seed).choice(len(vectors), sample_size, replace=False))
+    return np.asarray(vectors[rows], dtype=np.float32)
+
+
+def rerank(vectors: np.ndarray, queries: np.ndarray, candidates: np.ndarray, k: int,
+           deleted: Optional[np.ndarray] = None):
+    """Exact top-k among candidate ids (-1 padded) using full-precision vectors, e.g. on disk."""
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+    for row, (query, row_candidates) in enumerate(zip(queries, candidates)):
+        row_candidates = np.unique(row_candidates[row_candidates >= 0])
+        if deleted is not None:
+            row_candidates = row_candidates[~np.isin(row_candidates, deleted)]
+        if not len(row_candidates):
+            continue
+        # Sorted ids read the memory-mapped file front to back
+        diff = np.asarray(vectors[row_candidates], dtype=np.float32) - query
+        exact = np.einsum("ij,ij->i", diff, diff)
+        top = np.argsort(exact)[:k]
+        ids[row, :len(top)] = row_candidates[top]
+        dists[row, :len(top)] = exact[top]
+    return ids, dists
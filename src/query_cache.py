@@ -0,0 +1,204 @@
+# Two-level cache for the retrieval path.
+# Level 1 maps a normalized question to its embedding, level 2 maps
+# (collection, collection version, embedding, k, search mode) to the top-k results. Both
+# are bounded LRU maps with a TTL. Indexers bump the collection version after
+# writing, which makes every cached result for that collection unreachable.
+# An optional Redis tier lets several retrieval workers share hits.
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+VERSION_PREFIX = "qagpt:version:"
+CACHE_PREFIX = "qagpt:qcache:"
+
+
+def normalize_question(question: str) -> str:
+    """Case- and whitespace-insensitive form of a question, without trailing punctuation."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class TTLCache:
+    """Thread-safe LRU map whose entries expire ttl seconds after being stored."""
+
+    def __init__(self, max_entries: int = 10_000, ttl: Optional[float] = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CollectionVersions:
+    """Version counter per collection, in a local directory or in Redis.
+
+    location is a directory path or a redis:// URL. Reads are cached for
+    refresh_interval seconds so lookups stay cheap on the query path.
+    """
+
+    def __init__(self, location: str = ".collection_versions", refresh_interval: float = 1.0):
+        self.location = location
+        self.refresh_interval = refresh_interval
+        self._client = None
+        self._seen = {}
+        if location.startswith(("redis://", "rediss://")):
+            import redis
+            self._client = redis.from_url(location)
+        else:
+            os.makedirs(location, exist_ok=True)
+
+    def _path(self, collection_name):
+        return os.path.join(self.location, f"{collection_name}.version")
+
+    def _read(self, collection_name) -> int:
+        if self._client is not None:
+            return int(self._client.get(VERSION_PREFIX + collection_name) or 0)
+        try:
+            with open(self._path(collection_name), encoding="utf8") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def get(self, collection_name: str) -> int:
+        seen = self._seen.get(collection_name)
+        now = time.monotonic()
+        if seen is None or now - seen[0] > self.refresh_interval:
+            seen = (now, self._read(collection_name))
+            self._seen[collection_name] = seen
+        return seen[1]
+
+    def bump(self, collection_name: str) -> int:
+        """Record that collection_name was rewritten; returns the new version."""
+        if self._client is not None:
+            version = int(self._client.incr(VERSION_PREFIX + collection_name))
+        else:
+            version = self._read(collection_name) + 1
+            tmp_path = self._path(collection_name) + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                f.write(str(version))
+            os.replace(tmp_path, self._path(collection_name))
+        self._seen[collection_name] = (time.monotonic(), version)
+        return version
+
+
+def bump_collection_version(collection_name: str, location: Optional[str]) -> None:
+    # Called by the indexers once a collection has been written
+    if location:
+        version = CollectionVersions(location).bump(collection_name)
+        print(f"Collection {collection_name} is now at version {version}.")
+
+
+class RedisTier:
+    """Shared second tier: JSON values under qagpt:qcache: keys with a Redis TTL."""
+
+    def __init__(self, url: str, ttl: Optional[float] = 3600):
+        import redis
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str):
+        value = self.client.get(CACHE_PREFIX + key)
+        return json.loads(value) if value is not None else None
+
+    def put(self, key: str, value) -> None:
+        # Milliseconds, a TTL under a second would round to the invalid EX 0
+        self.client.set(CACHE_PREFIX + key, json.dumps(value),
+                        px=max(1, int(self.ttl * 1000)) if self.ttl else None)
+
+
+def _digest(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+class QueryCache:
+    def __init__(self, versions: CollectionVersions, max_entries: int = 10_000,
+                 embedding_ttl: Optional[float] = 24 * 3600, result_ttl: Optional[float] = 3600,
+                 redis_url: Optional[str] = None):
+        self.versions = versions
+        self.embeddings = TTLCache(max_entries, embedding_ttl)
+        self.results = TTLCache(max_entries, result_ttl)
+        self.redis_embeddings = RedisTier(redis_url, embedding_ttl) if redis_url else None
+        self.redis_results = RedisTier(redis_url, result_ttl) if redis_url else None
+
+    @staticmethod
+    def _tiered_get(local, shared, key):
+        value = local.get(key)
+        if value is None and shared is not None:
+            value = shared.get(key)
+            if value is not None:
+                local.put(key, value)
+        return value
+
+    @staticmethod
+    def _tiered_put(local, shared, key, value):
+        local.put(key, value)
+        if shared is not None:
+            shared.put(key, value)
+
+    def _embedding_key(self, model, question):
+        return "e:" + _digest(model, normalize_question(question))
+
+    def _results_key(self, collection_name, vector, k, mode):
+        version = self.versions.get(collection_name)
+        vector = np.asarray(vector, dtype=np.float32).tobytes()
+        return "r:" + _digest(collection_name, version, vector, k, mode)
+
+    def get_embedding(self, model: str, question: str):
+        return self._tiered_get(self.embeddings, self.redis_embeddings,
+                                self._embedding_key(model, question))
+
+    def put_embedding(self, model: str, question: str, vector) -> None:
+        self._tiered_put(self.embeddings, self.redis_embeddings,
+                         self._embedding_key(model, question), list(map(float, vector)))
+
+    def get_results(self, collection_name: str, vector, k: int, mode: str = "vector"):
+        return self._tiered_get(self.results, self.redis_results,
+                                self._results_key(collection_name, vector, k, mode))
+
+    def put_results(self, collection_name: str, vector, k: int, results, mode: str = "vector") -> None:
+        self._tiered_put(self.results, self.redis_results,
+                         self._results_key(collection_name, vector, k, mode), results)
+
+    def stats(self) -> dict:
+        return {
+            "embedding_hits": self.embeddings.hits,
+            "embedding_misses": self.embeddings.misses,
+            "result_hits": self.results.hits,
+            "result_misses": self.results.misses,
+        }
@@ -0,0 +1,229 @@
+# Long-lived retrieval service built on similar_search.
+# Connections, loaded collections and the embedding client are created once
+# and reused by every request, instead of once per query. It answers the same
+# {question, collection_name} body as the /qa Cloud Function.
+
+import os
+import asyncio
+import argparse
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from embedding_cache import report_cache
+from local_store import LocalVectorStore
+from query_cache import CollectionVersions, QueryCache
+from lexical import BM25Index, redis_text_search
+from metrics import METRICS
+from similar_search import (milvus_multi_search, local_multi_search, redis_multi_search, milvus_fetch,
+                            local_fetch, lexical_multi_search, hybrid_multi_search, query_embeddings)
+
+
+class Retriever:
+    """Warm embedding client plus one open handle per collection."""
+
+    def __init__(self, backend="milvus", host="127.0.0.1", port="19530", local_root=".local_index",
+                 redis_url=None, cache_dir=None, k=4, ef=None, query_cache=None,
+                 mode="vector", lexical_root=".lexical_index", versions=None):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.local_root = local_root
+        self.redis_url = redis_url
+        self.k = k
+        self.ef = ef
+        self.embeddings = query_embeddings(cache_dir)
+        self.model = getattr(self.embeddings, "model", type(self.embeddings).__name__)
+        self.query_cache = query_cache
+        # Indexers bump the version of a collection they rewrote, see query_cache.py
+        self.versions = versions or (query_cache.versions if query_cache else CollectionVersions())
+        self.mode = mode
+        self.lexical_root = lexical_root
+        # collection_name -> (version, handle or BM25 index)
+        self._lexical = {}
+        self._handles = {}
+        self._handles_lock = threading.Lock()
+        if backend == "milvus":
+            from pymilvus import connections
+            # A single gRPC channel shared by all collections and requests
+            connections.connect(host=host, port=port)
+        elif backend == "redis":
+            import redis
+            self._redis_pool = redis.ConnectionPool.from_url(redis_url)
+
+    def _cached(self, cache, collection_name, open_fn):
+        # Opened again once the collection version moves, so a re-index is picked up
+        version = self.versions.get(collection_name)
+        entry = cache.get(collection_name)
+        if entry is None or entry[0] != version:
+            with self._handles_lock:
+                entry = cache.get(collection_name)
+                if entry is None or entry[0] != version:
+                    entry = (version, open_fn(collection_name))
+                    cache[collection_name] = entry
+        return entry[1]
+
+    def _handle(self, collection_name):
+        return self._cached(self._handles, collection_name, self._open)
+
+    def _open(self, collection_name):
+        if self.backend == "local":
+            handle = LocalVectorStore(os.path.join(self.local_root, collection_name), self.embeddings)
+        elif self.backend == "redis":
+            import redis
+            # A client on the service-wide connection pool, the index is named after the collection
+            handle = redis.Redis(connection_pool=self._redis_pool)
+        else:
+            from pymilvus import Collection
+            handle = Collection(collection_name)
+            handle.load()
+        return handle
+
+    def _lexical_index(self, collection_name):
+        # Redis searches its own text fields, the other backends a BM25 index on disk
+        return self._cached(self._lexical, collection_name,
+                            lambda name: BM25Index(os.path.join(self.lexical_root, name)))
+
+    @property
+    def collections(self):
+        return sorted(self._handles)
+
+    def close(self):
+        report_cache(self.embeddings)
+
+    def _embed(self, questions):
+        if self.query_cache is None:
+            return self.embeddings.embed_documents(questions)
+        vectors = [self.query_cache.get_embedding(self.model, question) for question in questions]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = self.embeddings.embed_documents([questions[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                self.query_cache.put_embedding(self.model, questions[i], vector)
+                vectors[i] = vector
+        return vectors
+
+    def _lexical_search(self, handle, collection_name, questions, k):
+        if self.backend == "redis":
+            return [redis_text_search(handle, collection_name, question, k) for question in questions]
+        fetch = partial(local_fetch if self.backend == "local" else milvus_fetch, handle)
+        return lexical_multi_search(self._lexical_index(collection_name), questions, k, fetch)
+
+    def _search(self, handle, collection_name, questions, vectors, k):
+        if self.mode == "hybrid":
+            # Fuse a deeper candidate list from each side
+            candidates = 4 * k
+            return hybrid_multi_search(self._vector_search(handle, collection_name, vectors, candidates),
+                                       self._lexical_search(handle, collection_name, questions, candidates), k)
+        return self._vector_search(handle, collection_name, vectors, k)
+
+    def _vector_search(self, handle, collection_name, vectors, k):
+        if self.backend == "redis":
+            return redis_multi_search(handle, collection_name, vectors, k)
+        if self.backend == "local":
+            return local_multi_search(handle, vectors, k, self.ef)
+        return milvus_multi_search(handle, vectors, k, self.ef)
+
+    def search(self, questions, collection_name, k=None):
+        """Top-k documents for each question, as {"text", "metadata", "score"} dicts."""
+        with METRICS.timer("query"):
+            return self._cached_search(questions, collection_name, k or self.k)
+
+    def _cached_search(self, questions, collection_name, k):
+        METRICS.count("questions", len(questions))
+        handle = self._handle(collection_name)
+        with METRICS.timer("query_embed"):
+            vectors = self._embed(questions)
+        if self.query_cache is None:
+            with METRICS.timer("search"):
+                return self._search(handle, collection_name, questions, vectors, k)
+        results = [self.query_cache.get_results(collection_name, vector, k, self.mode) for vector in vectors]
+        missing = [i for i, result in enumerate(results) if result is None]
+        METRICS.count("query_cache_hits", len(results) - len(missing))
+        if missing:
+            with METRICS.timer("search"):
+                found = self._search(handle, collection_name, [questions[i] for i in missing],
+                                     [vectors[i] for i in missing], k)
+            for i, result in zip(missing, found):
+                self.query_cache.put_results(collection_name, vectors[i], k, result, self.mode)
+                results[i] = result
+        return results
+
+
+def create_app(retriever: Retriever, threads: int = 8) -> web.Application:
+    app = web.Application()
+    # pymilvus and the embedding client block, keep them off the event loop
+    executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def qa(request):
+        body = await request.json()
+        question = body.get("question")
+        collection_name = body.get("collection_name")
+        if not question or not collection_name:
+            return web.json_response(
+                {"message": "Invalid input. Please provide a question and a collection_name."}, status=400)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                executor, retriever.search, [question], collection_name, body.get("k"))
+        except Exception as e:
+            return web.json_response({"message": str(e)}, status=500)
+        # Same shape as langchain Documents so the Cloud Function can use them as is
+        return web.json_response({"documents": [
+            {"pageContent": doc["text"], "metadata": {**doc["metadata"], "score": doc["score"]}}
+            for doc in results[0]
+        ]})
+
+    async def health(request):
+        cache = retriever.query_cache.stats() if retriever.query_cache else None
+        return web.json_response({"status": "ok", "collections": retriever.collections, "query_cache": cache})
+
+    async def metrics(request):
+        # Prometheus scrape endpoint
+        return web.Response(text=METRICS.prometheus(), content_type="text/plain")
+
+    async def close_executor(app):
+        executor.shutdown(wait=False)
+        retriever.close()
+
+    app.router.add_post("/qa", qa)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    app.on_cleanup.append(close_executor)
+    return app
+
+
+# python src/retrieval_server.py --backend milvus --host 127.0.0.1 --port 19530 --listen_port 8000
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieval service for Question Answering over Documents application.")
+    parser.add_argument('--backend', type=str, default="milvus", choices=["milvus", "redis", "local"], help='Vector store to search.')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Host address for the Milvus server.')
+    parser.add_argument('--port', type=str, default="19530", help='Port for the Milvus server.')
+    parser.add_argument('--redis_url', type=str, default="redis://127.0.0.1:6379", help='URL of the Redis server.')
+    parser.add_argument('--local_root', type=str, default=".local_index", help='Directory holding one local vector store per collection.')
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache", help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+    parser.add_argument('--k', type=int, default=4, help='Number of documents returned per question.')
+    parser.add_argument('--ef', type=int, default=None, help='HNSW ef used when searching.')
+    parser.add_argument('--mode', type=str, default="vector", choices=["vector", "hybrid"], help='Vector search, or vector and BM25 search fused with reciprocal-rank fusion.')
+    parser.add_argument('--lexical_root', type=str, default=".lexical_index", help='Directory holding one BM25 index per collection (hybrid mode, Milvus and local backends).')
+    parser.add_argument('--threads', type=int, default=8, help='Threads running blocking embedding and search calls.')
+    parser.add_argument('--listen_host', type=str, default="0.0.0.0", help='Address the service listens on.')
+    parser.add_argument('--listen_port', type=int, default=8000, help='Port the service listens on.')
+    parser.add_argument('--query_cache_size', type=int, default=10000, help='Entries per query cache level (0 disables the query cache).')
+    parser.add_argument('--query_cache_ttl', type=float, default=3600, help='Seconds a cached search result stays valid.')
+    parser.add_argument('--query_cache_redis_url', type=str, default=None, help='Redis URL of a query cache tier shared between workers.')
+    parser.add_argument('--version_store', type=str, default=".collection_versions", help='Directory or redis:// URL where indexers record collection versions (cached handles and BM25 indexes are reopened when they change).')
+
+    args = parser.parse_args()
+
+    versions = CollectionVersions(args.version_store)
+    query_cache = None
+    if args.query_cache_size > 0:
+        query_cache = QueryCache(versions, args.query_cache_size,
+                                 result_ttl=args.query_cache_ttl, redis_url=args.query_cache_redis_url)
+    retriever = Retriever(args.backend, args.host, args.port, args.local_root, args.redis_url,
+                          args.cache_dir or None, args.k, args.ef, query_cache, args.mode, args.lexical_root,
+                          versions)
+    web.run_app(create_app(retriever, args.threads), host=args.listen_host, port=args.listen_port)
@@ -1,38 +1,289 @@
-# Langchain wraps the Milvus client and provides a few convenience methods for working with documents. 
-# It can split documents into chunks, embed them, and store them in Milvus.
+# Searches the Milvus or local vector store for the chunks closest to a question.
+# The query path doesn't import langchain: questions are embedded with the
+# aiohttp client of embedding_client.py and searched with pymilvus directly,
+# which is only imported when the Milvus backend is used.
 
 import os
+import sys
+import json
+import time
 import argparse
+from functools import partial
+from itertools import islice
 
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Milvus
+import numpy as np
 
+from embedding_cache import cached_embeddings, report_cache
+from embedding_client import AsyncEmbeddingClient
+from local_store import LocalVectorStore, default_local_dir
+from lexical import BM25Index, default_lexical_dir, rrf_fuse
+from metrics import METRICS, add_arguments as add_metrics_arguments, instrumented
+# VARCHAR field holding the chunk text in the collections index_documents.py creates
+from milvus_schema import text_field
 
-text_field = "otext"
 
-def main(question, host, port, collection_name):
-    embeddings = OpenAIEmbeddings()
+def query_embeddings(cache_dir=None):
+    # Same model as OpenAIEmbeddings, so the embedding cache is shared with the indexers
+    return cached_embeddings(AsyncEmbeddingClient(), cache_dir)
 
-    vector_db = Milvus(
-        embeddings,
-        {"host": host, "port": port},
-        collection_name,
-        text_field,
-    )
 
-    docs = vector_db.similarity_search(question)
-     
+def main(question, host, port, collection_name, cache_dir=None, backend="milvus", local_dir=None, ef=None,
+         mode="vector", lexical_dir=None, k=4, nprobe=None, rerank=None):
+    embeddings = query_embeddings(cache_dir)
+
+    multi_search = open_multi_search(backend, host, port, collection_name, embeddings, local_dir, ef, k,
+                                     mode, lexical_dir, nprobe=nprobe, rerank=rerank)
+    with METRICS.timer("query"):
+        docs = multi_search([question], embeddings.embed_documents([question]))[0]
+
     print(docs)
+    report_cache(embeddings)
+
+
+def read_questions(questions_file):
+    # JSONL: {"question": ..., "id": ...} objects or bare JSON strings, "-" reads stdin
+    f = sys.stdin if questions_file == "-" else open(questions_file, encoding="utf8")
+    try:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"question": record}
+            record.setdefault("id", number)
+            yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def milvus_search_params(collection, k, ef=None, nprobe=None):
+    # HNSW collections take ef, the quantized IVF_SQ8 / IVF_PQ ones nprobe
+    index_type = collection.indexes[0].params.get("index_type", "HNSW") if collection.indexes else "HNSW"
+    if index_type.startswith("IVF"):
+        return {"metric_type": "L2", "params": {"nprobe": nprobe or 16}}
+    return {"metric_type": "L2", "params": {"ef": max(ef or 64, k)}}
+
+
+def milvus_rerank(collection, anns_field, vectors, results, k):
+    # Exact L2 order of the candidates, from the float32 vectors Milvus keeps next to its quantized index
+    primary = next(field.name for field in collection.schema.fields if field.is_primary)
+    pks = sorted({doc["id"] for docs in results for doc in docs})
+    rows = collection.query(expr=f"{primary} in {pks}", output_fields=[anns_field]) if pks else []
+    stored = {row[primary]: np.asarray(row[anns_field], dtype=np.float32) for row in rows}
+    reranked = []
+    for vector, docs in zip(vectors, results):
+        vector = np.asarray(vector, dtype=np.float32)
+        for doc in docs:
+            if doc["id"] in stored:
+                doc["score"] = float(np.sum((stored[doc["id"]] - vector) ** 2))
+        reranked.append(sorted(docs, key=lambda doc: doc["score"])[:k])
+    return reranked
+
+
+def milvus_multi_search(collection, vectors, k, ef=None, nprobe=None, rerank=0):
+    # One round trip for the whole batch of query vectors
+    from pymilvus import DataType
+    anns_field = next(field.name for field in collection.schema.fields
+                      if field.dtype == DataType.FLOAT_VECTOR)
+    output_fields = [field.name for field in collection.schema.fields
+                     if field.dtype == DataType.VARCHAR]
+    limit = k * rerank if rerank else k
+    hits = collection.search(
+        data=vectors,
+        anns_field=anns_field,
+        param=milvus_search_params(collection, limit, ef, nprobe),
+        limit=limit,
+        output_fields=output_fields,
+    )
+    results = []
+    for query_hits in hits:
+        results.append([{
+            "id": hit.id,
+            "text": hit.entity.get(text_field),
+            "metadata": {name: hit.entity.get(name) for name in output_fields if name != text_field},
+            "score": hit.distance,
+        } for hit in query_hits])
+    if rerank:
+        results = milvus_rerank(collection, anns_field, vectors, results, k)
+    return results
+
+
+def local_multi_search(vector_db, vectors, k, ef=None, rerank=None):
+    ids, distances = vector_db.search_vectors(vectors, k, ef, rerank)
+    records = vector_db.records
+    return [[{"id": i, "text": records[i]["text"], "metadata": records[i]["metadata"], "score": float(d)}
+             for i, d in zip(row_ids.tolist(), row_distances.tolist()) if i >= 0]
+            for row_ids, row_distances in zip(ids, distances)]
+
+
+def _redis_text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def redis_multi_search(client, index_name, vectors, k, content_key="content", metadata_key="metadata",
+                       vector_key="content_vector"):
+    # KNN over the hashes of index_documents_redis.py with the precomputed
+    # vectors, every question's FT.SEARCH sent in one pipelined round trip
+    pipeline = client.pipeline(transaction=False)
+    for vector in vectors:
+        pipeline.execute_command(
+            "FT.SEARCH", index_name, f"*=>[KNN {k} @{vector_key} $vector AS score]",
+            "PARAMS", 2, "vector", np.asarray(vector, dtype=np.float32).tobytes(),
+            "SORTBY", "score", "RETURN", 3, content_key, metadata_key, "score",
+            "LIMIT", 0, k, "DIALECT", 2)
+    results = []
+    # Each reply is [total, key, [field, value, ...], key, [...], ...]
+    for reply in pipeline.execute():
+        hits = []
+        for key, fields in zip(reply[1::2], reply[2::2]):
+            fields = {_redis_text(name): value for name, value in zip(fields[::2], fields[1::2])}
+            hits.append({"id": _redis_text(key), "text": _redis_text(fields.get(content_key)),
+                         "metadata": json.loads(fields.get(metadata_key) or "{}"),
+                         "score": float(fields["score"])})
+        results.append(hits)
+    return results
+
+
+def milvus_fetch(collection, pks):
+    # Text and metadata of rows by primary key, for hits of the lexical index
+    from pymilvus import DataType
+    primary = next(field.name for field in collection.schema.fields if field.is_primary)
+    output_fields = [field.name for field in collection.schema.fields
+                     if field.dtype == DataType.VARCHAR]
+    rows = collection.query(expr=f"{primary} in {list(pks)}", output_fields=output_fields) if pks else []
+    return {row[primary]: {
+        "id": row[primary],
+        "text": row.get(text_field),
+        "metadata": {name: row.get(name) for name in output_fields if name != text_field},
+    } for row in rows}
+
+
+def local_fetch(vector_db, ids):
+    records = vector_db.records
+    return {i: {"id": i, "text": records[i]["text"], "metadata": records[i]["metadata"]} for i in ids}
+
+
+def lexical_multi_search(lexical, questions, k, fetch):
+    # BM25 hits of every question, resolved to documents with one fetch
+    hits = lexical.search_many(questions, k)
+    found = fetch(sorted({doc_id for question_hits in hits for doc_id, _ in question_hits}))
+    return [[{**found[doc_id], "score": score} for doc_id, score in question_hits if doc_id in found]
+            for question_hits in hits]
+
+
+def hybrid_multi_search(vector_results, lexical_results, k, rrf_k=60):
+    """Fuse vector and lexical rankings per question with reciprocal-rank fusion."""
+    return [rrf_fuse([vector_docs, lexical_docs], k, rrf_k)
+            for vector_docs, lexical_docs in zip(vector_results, lexical_results)]
+
+
+def open_multi_search(backend, host, port, collection_name, embeddings, local_dir=None, ef=None, k=4,
+                      mode="vector", lexical_dir=None, candidates=None, nprobe=None, rerank=None):
+    """Connect once and return multi_search(questions, vectors) -> top-k results per question.
+
+    In hybrid mode both sides return candidates results (4 * k by default)
+    before they are fused.
+    """
+    if backend == "local":
+        vector_db = LocalVectorStore(local_dir or default_local_dir(collection_name), embeddings)
+        vector_search = partial(local_multi_search, vector_db, ef=ef, rerank=rerank)
+        fetch = partial(local_fetch, vector_db)
+    else:
+        from pymilvus import Collection, connections
+        if not connections.has_connection("default"):
+            connections.connect(host=host, port=port)
+        collection = Collection(collection_name)
+        collection.load()
+        vector_search = partial(milvus_multi_search, collection, ef=ef, nprobe=nprobe, rerank=rerank or 0)
+        fetch = partial(milvus_fetch, collection)
+
+    if mode != "hybrid":
+        return lambda questions, vectors: vector_search(vectors, k=k)
+
+    lexical = BM25Index(lexical_dir or default_lexical_dir(collection_name))
+    candidates = candidates or 4 * k
+
+    def multi_search(questions, vectors):
+        return hybrid_multi_search(vector_search(vectors, k=candidates),
+                                   lexical_multi_search(lexical, questions, candidates, fetch), k)
+    return multi_search
+
+
+def main_batch(questions_file, host, port, collection_name, cache_dir=None, backend="milvus", local_dir=None, ef=None,
+               batch_size=64, k=4, output=sys.stdout, mode="vector", lexical_dir=None, nprobe=None, rerank=None):
+    embeddings = query_embeddings(cache_dir)
+
+    # Connect once for the whole run
+    multi_search = open_multi_search(backend, host, port, collection_name, embeddings, local_dir, ef, k,
+                                     mode, lexical_dir, nprobe=nprobe, rerank=rerank)
+
+    questions = read_questions(questions_file)
+    count = 0
+    started = time.perf_counter()
+    while True:
+        batch = list(islice(questions, batch_size))
+        if not batch:
+            break
+        batch_started = time.perf_counter()
+        texts = [record["question"] for record in batch]
+        vectors = embeddings.embed_documents(texts)
+        embedded = time.perf_counter()
+        results = multi_search(texts, vectors)
+        finished = time.perf_counter()
+        METRICS.observe_stage("query_embed", embedded - batch_started)
+        METRICS.observe_stage("search", finished - embedded)
+        METRICS.count("questions", len(batch))
+        for record, docs in zip(batch, results):
+            output.write(json.dumps({
+                "id": record["id"],
+                "question": record["question"],
+                "results": docs,
+                # The batch is embedded and searched together, so its cost is shared
+                "latency_ms": round((finished - batch_started) * 1000 / len(batch), 3),
+                "batch_latency_ms": round((finished - batch_started) * 1000, 3),
+                "embed_ms": round((embedded - batch_started) * 1000, 3),
+                "search_ms": round((finished - embedded) * 1000, 3),
+            }) + "\n")
+        output.flush()
+        count += len(batch)
+
+    elapsed = time.perf_counter() - started
+    print(f"Searched {count} questions in {elapsed:.2f}s "
+          f"({count / elapsed if elapsed else 0:.1f} questions/s).", file=sys.stderr)
+    report_cache(embeddings, file=sys.stderr)
 
 
 # python similar_seatch.py --question your_question --collection_name my_collection
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Similar search for Question Answering over Documents application.")
-    parser.add_argument('--question', type=str, required=True, help='Question to search for.')
+    questions = parser.add_mutually_exclusive_group(required=True)
+    questions.add_argument('--question', type=str, help='Question to search for.')
+    questions.add_argument('--questions_file', type=str, help='JSONL file of questions to search for in batch mode ("-" reads stdin).')
     parser.add_argument('--host', type=str, default="127.0.0.1", help='Host address for the Milvus server.')
     parser.add_argument('--port', type=str, default="19530", help='Port for the Milvus server.')
     parser.add_argument('--collection_name', type=str, required=True, help='Name of the collection to index the documents into.')
+    parser.add_argument('--cache_dir', type=str, default=".embedding_cache", help='Directory of the on-disk embedding cache (pass an empty string to disable).')
+    parser.add_argument('--backend', type=str, default="milvus", choices=["milvus", "local"], help='Search a Milvus server or an embedded local vector store.')
+    parser.add_argument('--local_dir', type=str, default=None, help='Directory of the local vector store (default: .local_index/<collection_name>).')
+    parser.add_argument('--ef', type=int, default=None, help='HNSW ef used when searching.')
+    parser.add_argument('--nprobe', type=int, default=None, help='IVF nprobe used when searching an IVF_SQ8 or IVF_PQ Milvus collection.')
+    parser.add_argument('--rerank', type=int, default=None, help='Re-rank k * rerank quantized candidates against the full-precision vectors (0 disables).')
+    parser.add_argument('--batch_size', type=int, default=64, help='Questions embedded and searched per round trip in batch mode.')
+    parser.add_argument('--k', type=int, default=4, help='Number of documents returned per question in batch and hybrid mode.')
+    parser.add_argument('--mode', type=str, default="vector", choices=["vector", "hybrid"], help='Vector search, or vector and BM25 search fused with reciprocal-rank fusion.')
+    parser.add_argument('--lexical_dir', type=str, default=None, help='Directory of the BM25 index for hybrid mode (default: .lexical_index/<collection_name>).')
 
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    main(args.question, args.host, args.port, args.collection_name)
\ No newline at end of file
+    # Batch results go to stdout, so the reports go to stderr
+    with instrumented(args.metrics, args.prometheus, args.profile, args.profile_mode, file=sys.stderr):
+        if args.questions_file is not None:
+            main_batch(args.questions_file, args.host, args.port, args.collection_name, args.cache_dir or None,
+                       args.backend, args.local_dir, args.ef, args.batch_size, args.k,
+                       mode=args.mode, lexical_dir=args.lexical_dir, nprobe=args.nprobe, rerank=args.rerank)
+        else:
+            main(args.question, args.host, args.port, args.collection_name, args.cache_dir or None, args.backend, args.local_dir, args.ef,
+                 args.mode, args.lexical_dir, args.k, args.nprobe, args.rerank)
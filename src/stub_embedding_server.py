@@ -0,0 +1,61 @@
+# Local stub of the OpenAI embeddings endpoint for exercising AsyncEmbeddingClient.
+# Returns FakeEmbeddings vectors, and can inject latency and 429 responses.
+# Inputs are counted in words against max_input_tokens, like tokens by the API.
+
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+from fake_embeddings import FakeEmbeddings
+
+
+def create_app(dim=1536, latency=0.05, throttle_rate=0.0, max_input_tokens=None):
+    embeddings = FakeEmbeddings(dim)
+    app = web.Application()
+    app["stats"] = {"requests": 0, "throttled": 0, "inputs": 0}
+
+    async def create_embeddings(request):
+        stats = request.app["stats"]
+        stats["requests"] += 1
+        if random.random() < throttle_rate:
+            stats["throttled"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached"}},
+                                     status=429, headers={"Retry-After": "1"})
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if max_input_tokens is not None and any(len(text.split()) > max_input_tokens for text in inputs):
+            return web.json_response({"error": {"message": "This model's maximum context length is "
+                                                           f"{max_input_tokens} tokens"}}, status=400)
+        stats["inputs"] += len(inputs)
+        await asyncio.sleep(latency)
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": embeddings.embed_query(text)}
+                     for i, text in enumerate(inputs)],
+        })
+
+    app.router.add_post("/v1/embeddings", create_embeddings)
+    return app
+
+
+# python src/stub_embedding_server.py --port 8080 --throttle_rate 0.1
+# then run an indexer with OPENAI_API_BASE=http://127.0.0.1:8080/v1 --embedding_concurrency 8
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub OpenAI embeddings endpoint.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Host address to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimension of the returned vectors.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds to wait before answering.')
+    parser.add_argument('--throttle_rate', type=float, default=0.0,
+                        help='Fraction of requests answered with 429.')
+    parser.add_argument('--max_input_tokens', type=int, default=None,
+                        help='Answer 400 to inputs longer than this many words.')
+
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.dim, args.latency, args.throttle_rate, args.max_input_tokens), host=args.host, port=args.port)
@@ -0,0 +1,191 @@
+# Token-aware, structure-aware text splitter.
+# Chunks are sized in tiktoken tokens and cut preferably before headings and
+# around code fences, then at blank lines, then at line ends. Boundaries are
+# found in one pass over the lines of a document; cut points are then picked
+# with prefix sums over the per-segment token and byte counts, so the text is
+# never re-split. Chunks never exceed max_length UTF-8 bytes, the size of the
+# backend's text field.
+
+import re
+from bisect import bisect_right
+from typing import Iterable, List, Optional
+
+import numpy as np
+import tiktoken
+
+
+# Cut priorities, a higher priority is a better place to end a chunk
+WORD, LINE, PARAGRAPH, SECTION = 0, 1, 2, 3
+
+HEADINGS = {
+    "markdown": re.compile(r"#{1,6}\s"),
+    "adoc": re.compile(r"={1,6}\s"),
+}
+FENCES = {
+    "markdown": re.compile(r"(```|~~~)"),
+    "adoc": re.compile(r"(----|\.\.\.\.|```)\s*$"),
+}
+HISTOGRAM_BINS = [0, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+
+class StructuredTokenSplitter:
+    def __init__(self, chunk_size: int = 400, chunk_overlap: int = 0, file_type: str = "text",
+                 max_length: Optional[int] = None, encoding_name: str = "cl100k_base",
+                 min_fill: float = 0.5):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(
+                f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.file_type = file_type
+        self.max_length = max_length
+        self.encoding_name = encoding_name
+        # A structural cut is only taken if the chunk is at least this full
+        self.min_fill = min_fill
+        self._encoding = None
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _segments(self, text: str):
+        """Split text into (start, end, priority) segments, one pass over its lines.
+
+        priority is the quality of cutting *before* the segment.
+        """
+        heading = HEADINGS.get(self.file_type)
+        fence = FENCES.get(self.file_type)
+        segments = []
+        in_code = False
+        after_block = False
+        for match in re.finditer(r"[^\n]*\n|[^\n]+$", text):
+            line = match.group()
+            is_fence = fence is not None and fence.match(line.lstrip()) is not None
+            if is_fence:
+                # Cut before an opening fence; a closing fence stays with its block
+                priority = LINE if in_code else SECTION
+                in_code = not in_code
+            elif in_code:
+                priority = LINE
+            elif heading is not None and heading.match(line):
+                priority = SECTION
+            elif after_block:
+                priority = PARAGRAPH
+            else:
+                priority = LINE
+            segments.append((match.start(), match.end(), priority))
+            # A blank line or a closing fence ends a block
+            after_block = not in_code and (is_fence or not line.strip())
+        return segments
+
+    def _measure(self, text: str, segments):
+        """Token and byte counts per segment; lines over budget are broken into words."""
+        starts, tokens, sizes, priorities = [], [], [], []
+        for start, end, priority in segments:
+            piece = text[start:end]
+            piece_tokens = self.count_tokens(piece)
+            piece_bytes = len(piece.encode("utf-8"))
+            if piece_tokens <= self.chunk_size and (self.max_length is None or piece_bytes <= self.max_length):
+                starts.append(start)
+                tokens.append(piece_tokens)
+                sizes.append(piece_bytes)
+                priorities.append(priority)
+                continue
+            for word in self._words(piece):
+                starts.append(start + word.start())
+                tokens.append(self.count_tokens(word.group()))
+                sizes.append(len(word.group().encode("utf-8")))
+                priorities.append(priority if word.start() == 0 else WORD)
+        return starts, tokens, sizes, priorities
+
+    def _words(self, piece: str):
+        # Words, with any single word longer than the budget hard-cut into slices
+        limit = self.chunk_size
+        if self.max_length is not None:
+            # 4 bytes is the longest UTF-8 character
+            limit = min(limit, self.max_length // 4)
+        return re.finditer(r"\S{1,%d}\s*|\s+" % max(1, limit), piece)
+
+    def split_text(self, text: str) -> List[str]:
+        if not text.strip():
+            return []
+        starts, tokens, sizes, priorities = self._measure(text, self._segments(text))
+        n = len(starts)
+        offsets = starts + [len(text)]
+        token_sums = np.concatenate([[0], np.cumsum(tokens)])
+        byte_sums = np.concatenate([[0], np.cumsum(sizes)])
+        priorities = np.array(priorities)
+
+        chunks = []
+        i = 0
+        while i < n:
+            # Furthest segment end that keeps the chunk within both budgets
+            end = int(np.searchsorted(token_sums, token_sums[i] + self.chunk_size, side="right")) - 1
+            if self.max_length is not None:
+                end = min(end, int(np.searchsorted(byte_sums, byte_sums[i] + self.max_length, side="right")) - 1)
+            end = max(end, i + 1)
+            if end < n:
+                # Prefer the best structural cut in the second half of the window
+                low = i + 1 + int(np.searchsorted(
+                    token_sums[i + 1:end + 1], token_sums[i] + self.min_fill * self.chunk_size))
+                if low <= end:
+                    window = priorities[low:end + 1]
+                    best = window.max()
+                    end = low + int(np.flatnonzero(window == best)[-1])
+            chunk = text[offsets[i]:offsets[end]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+            # Step back over whole segments to overlap with the previous chunk
+            next_i = end
+            if self.chunk_overlap:
+                next_i = bisect_right(token_sums, token_sums[end] - self.chunk_overlap, lo=i + 1, hi=end + 1) - 1
+                next_i = min(max(next_i, i + 1), end)
+            i = next_i
+        return chunks
+
+    def split_documents(self, documents: Iterable) -> List:
+        from langchain.docstore.document import Document
+        return [Document(page_content=chunk, metadata=dict(document.metadata))
+                for document in documents
+                for chunk in self.split_text(document.page_content)]
+
+
+class ChunkHistogram:
+    """Token-size histogram of the chunks streaming through the pipeline."""
+
+    def __init__(self, encoding_name: str = "cl100k_base", bins: List[int] = HISTOGRAM_BINS):
+        self.encoding_name = encoding_name
+        self.bins = bins
+        self.counts = [0] * len(bins)
+        self.tokens = 0
+        self.chunks = 0
+        self._encoding = None
+
+    def observe(self, text: str) -> None:
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        tokens = len(self._encoding.encode(text, disallowed_special=()))
+        self.counts[bisect_right(self.bins, tokens) - 1] += 1
+        self.tokens += tokens
+        self.chunks += 1
+
+    def observe_all(self, chunks: Iterable) -> Iterable:
+        for chunk in chunks:
+            self.observe(chunk.page_content)
+            yield chunk
+
+    def report(self) -> str:
+        lines = [f"Chunk sizes ({self.chunks} chunks, {self.tokens} tokens, "
+                 f"{self.tokens / self.chunks if self.chunks else 0:.0f} tokens on average):"]
+        bounds = self.bins[1:] + [None]
+        for low, high, count in zip(self.bins, bounds, self.counts):
+            label = f"{low}-{high - 1}" if high else f"{low}+"
+            lines.append(f"  {label:>11} tokens: {count}")
+        return "\n".join(lines)
@@ -0,0 +1,41 @@
+import os
+import sys
+import asyncio
+import threading
+
+import pytest
+
+# The modules in src/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+@pytest.fixture
+def stub_server():
+    """Factory starting stub_embedding_server.py on a free port; returns (api_base, stats)."""
+    from aiohttp import web
+    from stub_embedding_server import create_app
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    def start(**options):
+        app = create_app(**options)
+
+        async def serve():
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            runners.append(runner)
+            return runner.addresses[0][1]
+
+        port = asyncio.run_coroutine_threadsafe(serve(), loop).result()
+        return f"http://127.0.0.1:{port}/v1", app["stats"]
+
+    yield start
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
@@ -0,0 +1,107 @@
+import json
+from types import SimpleNamespace
+
+import numpy as np
+
+from bulk_load import MilvusBulkWriter, RedisBulkWriter
+from fake_embeddings import FakeEmbeddings
+
+DIM = 8
+
+
+def make_docs(count, source="a.md"):
+    return [SimpleNamespace(page_content=f"{source} paragraph {i}", metadata={"source": source})
+            for i in range(count)]
+
+
+class Collection:
+    """The parts of a pymilvus Collection the writer uses; ids are handed out in insert order."""
+
+    name = "docs"
+
+    def __init__(self):
+        self.schema = SimpleNamespace(fields=[
+            SimpleNamespace(name="pk", auto_id=True), SimpleNamespace(name="source", auto_id=False),
+            SimpleNamespace(name="text", auto_id=False), SimpleNamespace(name="vector", auto_id=False)])
+        self.inserts = []
+        self.flushes = 0
+        self.index = None
+
+    def insert(self, columns):
+        self.inserts.append(columns)
+        start = sum(len(columns[0]) for columns in self.inserts[:-1])
+        return SimpleNamespace(primary_keys=list(range(start, start + len(columns[0]))))
+
+    def flush(self):
+        self.flushes += 1
+
+    def has_index(self):
+        return self.index is not None
+
+    def create_index(self, field, params):
+        self.index = (field, params)
+
+
+class Pipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def hset(self, key, mapping):
+        self.commands.append((key, mapping))
+
+    def execute(self):
+        self.client.round_trips.append(len(self.commands))
+        self.client.hashes.update(self.commands)
+        self.commands = []
+
+
+class Client:
+    def __init__(self):
+        self.hashes = {}
+        self.round_trips = []
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+
+def test_milvus_writer_inserts_columns_in_schema_order_and_indexes_once():
+    collection = Collection()
+    writer = MilvusBulkWriter(collection, FakeEmbeddings(DIM), "text", "vector", {"index_type": "HNSW"})
+    assert writer.add_documents(make_docs(3)) == [0, 1, 2]
+    assert writer.add_documents(make_docs(2, "b.md")) == [3, 4]
+    assert writer.add_documents([]) == []
+
+    source, text, vector = collection.inserts[1]
+    assert source == ["b.md", "b.md"] and text == ["b.md paragraph 0", "b.md paragraph 1"]
+    assert len(vector) == 2 and len(vector[0]) == DIM
+    # Nothing is flushed or indexed while loading
+    assert collection.flushes == 0 and collection.index is None
+    writer.finish()
+    writer.finish()
+    assert collection.flushes == 2 and collection.index == ("vector", {"index_type": "HNSW"})
+    assert writer.stats.rows == 5
+
+
+def test_redis_writer_pipelines_hsets_under_given_or_new_keys():
+    client = Client()
+    embeddings = FakeEmbeddings(DIM)
+    writer = RedisBulkWriter(client, "idx", embeddings, pipeline_size=4)
+    docs = make_docs(10)
+    keys = writer.add_documents(docs)
+    assert len(set(keys)) == 10 and all(key.startswith("doc:idx:") for key in keys)
+    # Full pipelines are sent as they fill up, the rest at the end
+    assert client.round_trips == [4, 4, 2]
+
+    stored = client.hashes[keys[3]]
+    assert stored["content"] == "a.md paragraph 3" and json.loads(stored["metadata"]) == {"source": "a.md"}
+    vector = np.frombuffer(stored["content_vector"], dtype=np.float32)
+    assert np.allclose(vector, embeddings.embed_query("a.md paragraph 3"), atol=1e-6)
+
+    # Given keys overwrite the hashes they name
+    assert writer.add_documents(make_docs(2, "b.md"), keys=keys[:2]) == keys[:2]
+    assert len(client.hashes) == 10 and client.hashes[keys[0]]["content"] == "b.md paragraph 0"
+    assert writer.stats.rows == 12
@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+
+import pytest
+
+from checkpoint import Checkpoint
+
+SETTINGS = {"chunk_size": 100}
+
+
+def make_chunks(sources, per_source):
+    return [SimpleNamespace(page_content=f"{source} {i}", metadata={"source": source})
+            for source in sources for i in range(per_source)]
+
+
+class Store:
+    """Rows with integer ids; add returns them as strings, like langchain's SupabaseVectorStore."""
+
+    def __init__(self):
+        self.rows = {}
+        self.next_id = 100
+        self.fail_after = None
+
+    def add(self, batch, positions):
+        ids = []
+        for chunk in batch:
+            self.rows[self.next_id] = chunk.page_content
+            ids.append(str(self.next_id))
+            self.next_id += 1
+        if self.fail_after is not None:
+            self.fail_after -= 1
+            if self.fail_after == 0:
+                # The rows are stored, but the process dies before the batch is committed
+                raise KeyboardInterrupt
+        return ids
+
+    def find(self, sources):
+        return [row_id for row_id, text in self.rows.items() if text.split()[0] in sources]
+
+    def delete(self, ids):
+        for row_id in ids:
+            del self.rows[row_id]
+
+
+def run(checkpoint, store, chunks, batch_size=3):
+    write = checkpoint.writer(store.add)
+    chunks = list(checkpoint.skip_committed(chunks))
+    for start in range(0, len(chunks), batch_size):
+        write(chunks[start:start + batch_size])
+
+
+def test_resume_after_a_partly_committed_batch_stores_every_chunk_once(tmp_path):
+    path = str(tmp_path / "c.jsonl")
+    chunks = make_chunks(["a.md", "b.md"], 4)
+    store = Store()
+    # The second batch holds the last chunk of a.md and two of b.md
+    store.fail_after = 2
+    checkpoint = Checkpoint(path, SETTINGS)
+    checkpoint.start()
+    with pytest.raises(KeyboardInterrupt):
+        run(checkpoint, store, chunks)
+    assert len(store.rows) == 6
+
+    checkpoint = Checkpoint(path, SETTINGS, resume=True)
+    assert checkpoint.resumed and checkpoint.pending == ["a.md", "b.md"]
+    # Only the three uncommitted rows go, although the store's ids are numbers and the checkpoint's strings
+    assert checkpoint.recover(store.find, store.delete) == 3
+    assert checkpoint.committed() == 3
+    run(checkpoint, store, chunks)
+    assert sorted(store.rows.values()) == sorted(chunk.page_content for chunk in chunks)
+    assert checkpoint.ids("a.md") == ["100", "101", "102", "106"]
+
+
+def test_skip_committed_reports_the_ids_of_skipped_chunks(tmp_path):
+    path = str(tmp_path / "c.jsonl")
+    chunks = make_chunks(["a.md", "b.md"], 3)
+    checkpoint = Checkpoint(path, SETTINGS)
+    checkpoint.start()
+    write = checkpoint.writer(Store().add)
+    write(chunks[:4])
+
+    checkpoint = Checkpoint(path, SETTINGS, resume=True)
+    skipped = []
+    rest = list(checkpoint.skip_committed(chunks, lambda chunk, row_id: skipped.append((chunk.page_content, row_id))))
+    assert skipped == [("a.md 0", "100"), ("a.md 1", "101"), ("a.md 2", "102"), ("b.md 0", "103")]
+    assert [chunk.page_content for chunk in rest] == ["b.md 1", "b.md 2"]
+    # a.md was followed by another file, b.md may still have chunks to come
+    assert checkpoint.remaining(["a.md", "b.md"]) == ["b.md"]
+
+
+def test_a_torn_last_line_is_ignored_and_the_log_compacted(tmp_path):
+    path = str(tmp_path / "c.jsonl")
+    checkpoint = Checkpoint(path, SETTINGS)
+    checkpoint.start()
+    write = checkpoint.writer(Store().add)
+    for i in range(10):
+        write(make_chunks([f"f{i}.md"], 2))
+    with open(path, "a", encoding="utf8") as f:
+        f.write('{"pending": ["f1')
+
+    checkpoint = Checkpoint(path, SETTINGS, resume=True)
+    assert checkpoint.pending is None
+    assert checkpoint.committed() == 20
+    assert checkpoint.remaining([f"f{i}.md" for i in range(10)]) == ["f9.md"]
+    with open(path, encoding="utf8") as f:
+        # The settings, then one record per file
+        assert len(f.read().splitlines()) == 11
+
+
+def test_resuming_with_other_settings_fails(tmp_path):
+    path = str(tmp_path / "c.jsonl")
+    Checkpoint(path, SETTINGS).start()
+    with pytest.raises(ValueError):
+        Checkpoint(path, {"chunk_size": 200}, resume=True)
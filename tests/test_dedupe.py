@@ -0,0 +1,45 @@
+import json
+from types import SimpleNamespace
+
+from dedupe import ChunkDeduplicator
+
+LICENCE = "Licensed under the Apache License, Version 2.0; you may not use this file except in compliance."
+
+
+def make_chunk(text, source):
+    return SimpleNamespace(page_content=text, metadata={"source": source})
+
+
+def corpus():
+    return [
+        make_chunk(LICENCE, "a.md"),
+        make_chunk("How to configure the block cache size for the node.", "a.md"),
+        make_chunk(LICENCE.upper(), "b.md"),
+        # One word changed, a near duplicate
+        make_chunk("How to configure the block cache size for the server.", "c.md"),
+        make_chunk("A page about something else entirely, with its own words.", "c.md"),
+    ]
+
+
+def test_streamed_chunks_leave_later_sources_in_the_side_table(tmp_path):
+    deduplicator = ChunkDeduplicator(threshold=0.5)
+    kept = list(deduplicator.dedupe(corpus()))
+    assert [chunk.metadata["sources"] for chunk in kept] == [["a.md"], ["a.md"], ["c.md"]]
+    assert deduplicator.exact_duplicates == 1 and deduplicator.near_duplicates == 1
+
+    path = str(tmp_path / "sources.jsonl")
+    assert deduplicator.save_sources(path) == 2
+    with open(path, encoding="utf8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [(row["source"], row["sources"]) for row in rows] == [("a.md", ["a.md", "b.md"]), ("a.md", ["a.md", "c.md"])]
+    assert path in deduplicator.report()
+
+
+def test_all_sources_records_them_with_the_chunks(tmp_path):
+    deduplicator = ChunkDeduplicator(threshold=0.5, all_sources=True)
+    kept = deduplicator.dedupe(corpus())
+    assert [chunk.metadata["sources"] for chunk in kept] == [["a.md", "b.md"], ["a.md", "c.md"], ["c.md"]]
+    path = tmp_path / "sources.jsonl"
+    path.write_text("stale")
+    # Nothing is left for a side table, and the one of an earlier run goes
+    assert deduplicator.save_sources(str(path)) == 0 and not path.exists()
@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, VECTORS_FILE
+
+
+def test_smaller_max_entries_shrinks_the_cache(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), dim=4, max_entries=2000)
+    for i in range(1500):
+        cache.put(f"key{i}", np.full(4, i, dtype=np.float32))
+    cache.flush()
+
+    cache = EmbeddingCache(str(tmp_path), dim=4, max_entries=100)
+    assert len(cache) == 100
+    # The most recently used entries are kept, with their vectors
+    assert cache.get("key1499").tolist() == [1499.0] * 4
+    assert cache.get("key1400") is not None and cache.get("key1399") is None
+    for i in range(1500, 1700):
+        cache.put(f"key{i}", np.full(4, i, dtype=np.float32))
+    assert len(cache) == 100
+    assert cache.get("key1699").tolist() == [1699.0] * 4
+    assert os.path.getsize(os.path.join(str(tmp_path), VECTORS_FILE)) == 100 * 4 * 4
+    cache.flush()
+    assert len(EmbeddingCache(str(tmp_path), dim=4, max_entries=100)) == 100
+
+
+def test_cached_embeddings_use_the_async_client(tmp_path, stub_server):
+    from embedding_cache import CachedEmbeddings
+    from test_embedding_client import make_client
+
+    api_base, stats = stub_server(dim=8, latency=0.3)
+    client = make_client(api_base, max_concurrency=4)
+    embeddings = CachedEmbeddings(client, EmbeddingCache(str(tmp_path), dim=8))
+    texts = [f"chunk {i}" for i in range(64)]
+    started = time.perf_counter()
+    vectors = asyncio.run(embeddings.aembed_documents(texts))
+    elapsed = time.perf_counter() - started
+    # The misses were sent as 4 overlapping requests, not one request per batch in a thread
+    assert stats["requests"] == 4 and elapsed < 0.9
+    assert asyncio.run(embeddings.aembed_documents(texts[:8] + ["new"])) == vectors[:8] + [client.embed_query("new")]
+    client.close()
+    assert stats["inputs"] == 64 + 2
+
+
+def test_a_slot_reused_after_the_last_save_is_not_served_for_the_old_key(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), dim=4, max_entries=1024, autosave_every=10_000)
+    for i in range(1024):
+        cache.put(f"key{i}", np.full(4, i, dtype=np.float32))
+    cache.flush()
+    # Evicts key0 and writes key1024 into its slot, then the process dies before the next save
+    cache.put("key1024", np.full(4, 1024, dtype=np.float32))
+    cache._vectors.flush()
+    cache._keys.flush()
+
+    cache = EmbeddingCache(str(tmp_path), dim=4, max_entries=1024)
+    assert "key0" in cache
+    assert cache.get("key0") is None
+    assert "key0" not in cache
+    assert cache.get("key1").tolist() == [1.0] * 4
+    cache.put("key0", np.zeros(4, dtype=np.float32))
+    assert len(cache) == 1024
+
+
+def test_caches_without_fingerprints_are_upgraded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), dim=4)
+    cache.put("key", np.ones(4, dtype=np.float32))
+    cache.flush()
+    os.remove(os.path.join(str(tmp_path), "keys.bin"))
+    assert EmbeddingCache(str(tmp_path), dim=4).get("key").tolist() == [1.0] * 4
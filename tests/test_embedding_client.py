@@ -0,0 +1,113 @@
+import time
+import asyncio
+
+import aiohttp
+import pytest
+
+from embedding_client import AsyncEmbeddingClient, MAX_INPUT_TOKENS
+
+
+def make_client(api_base, **options):
+    client = AsyncEmbeddingClient(api_key="test", api_base=api_base, **options)
+    # Word counts instead of tiktoken, which downloads its BPE file on first use
+    client.count_tokens = lambda text: len(text.split())
+    return client
+
+
+def test_requests_per_minute_holds_across_calls(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0)
+    # A full bucket of 120 requests, then one every half second
+    client = make_client(api_base, max_concurrency=1, requests_per_minute=120, tokens_per_minute=None)
+    started = time.perf_counter()
+    for i in range(123):
+        assert len(client.embed_documents([f"text {i}"])) == 1
+    elapsed = time.perf_counter() - started
+    client.close()
+    assert stats["requests"] == 123
+    assert elapsed >= 1.2
+
+
+def test_tokens_per_minute_holds_across_sync_and_async_calls(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0)
+    # 600 tokens per minute, refilled at 10 per second
+    client = make_client(api_base, requests_per_minute=None, tokens_per_minute=600)
+    texts = [" ".join(["word"] * 100)]
+    started = time.perf_counter()
+    for _ in range(3):
+        client.embed_documents(texts)
+        asyncio.run(client.aembed_documents(texts))
+    # The six calls spent the 600 tokens of the full bucket, these 10 wait a second
+    client.embed_documents([" ".join(["word"] * 10)])
+    elapsed = time.perf_counter() - started
+    client.close()
+    assert stats["inputs"] == 7
+    assert elapsed >= 0.9
+
+
+def test_batch_is_spread_over_the_concurrency_window(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0.3)
+    client = make_client(api_base, max_concurrency=4)
+    texts = [f"chunk {i}" for i in range(64)]
+    started = time.perf_counter()
+    vectors = client.embed_documents(texts)
+    elapsed = time.perf_counter() - started
+    client.close()
+    assert len(vectors) == 64 and all(len(vector) == 8 for vector in vectors)
+    assert stats["requests"] == 4
+    # The 4 requests overlap instead of taking 4 x 0.3 seconds
+    assert elapsed < 0.9
+
+
+def test_throttling_shrinks_the_window_for_later_calls(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0, throttle_rate=1.0)
+    client = make_client(api_base, max_concurrency=8, max_retries=0)
+    for _ in range(2):
+        try:
+            client.embed_documents(["text"])
+        except Exception:
+            pass
+    window = client.scheduler.window
+    client.close()
+    assert stats["throttled"] == 2
+    assert window == 2
+
+
+def test_bad_requests_fail_without_retries(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0, max_input_tokens=10)
+    client = make_client(api_base, max_concurrency=1)
+    started = time.perf_counter()
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        client.embed_documents([" ".join(["word"] * 11)])
+    assert error.value.status == 400
+    assert stats["requests"] == 1 and time.perf_counter() - started < 1
+    # The slot of the failed request is free again
+    assert client.scheduler.in_flight == 0
+    assert len(client.embed_documents(["short text"])) == 1
+    client.close()
+
+
+def test_inputs_over_the_limit_are_truncated(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0, max_input_tokens=MAX_INPUT_TOKENS)
+    client = make_client(api_base)
+    client.truncate = lambda text, max_tokens: " ".join(text.split()[:max_tokens])
+    vectors = client.embed_documents([" ".join(["word"] * (MAX_INPUT_TOKENS + 100)), "short text"])
+    client.close()
+    assert len(vectors) == 2 and stats["inputs"] == 2
+
+
+def test_cancelled_calls_give_their_slot_back(stub_server):
+    api_base, stats = stub_server(dim=8, latency=0.5)
+    client = make_client(api_base, max_concurrency=1)
+
+    async def cancel():
+        task = asyncio.ensure_future(client.aembed_documents(["text"]))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+
+    asyncio.run(cancel())
+    assert client.scheduler.in_flight == 0
+    assert len(client.embed_documents(["text"])) == 1
+    client.close()
@@ -0,0 +1,92 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from backends import MemoryBackend
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from engine import adelete_sources, aindex_chunks, amulti_search
+from fake_embeddings import FakeEmbeddings
+
+DIM = 16
+
+
+def make_chunks(sources, per_source=5):
+    return [SimpleNamespace(page_content=f"{source} paragraph {i}", metadata={"source": source})
+            for source in sources for i in range(per_source)]
+
+
+def test_chunks_are_written_to_every_backend_and_found_again(tmp_path):
+    embeddings = CachedEmbeddings(FakeEmbeddings(DIM), EmbeddingCache(str(tmp_path), dim=DIM))
+    backends = [MemoryBackend(DIM), MemoryBackend(DIM)]
+
+    async def run():
+        for backend in backends:
+            await backend.open()
+        count = await aindex_chunks(make_chunks(["a.md", "b.md"]), embeddings, backends, batch_size=3)
+        results = await amulti_search(backends, embeddings, ["b.md paragraph 2", "a.md paragraph 0"], k=2)
+        return count, results
+
+    count, results = asyncio.run(run())
+    assert count == 10
+    assert all(len(backend.rows) == 10 for backend in backends)
+    for found in results.values():
+        # The chunk with the question's text is the exact match
+        assert found[0][0]["text"] == "b.md paragraph 2" and found[0][0]["score"] == pytest.approx(0, abs=1e-5)
+        assert found[1][0]["metadata"] == {"source": "a.md"}
+
+
+def test_rewriting_a_file_after_deleting_its_chunks_keeps_one_copy():
+    embeddings = FakeEmbeddings(DIM)
+    backends = [MemoryBackend(DIM), MemoryBackend(DIM)]
+    # Counts are reported by backend name
+    backends[1].name = "memory2"
+
+    async def run():
+        await aindex_chunks(make_chunks(["a.md", "b.md"]), embeddings, backends)
+        deleted = await adelete_sources(backends, ["a.md"])
+        await aindex_chunks(make_chunks(["a.md"], per_source=3), embeddings, backends)
+        return deleted
+
+    deleted = asyncio.run(run())
+    assert deleted == {"memory": 5, "memory2": 5}
+    for backend in backends:
+        sources = [metadata["source"] for _, _, metadata in backend.rows.values()]
+        assert sorted(sources) == ["a.md"] * 3 + ["b.md"] * 5
+
+
+def test_a_failing_backend_stops_the_run():
+    class FailingBackend(MemoryBackend):
+        async def upsert(self, chunks, vectors, positions):
+            raise RuntimeError("store is down")
+
+    backends = [MemoryBackend(DIM), FailingBackend(DIM)]
+    with pytest.raises(RuntimeError, match="store is down"):
+        asyncio.run(aindex_chunks(make_chunks(["a.md"], per_source=50), FakeEmbeddings(DIM), backends,
+                                  batch_size=4, max_pending=1))
+    # Embedding stopped soon after the failure instead of going through the whole stream
+    assert len(backends[0].rows) < 50
+
+
+def test_replacing_files_one_at_a_time_keeps_the_rest_searchable():
+    embeddings = FakeEmbeddings(DIM)
+
+    class FailingBackend(MemoryBackend):
+        fail_on = None
+
+        async def upsert(self, chunks, vectors, positions):
+            if any(source == self.fail_on for source, _ in positions):
+                raise RuntimeError("store is down")
+            await super().upsert(chunks, vectors, positions)
+
+    backend = FailingBackend(DIM)
+    asyncio.run(aindex_chunks(make_chunks(["a.md", "b.md", "c.md"]), embeddings, [backend]))
+    backend.fail_on = "c.md"
+    written = []
+    with pytest.raises(RuntimeError, match="store is down"):
+        asyncio.run(aindex_chunks(make_chunks(["a.md", "b.md", "c.md"], per_source=2), embeddings, [backend],
+                                  batch_size=2, max_pending=1, replace=True, written=written))
+    # a.md and b.md were replaced; c.md was started, its old chunks deleted just before the failed write
+    assert written == [["a.md", "b.md", "c.md"]]
+    sources = sorted(metadata["source"] for _, _, metadata in backend.rows.values())
+    assert sources == ["a.md"] * 2 + ["b.md"] * 2
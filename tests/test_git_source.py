@@ -0,0 +1,55 @@
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("git")
+
+from git_source import changed_files, sync_repo
+
+
+def commit(repo, files):
+    # files maps names to contents, None removes the file
+    for name, content in files.items():
+        path = os.path.join(repo, name)
+        if content is None:
+            os.remove(path)
+        else:
+            with open(path, "w", encoding="utf8") as f:
+                f.write(content)
+    subprocess.run(["git", "add", "-A"], cwd=repo, check=True)
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com",
+                    "commit", "-q", "-m", "update"], cwd=repo, check=True)
+
+
+def test_updates_are_fetched_and_changed_files_found_by_diffing(tmp_path):
+    source = str(tmp_path / "source")
+    subprocess.run(["git", "init", "-q", "-b", "main", source], check=True)
+    commit(source, {"a.md": "a", "b.md": "b", "c.txt": "c"})
+    url = "file://" + source
+    checkout = str(tmp_path / "checkout")
+
+    first = sync_repo(url, checkout, "md")
+    # Only files of the indexed type are checked out
+    assert sorted(os.listdir(checkout)) == [".git", "a.md", "b.md"]
+
+    commit(source, {"a.md": "a2", "b.md": None, "c.txt": "c2", "d.md": "d"})
+    second = sync_repo(url, checkout, "md")
+    assert second != first
+    assert sorted(os.listdir(checkout)) == [".git", "a.md", "d.md"]
+    assert sorted(changed_files(checkout, first, "md")) == [os.path.join(checkout, name)
+                                                           for name in ("a.md", "b.md", "d.md")]
+    assert changed_files(checkout, second, "md") == []
+
+
+def test_changes_cant_be_told_without_a_known_commit(tmp_path):
+    source = str(tmp_path / "source")
+    subprocess.run(["git", "init", "-q", "-b", "main", source], check=True)
+    commit(source, {"a.md": "a"})
+    checkout = str(tmp_path / "checkout")
+    sync_repo("file://" + source, checkout, "md")
+    assert changed_files(checkout, None, "md") is None
+    assert changed_files(checkout, "0" * 40, "md") is None
+    (tmp_path / "plain").mkdir()
+    with pytest.raises(ValueError):
+        sync_repo("file://" + source, str(tmp_path / "plain"), "md")
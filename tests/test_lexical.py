@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+from lexical import BM25Index, BM25Writer, rrf_fuse, tokenize
+
+TEXTS = [f"chunk {i} mentions get_block_hash {'E0123 ' * (i % 3)}and word{i % 7}" for i in range(60)]
+
+
+def build(directory, texts, ids=None, **options):
+    writer = BM25Writer(str(directory), **options)
+    writer.add(ids or list(range(len(texts))), texts)
+    writer.save()
+    return BM25Index(str(directory))
+
+
+def results(index, queries=("E0123", "word3 get_block_hash", "chunk 42", "missing")):
+    return [[(i, round(score, 4)) for i, score in index.search(query, k=5)] for query in queries]
+
+
+def test_spilled_segments_give_the_same_index(tmp_path):
+    in_memory = build(tmp_path / "a", TEXTS)
+    spilled = build(tmp_path / "b", TEXTS, spill_postings=16)
+    assert results(spilled) == results(in_memory)
+    assert spilled.terms == in_memory.terms and spilled.postings.tolist() == in_memory.postings.tolist()
+    assert not os.path.exists(str(tmp_path / "b") + ".segments")
+
+
+def test_incremental_updates_match_a_rebuild(tmp_path):
+    build(tmp_path / "index", TEXTS[:40], spill_postings=32)
+    writer = BM25Writer.load(str(tmp_path / "index"))
+    writer.spill_postings = 32
+    writer.remove(range(0, 40, 4))
+    writer.add(list(range(40, 60)), TEXTS[40:])
+    writer.save()
+    # A second round on the same writer continues from what it saved
+    writer.remove([41])
+    writer.save()
+
+    kept = [i for i in range(60) if (i >= 40 or i % 4) and i != 41]
+    rebuilt = build(tmp_path / "rebuilt", [TEXTS[i] for i in kept], kept)
+    index = BM25Index(str(tmp_path / "index"))
+    assert index.ids == kept
+    assert results(index) == results(rebuilt)
+
+
+def test_search_ranks_the_rarer_match_first(tmp_path):
+    index = build(tmp_path, ["the cache is warm", "the E0042 error from the cache", "the the the"])
+    assert [i for i, _ in index.search("E0042 cache", k=3)] == [1, 0]
+    assert index.search("nothing", k=3) == []
+    assert tokenize("Call get_block_hash(E0123)!") == ["call", "get_block_hash", "e0123"]
+
+
+def test_rrf_fuse_rewards_results_found_by_both_rankings():
+    vector = [{"id": 1, "text": "a"}, {"id": 2, "text": "b"}, {"id": 3, "text": "c"}]
+    lexical = [{"id": 3, "text": "c"}, {"id": 4, "text": "d"}]
+    fused = rrf_fuse([vector, lexical], k=3)
+    # 2 and 4 tie at rank 2, the earlier ranking wins
+    assert [result["id"] for result in fused] == [3, 1, 2]
+    assert fused[0]["score"] == pytest.approx(1 / 63 + 1 / 61)
+    # Results without ids are matched on their text
+    assert len(rrf_fuse([[{"text": "x"}], [{"text": "x"}]], k=5)) == 1
@@ -0,0 +1,70 @@
+import numpy as np
+
+from local_store import LocalVectorStore, exact_search
+from fake_embeddings import FakeEmbeddings
+
+DIM = 16
+
+
+def random_vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+
+
+def brute_force(vectors, queries, k, deleted=()):
+    distances = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    distances[:, list(deleted)] = np.inf
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+def fill(store, vectors, batch=250):
+    for start in range(0, len(vectors), batch):
+        rows = vectors[start:start + batch]
+        store.add_vectors(rows, [f"row {start + i}" for i in range(len(rows))],
+                          [{"source": f"f{(start + i) % 7}.md"} for i in range(len(rows))])
+
+
+def recall(found, expected):
+    return np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found.tolist(), expected.tolist())])
+
+
+def test_exact_search_in_blocks_matches_brute_force():
+    vectors, queries = random_vectors(500), random_vectors(20, seed=1)
+    ids, distances = exact_search(vectors, queries, 5, deleted=np.array([3, 250]), block_size=64)
+    assert ids.tolist() == brute_force(vectors, queries, 5, deleted=[3, 250]).tolist()
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_flat_store_persists_rows_and_deletions(tmp_path):
+    vectors, queries = random_vectors(600), random_vectors(10, seed=1)
+    store = LocalVectorStore.create(str(tmp_path), FakeEmbeddings(DIM), dim=DIM, block_size=128)
+    fill(store, vectors)
+    deleted = brute_force(vectors, queries, 1)[:, 0].tolist()
+    store.delete(deleted)
+
+    store = LocalVectorStore(str(tmp_path), FakeEmbeddings(DIM))
+    assert len(store) == 600 - len(set(deleted))
+    ids, _ = store.search_vectors(queries, k=4)
+    assert ids.tolist() == brute_force(vectors, queries, 4, deleted).tolist()
+    assert store.records[7] == {"text": "row 7", "metadata": {"source": "f0.md"}}
+    # Fewer rows than k are padded with -1
+    ids, _ = store.search_vectors(queries, k=700)
+    assert (ids[:, -len(set(deleted)):] == -1).all()
+
+
+def test_hnsw_recall_holds_after_adding_rows_and_reloading(tmp_path):
+    vectors, queries = random_vectors(1500), random_vectors(30, seed=1)
+    store = LocalVectorStore.create(str(tmp_path), FakeEmbeddings(DIM), dim=DIM, index_type="HNSW",
+                                    M=8, ef_construction=64, ef=64)
+    fill(store, vectors[:1000])
+    store.build_index()
+    ids, _ = store.search_vectors(queries, k=10)
+    assert recall(ids, brute_force(vectors[:1000], queries, 10)) >= 0.9
+
+    # Rows added later extend the saved graph, which a new process loads
+    fill(store, vectors[1000:])
+    store.build_index()
+    store.delete(range(0, 1500, 10))
+    store = LocalVectorStore(str(tmp_path), FakeEmbeddings(DIM))
+    ids, _ = store.search_vectors(queries, k=10)
+    assert not set(ids.ravel().tolist()) & set(range(0, 1500, 10))
+    assert recall(ids, brute_force(vectors, queries, 10, deleted=range(0, 1500, 10))) >= 0.9
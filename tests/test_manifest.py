@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from manifest import Manifest, sync_files
+
+
+class Store:
+    """Chunks by id, with a file's chunks stored one by one like a batched insert."""
+
+    def __init__(self):
+        self.rows = {}
+        self.next_id = 0
+        self.fail_on = None
+
+    def index_file(self, path):
+        with open(path, encoding="utf8") as f:
+            lines = f.read().splitlines()
+        ids = []
+        for line in lines:
+            if line == self.fail_on:
+                raise RuntimeError(f"can't store {line}")
+            self.rows[self.next_id] = (path, line)
+            ids.append(self.next_id)
+            self.next_id += 1
+        return ids
+
+    def delete(self, ids):
+        for row_id in ids:
+            self.rows.pop(row_id, None)
+
+    def find(self, sources):
+        return [row_id for row_id, (path, _) in self.rows.items() if path in sources]
+
+    def lines(self):
+        return sorted(line for _, line in self.rows.values())
+
+
+def write_files(directory, contents):
+    paths = []
+    for name, lines in contents.items():
+        path = os.path.join(directory, name)
+        with open(path, "w", encoding="utf8") as f:
+            f.write("\n".join(lines))
+        paths.append(path)
+    return sorted(paths)
+
+
+def sync(manifest, store, paths):
+    return sync_files(manifest, paths, store.index_file, store.delete, find_ids=store.find)
+
+
+def test_files_are_logged_and_the_manifest_written_once(tmp_path):
+    paths = write_files(str(tmp_path), {f"f{i}.txt": [f"f{i} a", f"f{i} b"] for i in range(20)})
+    manifest_path = str(tmp_path / "m.json")
+    store = Store()
+    index_file = store.index_file
+
+    def check_not_saved_yet(path):
+        assert not os.path.exists(manifest_path)
+        return index_file(path)
+
+    store.index_file = check_not_saved_yet
+    assert sync(Manifest(manifest_path), store, paths) == (20, 0)
+    assert os.path.exists(manifest_path) and not os.path.exists(manifest_path + ".log")
+    manifest = Manifest(manifest_path)
+    assert manifest.ids(paths[3]) == [6, 7]
+    store.index_file = index_file
+    assert sync(manifest, store, paths) == (0, 0)
+
+
+def test_chunks_of_a_failed_file_are_deleted_by_the_next_run(tmp_path):
+    paths = write_files(str(tmp_path), {"a.txt": ["a 1", "a 2"], "b.txt": ["b 1", "b 2", "b 3"]})
+    manifest_path = str(tmp_path / "m.json")
+    store = Store()
+    store.fail_on = "b 3"
+    with pytest.raises(RuntimeError):
+        sync(Manifest(manifest_path), store, paths)
+    # b's first two chunks were stored before the failure, and recorded
+    assert Manifest(manifest_path).ids(paths[1]) == [2, 3]
+
+    store.fail_on = None
+    assert sync(Manifest(manifest_path), store, paths) == (1, 0)
+    assert store.lines() == ["a 1", "a 2", "b 1", "b 2", "b 3"]
+
+
+def test_a_run_that_died_in_a_file_is_recovered_from_the_log(tmp_path):
+    paths = write_files(str(tmp_path), {"a.txt": ["a 1"], "b.txt": ["b 1", "b 2"]})
+    manifest_path = str(tmp_path / "m.json")
+    store = Store()
+    manifest = Manifest(manifest_path)
+    # What a killed process leaves: the log of a, and b started but not recorded
+    manifest.log_record(paths[0], "stale-hash", store.index_file(paths[0]))
+    manifest.log_start(paths[1])
+    store.index_file(paths[1])
+    with open(manifest.log_path, "a", encoding="utf8") as f:
+        f.write('{"path": "')
+
+    manifest = Manifest(manifest_path)
+    assert manifest.exists and manifest.pending == paths[1]
+    assert sync(manifest, store, paths) == (2, 0)
+    assert store.lines() == ["a 1", "b 1", "b 2"]
+    assert Manifest(manifest_path).pending is None
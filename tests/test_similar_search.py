@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+
+from similar_search import hybrid_multi_search, redis_multi_search
+
+
+class Pipeline:
+    """Records FT.SEARCH commands and answers them with canned raw replies."""
+
+    def __init__(self, replies):
+        self.commands = []
+        self.replies = replies
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+
+    def execute(self):
+        return self.replies[:len(self.commands)]
+
+
+class Client:
+    def __init__(self, replies):
+        self.pipelines = []
+        self.replies = replies
+
+    def pipeline(self, transaction=True):
+        self.pipelines.append(Pipeline(self.replies))
+        return self.pipelines[-1]
+
+
+def test_redis_search_sends_the_vectors_in_one_round_trip():
+    metadata = json.dumps({"source": "docs/a.md"}).encode()
+    replies = [
+        [2, b"doc:c:1", [b"content", b"first", b"metadata", metadata, b"score", b"0.1"],
+         b"doc:c:2", [b"score", b"0.3", b"content", b"second", b"metadata", metadata]],
+        [0],
+    ]
+    client = Client(replies)
+    vectors = [[0.5, 0.25], [1.0, 0.0]]
+    results = redis_multi_search(client, "c", vectors, 2)
+
+    assert len(client.pipelines) == 1
+    command = client.pipelines[0].commands[0]
+    assert command[:3] == ("FT.SEARCH", "c", "*=>[KNN 2 @content_vector $vector AS score]")
+    assert command[6] == np.asarray(vectors[0], dtype=np.float32).tobytes()
+    assert results == [
+        [{"id": "doc:c:1", "text": "first", "metadata": {"source": "docs/a.md"}, "score": 0.1},
+         {"id": "doc:c:2", "text": "second", "metadata": {"source": "docs/a.md"}, "score": 0.3}],
+        [],
+    ]
+
+
+def test_hybrid_search_fuses_each_question_separately():
+    vector = [[{"id": 1, "text": "a"}, {"id": 2, "text": "b"}], [{"id": 5, "text": "e"}]]
+    lexical = [[{"id": 2, "text": "b"}], []]
+    fused = hybrid_multi_search(vector, lexical, k=2)
+    assert [[result["id"] for result in question] for question in fused] == [[2, 1], [5]]
@@ -0,0 +1,49 @@
+import pytest
+
+from token_splitter import StructuredTokenSplitter
+
+
+class WordSplitter(StructuredTokenSplitter):
+    """Counts words instead of tiktoken tokens, which needs no download."""
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+
+def section(title, words):
+    return f"# {title}\n\n" + " ".join(f"{title.lower()}{i}" for i in range(words)) + "\n\n"
+
+
+def test_chunks_end_before_headings_and_keep_every_word():
+    text = section("Install", 12) + section("Usage", 12) + section("Config", 12)
+    chunks = WordSplitter(chunk_size=20, file_type="markdown").split_text(text)
+    assert [chunk.splitlines()[0] for chunk in chunks] == ["# Install", "# Usage", "# Config"]
+    assert all(len(chunk.split()) <= 20 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_a_code_block_is_not_cut_when_it_fits():
+    code = "```\n" + "".join(f"line{i} = {i}\n" for i in range(6)) + "```\n"
+    text = "intro " * 14 + "\n\n" + code + "\nafter " * 4
+    # The cut goes before the opening fence, not inside the block
+    chunks = WordSplitter(chunk_size=24, file_type="markdown").split_text(text)
+    assert sum(code.strip() in chunk for chunk in chunks) == 1
+
+
+def test_long_lines_are_cut_at_words_and_within_the_byte_limit():
+    text = " ".join(["äöü"] * 40) + " " + "x" * 50
+    chunks = WordSplitter(chunk_size=10, max_length=24).split_text(text)
+    assert all(len(chunk.encode("utf-8")) <= 24 for chunk in chunks)
+    assert all(len(chunk.split()) <= 10 for chunk in chunks)
+    # The word too long for one chunk is hard-cut, nothing is lost
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+
+
+def test_overlap_repeats_the_end_of_the_previous_chunk():
+    text = "".join(f"line {i} of the file\n" for i in range(20))
+    chunks = WordSplitter(chunk_size=20, chunk_overlap=5).split_text(text)
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.splitlines()[0] == previous.splitlines()[-1]
+    with pytest.raises(ValueError):
+        WordSplitter(chunk_size=10, chunk_overlap=10)